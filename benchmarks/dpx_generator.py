@@ -0,0 +1,138 @@
+import argparse
+import os
+import random
+import struct
+
+import numpy as np
+
+from utils.dpx_header import DPX_HEADER_SIZE, DPX_MAGIC_BIG, DPX_MAGIC_LITTLE, DpxHeader, expected_image_size
+
+# Characteristics rawcooked has to keep in the reversibility data, see reversibility_probe.find_header_anomalies
+ANOMALIES = ('user_data', 'trailing_data', 'padding_bits', 'size_field')
+USER_DATA_SIZE = 6000
+TRAILING_DATA_SIZE = 4096
+# Image data is built from a block of random words repeated over the frame, so generating is not CPU bound
+NOISE_BLOCK_BYTES = 1024 * 1024
+# Filled packing (method A) for the bit depths that do not fit 32-bit words exactly
+PACKING_BY_DEPTH = {8: 0, 10: 1, 12: 1, 16: 0}
+PADDING_MASKS = {10: 0x00000003, 12: 0x000F000F}
+
+
+def _image_size(width, height, bit_depth) -> int:
+    header = DpxHeader('Big', 'V2.0', 0, 0, 0, width, height, 1, 50, 2, 2, bit_depth, PACKING_BY_DEPTH[bit_depth], 0,
+                       0, 0, 0)
+    return expected_image_size(header)
+
+
+def _noise_block(bit_depth, big_endian, padding_bits, seed) -> bytes:
+    """Random image words with the padding bits cleared, unless padding_bits is set"""
+    rng = np.random.default_rng(seed)
+    words = rng.integers(0, 2 ** 32, NOISE_BLOCK_BYTES // 4, dtype=np.uint64).astype(np.uint32)
+    mask = PADDING_MASKS.get(bit_depth, 0)
+    if mask:
+        words &= np.uint32(~mask & 0xFFFFFFFF)
+        if padding_bits:
+            words |= np.uint32(mask)
+    return words.astype('>u4' if big_endian else '<u4').tobytes()
+
+
+def build_header(width, height, bit_depth, image_offset, file_size, user_data_size=0, big_endian=True) -> bytes:
+    """Builds the 2048 byte generic and image headers of a single element RGB frame"""
+    endian = '>' if big_endian else '<'
+    header = bytearray(DPX_HEADER_SIZE)
+    header[0:4] = DPX_MAGIC_BIG if big_endian else DPX_MAGIC_LITTLE
+    struct.pack_into(endian + 'I', header, 4, image_offset)
+    header[8:12] = b'V2.0'
+    struct.pack_into(endian + 'IIIII', header, 16, file_size, 0, 1664, 384, user_data_size)
+    struct.pack_into(endian + 'HHII', header, 768, 0, 1, width, height)
+    # Data sign, reference low/high data and quantity, then descriptor RGB, linear transfer and colorimetry
+    struct.pack_into(endian + 'IIfIfBBBBHHIII', header, 780, 0, 0, 0.0, 2 ** bit_depth - 1, 2.047, 50, 2, 2,
+                     bit_depth, PACKING_BY_DEPTH[bit_depth], 0, image_offset, 0, 0)
+    return bytes(header)
+
+
+def write_frame(path, width, height, bit_depth, noise, anomalies=(), big_endian=True) -> int:
+    """Writes one DPX frame and returns its size in bytes"""
+    image_size = _image_size(width, height, bit_depth)
+    user_data_size = USER_DATA_SIZE if 'user_data' in anomalies else 0
+    image_offset = DPX_HEADER_SIZE + user_data_size
+    trailing = TRAILING_DATA_SIZE if 'trailing_data' in anomalies else 0
+    file_size = image_offset + image_size + trailing
+    size_field = file_size + 1024 if 'size_field' in anomalies else file_size
+
+    with open(path, 'wb') as file:
+        file.write(build_header(width, height, bit_depth, image_offset, size_field, user_data_size, big_endian))
+        if user_data_size:
+            file.write(b'\x01' * user_data_size)
+        remaining = image_size
+        while remaining:
+            chunk = noise[:remaining]
+            file.write(chunk)
+            remaining -= len(chunk)
+        if trailing:
+            file.write(b'\x02' * trailing)
+    return file_size
+
+
+def generate_sequence(root, name, frames, width=2048, height=1556, bit_depth=10, gaps=0, anomaly=None,
+                      anomaly_frames=0, first_frame=1, big_endian=True, seed=None) -> dict:
+    """Writes a sequence as root/name/<width>x<height>/name_<frame>.dpx, the layout the workflow expects
+
+    gaps frames are left out at random positions (never the first or last frame). With anomaly, one of ANOMALIES,
+    anomaly_frames random frames carry it, or every frame when anomaly_frames is 0.
+    Returns a description of the sequence.
+    """
+    rng = random.Random(seed if seed is not None else name)
+    folder = os.path.join(root, name, f"{width}x{height}")
+    os.makedirs(folder, exist_ok=True)
+
+    numbers = list(range(first_frame, first_frame + frames))
+    missing = set(rng.sample(numbers[1:-1], min(gaps, max(0, frames - 2))))
+    numbers = [number for number in numbers if number not in missing]
+    anomalous = set()
+    if anomaly:
+        anomalous = set(numbers) if not anomaly_frames else set(rng.sample(numbers, min(anomaly_frames, len(numbers))))
+
+    noise = _noise_block(bit_depth, big_endian, False, rng.getrandbits(32))
+    padded_noise = _noise_block(bit_depth, big_endian, True, rng.getrandbits(32)) if anomaly == 'padding_bits' else None
+    byte_total = 0
+    for number in numbers:
+        frame_anomalies = (anomaly,) if number in anomalous else ()
+        frame_noise = padded_noise if 'padding_bits' in frame_anomalies else noise
+        byte_total += write_frame(os.path.join(folder, f"{name}_{number:07d}.dpx"), width, height, bit_depth,
+                                  frame_noise, frame_anomalies, big_endian)
+
+    return {
+        'name': name,
+        'path': os.path.join(root, name),
+        'frames': len(numbers),
+        'bytes': byte_total,
+        'missing_frames': sorted(missing),
+        'anomaly': anomaly,
+        'anomalous_frames': len(anomalous),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates synthetic DPX sequences")
+    parser.add_argument('output', help="Folder the sequences are written to")
+    parser.add_argument('--sequences', type=int, default=1)
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--height', type=int, default=1556)
+    parser.add_argument('--bit-depth', type=int, default=10, choices=sorted(PACKING_BY_DEPTH))
+    parser.add_argument('--gaps', type=int, default=0, help="Frames left out of each sequence")
+    parser.add_argument('--anomaly', choices=ANOMALIES)
+    parser.add_argument('--anomaly-frames', type=int, default=0, help="Frames with the anomaly, 0 for all")
+    parser.add_argument('--little-endian', action='store_true')
+    args = parser.parse_args()
+
+    for index in range(args.sequences):
+        description = generate_sequence(args.output, f"seq{index:04d}", args.frames, args.width, args.height,
+                                        args.bit_depth, args.gaps, args.anomaly, args.anomaly_frames,
+                                        big_endian=not args.little_endian)
+        print(f"{description['path']}: {description['frames']} frames, {description['bytes'] / 2 ** 20:.0f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Runs several local processes standing in for encode nodes that drain one queue of sequences through leases
+
+Each node claims sequences from a shared lease folder the way dpx_rawcook does with RAWCOOK_LEASE_DIR set, holds each
+claim for the time of a fake encode and marks it done. With --crash-nodes some nodes die in the middle of their first
+encode without giving the lease back, and the other nodes reclaim the sequence once the lease expires. Every claim is
+appended to a shared event log, which is checked afterwards: each sequence has to be finished exactly once and no two
+nodes may hold the same sequence at the same time.
+
+    python3 -m benchmarks.lease_contention --nodes 4 --sequences 40 --crash-nodes 1 --ttl 2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from utils.lease import LeaseManager, DONE
+
+EVENTS_NAME = 'events.jsonl'
+
+
+def append_event(path: str, **event) -> None:
+    # A single write of a short line to a file opened with O_APPEND is not interleaved with the other nodes
+    with open(path, 'a') as file:
+        file.write(json.dumps(event) + '\n')
+
+
+def run_node(node: str, lease_dir: str, events_path: str, names: list, job_seconds: float, ttl: float,
+             heartbeat: float, crash: bool, deadline: float) -> None:
+    leases = LeaseManager(lease_dir, node, ttl, heartbeat)
+    lost = set()
+    leases.start(lost.add)
+    order = list(names)
+    random.Random(node).shuffle(order)
+    remaining = set(order)
+    while remaining and time.time() < deadline:
+        for name in order:
+            if name not in remaining:
+                continue
+            lease = leases.read(name)
+            if lease is not None and lease[0].get('state') == DONE:
+                remaining.discard(name)
+                continue
+            if not leases.acquire(name):
+                continue
+            start = time.time()
+            append_event(events_path, node=node, name=name, event='claim', time=start)
+            if crash:
+                time.sleep(job_seconds / 2)
+                # Dies without releasing the lease or stopping the heartbeat cleanly
+                os._exit(1)
+            end = start + job_seconds
+            while time.time() < end and name not in lost:
+                time.sleep(min(0.05, job_seconds))
+            if name in lost:
+                append_event(events_path, node=node, name=name, event='lost', time=time.time())
+                continue
+            # Checked before the lease is marked, as the log would be wrong if another node held it meanwhile
+            append_event(events_path, node=node, name=name, event='done', time=time.time(), owned=leases.owns(name))
+            leases.mark_done(name)
+            remaining.discard(name)
+        time.sleep(heartbeat / 4)
+    leases.stop()
+
+
+def check_events(events_path: str, names: list, crashed: set) -> dict:
+    with open(events_path) as file:
+        events = [json.loads(line) for line in file]
+    claims = {}
+    for event in events:
+        claims.setdefault(event['name'], []).append(event)
+
+    finished = {}
+    overlaps = []
+    reclaimed = 0
+    taken_over = 0
+    for name in names:
+        history = sorted(claims.get(name, []), key=lambda event: event['time'])
+        done = [event for event in history if event['event'] == 'done']
+        finished[name] = len(done)
+        # The node holding the sequence, from its claim until its done or lost event. Only the claims of crashed
+        # nodes may be taken over while open
+        holder = None
+        for event in history:
+            if event['event'] == 'claim':
+                if holder is not None:
+                    if holder['node'] in crashed:
+                        reclaimed += 1
+                    else:
+                        overlaps.append((name, holder['node'], event['node']))
+                holder = event
+            elif event['event'] == 'lost':
+                taken_over += 1
+                if holder is not None and holder['node'] == event['node']:
+                    holder = None
+            elif holder is not None and holder['node'] == event['node'] and event.get('owned', True):
+                holder = None
+            else:
+                overlaps.append((name, holder['node'] if holder else None, event['node']))
+    return {
+        'events': len(events),
+        'finished_once': sum(1 for count in finished.values() if count == 1),
+        'unfinished': [name for name, count in finished.items() if count == 0],
+        'finished_twice': [name for name, count in finished.items() if count > 1],
+        'overlaps': overlaps,
+        'reclaimed': reclaimed,
+        'taken_over': taken_over,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks that several nodes drain one queue without double claims")
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--sequences', type=int, default=40)
+    parser.add_argument('--job-seconds', type=float, default=0.2, help="Time each fake encode holds its lease")
+    parser.add_argument('--crash-nodes', type=int, default=0, help="Nodes dying during their first encode")
+    parser.add_argument('--ttl', type=float, default=2.0)
+    parser.add_argument('--heartbeat', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--workdir', help="Lease folder parent, a temporary folder by default")
+    parser.add_argument('--output', help="JSON file the results are written to, printed when not given")
+    args = parser.parse_args()
+
+    root = args.workdir or tempfile.mkdtemp(prefix='lease_contention_')
+    lease_dir = os.path.join(root, 'leases')
+    events_path = os.path.join(root, EVENTS_NAME)
+    names = [f"N_{number:06d}_01of01" for number in range(args.sequences)]
+    deadline = time.time() + args.timeout
+
+    started = time.time()
+    processes = []
+    for number in range(args.nodes):
+        process = multiprocessing.Process(target=run_node, args=(
+            f"node{number}", lease_dir, events_path, names, args.job_seconds, args.ttl, args.heartbeat,
+            number < args.crash_nodes, deadline))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+    wall_seconds = time.time() - started
+
+    results = {
+        'nodes': args.nodes,
+        'crash_nodes': args.crash_nodes,
+        'sequences': args.sequences,
+        'job_seconds': args.job_seconds,
+        'ttl': args.ttl,
+        'heartbeat': args.heartbeat,
+        'wall_seconds': round(wall_seconds, 3),
+        'ideal_seconds': round(args.sequences * args.job_seconds / max(args.nodes - args.crash_nodes, 1), 3),
+        **check_events(events_path, names, {f"node{number}" for number in range(args.crash_nodes)}),
+    }
+    if not args.workdir:
+        shutil.rmtree(root)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    if results['unfinished'] or results['finished_twice'] or results['overlaps']:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
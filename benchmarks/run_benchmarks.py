@@ -0,0 +1,263 @@
+"""Times the assessment, rawcook and post-rawcook workflows end to end on synthetic DPX sequences
+
+Builds a throw-away working folder with the directory structure of the README, fills the gap check folder with
+generated sequences and puts the stub rawcooked and mediaconch of benchmarks/stubs first on PATH. Each workflow is
+then run once with its execute() method while the per-sequence stages are timed, and the results are written as
+JSON so they can be compared across releases:
+
+    python3 -m benchmarks.run_benchmarks --sequences 8 --frames 200 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUBS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'stubs')
+
+# Folders of the working directory, relative to FILM_OPS, as in the README
+WORKING_FOLDERS = {
+    'SCRIPT_LOGS': 'logs',
+    'PREPROCESSING': 'media/preprocessing',
+    'RAWCOOKED': 'media/rawcook',
+    'DPX_GAP_CHECK': 'media/preprocessing/dpx_gap_check',
+    'DPX_POLICY_CHECK': 'media/preprocessing/dpx_policy_check',
+    'DPX_TO_COOK': 'media/rawcook/dpx_to_cook',
+    'DPX_TO_COOK_V2': 'media/rawcook/dpx_to_cook_v2',
+    'MKV_COOKED': 'media/rawcook/mkv_cooked',
+    'DPX_GAP_CHECK_FAILED': 'media/review/failed/gap_check_failures',
+    'DPX_POLICY_CHECK_FAILED': 'media/review/failed/dpx_policy_failures',
+    'MKV_POLICY_CHECK_FAILED': 'media/review/failed/mkv_policy_failures',
+    'RAWCOOKED_FAILED': 'media/review/failed/rawcook_failures',
+    'POST_RAWCOOKED_FAILED': 'media/review/failed/post_rawcook_failures',
+    'MKV_COMPLETED': 'media/review/completed',
+}
+POLICY_FILES = {
+    'POLICY_DPX': 'policy/rawcooked_dpx_policy.xml',
+    'POLICY_MKV': 'policy/rawcooked_mkv_policy.xml',
+}
+
+DPX_POLICY = """<?xml version="1.0"?>
+<policy type="and" name="Benchmark DPX policy">
+  <rule name="DPX" value="Format" tracktype="Image" operator="=">DPX</rule>
+  <rule name="Width" value="Width" tracktype="Image" operator="&gt;=">1</rule>
+  <rule name="Bit depth" value="BitDepth" tracktype="Image" operator="&lt;=">16</rule>
+</policy>
+"""
+MKV_POLICY = """<?xml version="1.0"?>
+<policy type="and" name="Benchmark MKV policy">
+  <rule name="Matroska" value="Format" tracktype="General" operator="=">Matroska</rule>
+</policy>
+"""
+
+# Methods timed in each workflow. Most of them run concurrently on worker pools, so their totals can be larger than
+# the wall time of the workflow.
+STAGES = {
+    'assessment': ('gap_check_sequence', 'check_v2_sequence', 'check_policy_sequence', 'move_sequence'),
+    'rawcook': ('find_sequences', 'rawcooked_command_executor', 'collect_result'),
+    'post_rawcook': ('process_item', 'check_mkv_policy', 'check_log', 'verify_framemd5', 'complete_item', 'fail_item',
+                     'move_dpx_completed'),
+}
+
+
+class StageTimer:
+    """Wraps methods of a workflow object and accumulates the number of calls and the time spent in them"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def wrap(self, instance, method_names) -> None:
+        for name in method_names:
+            method = getattr(instance, name, None)
+            if method is not None:
+                setattr(instance, name, self._timed(name, method))
+
+    def _timed(self, name, method):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    stage = self.stages.setdefault(name, {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+                    stage['calls'] += 1
+                    stage['total_seconds'] += elapsed
+                    stage['max_seconds'] = max(stage['max_seconds'], elapsed)
+        return timed
+
+
+def prepare_workspace(root: str, verify_framemd5: bool) -> dict:
+    """Creates the working folders and policies and sets the environment read by scripts.config"""
+    environment = {'FILM_OPS': root}
+    for variable, relative_path in {**WORKING_FOLDERS, **POLICY_FILES}.items():
+        environment[variable] = relative_path
+    for relative_path in WORKING_FOLDERS.values():
+        os.makedirs(os.path.join(root, relative_path), exist_ok=True)
+    os.makedirs(os.path.join(root, 'policy'), exist_ok=True)
+    for variable, content in (('POLICY_DPX', DPX_POLICY), ('POLICY_MKV', MKV_POLICY)):
+        with open(os.path.join(root, POLICY_FILES[variable]), 'w') as file:
+            file.write(content)
+
+    environment.update({
+        'RAWCOOK_LICENSE': os.environ.get('RAWCOOK_LICENSE', 'benchmark'),
+        'WORKFLOW_STATE_DB': os.path.join(root, 'logs', 'workflow_state.db'),
+        'SEQUENCE_INDEX_CACHE': os.path.join(root, 'logs', 'sequence_index'),
+        'FRAMEMD5_VERIFY': '1' if verify_framemd5 else '0',
+        'PATH': STUBS_DIR + os.pathsep + os.environ.get('PATH', ''),
+    })
+    os.environ.update(environment)
+    return environment
+
+
+def folder_counts(root: str) -> dict:
+    """Number of entries left in each working folder, to check where the sequences ended up"""
+    counts = {}
+    for variable, relative_path in WORKING_FOLDERS.items():
+        if variable in ('SCRIPT_LOGS', 'PREPROCESSING', 'RAWCOOKED'):
+            continue
+        with os.scandir(os.path.join(root, relative_path)) as entries:
+            counts[variable] = sum(1 for entry in entries if not entry.name.startswith('.'))
+    return counts
+
+
+def drop_page_cache(root: str) -> None:
+    """Evicts the files of the working folder from the page cache, so the next workflow reads them cold like from
+    a NAS. Needs no privileges, unlike writing to /proc/sys/vm/drop_caches"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for folder, _, names in os.walk(os.path.join(root, 'media')):
+        for name in names:
+            try:
+                fd = os.open(os.path.join(folder, name), os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_workflow(name, factory, timer_stages) -> dict:
+    timer = StageTimer()
+    workflow = factory()
+    timer.wrap(workflow, timer_stages)
+    start = time.perf_counter()
+    error = None
+    try:
+        workflow.execute()
+    except Exception as e:
+        error = str(e)
+    return {'seconds': time.perf_counter() - start, 'error': error, 'stages': timer.stages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the DPX workflows on synthetic sequences")
+    parser.add_argument('--sequences', type=int, default=4)
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--height', type=int, default=1556)
+    parser.add_argument('--bit-depth', type=int, default=10)
+    parser.add_argument('--gap-sequences', type=int, default=0, help="Sequences generated with a missing frame")
+    parser.add_argument('--anomaly-sequences', type=int, default=0,
+                        help="Sequences generated with user data, which are cooked with output version 2")
+    parser.add_argument('--rawcooked-latency', type=float, default=0.0)
+    parser.add_argument('--rawcooked-cpu', type=float, default=0.0, help="CPU seconds burnt per GiB by rawcooked")
+    parser.add_argument('--rawcooked-lines', type=int, default=10, help="Output lines per 100 frames")
+    parser.add_argument('--mediaconch-latency', type=float, default=0.0)
+    parser.add_argument('--verify-framemd5', action='store_true', help="Needs a real ffmpeg on PATH")
+    parser.add_argument('--io-hints', choices=('on', 'off'), default='on',
+                        help="Page cache prefetch and eviction hints around the cook stage")
+    parser.add_argument('--cold', action='store_true',
+                        help="Drop the working folder from the page cache before each workflow")
+    parser.add_argument('--workdir', help="Working folder, a temporary folder by default")
+    parser.add_argument('--keep', action='store_true', help="Keep the working folder")
+    parser.add_argument('--output', help="JSON file the results are written to, printed when not given")
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='rawcook_bench_')
+    os.environ.update({
+        'BENCH_RAWCOOKED_LATENCY': str(args.rawcooked_latency),
+        'BENCH_RAWCOOKED_CPU_SECONDS_GB': str(args.rawcooked_cpu),
+        'BENCH_RAWCOOKED_OUTPUT_LINES': str(args.rawcooked_lines),
+        'BENCH_MEDIACONCH_LATENCY': str(args.mediaconch_latency),
+        'IO_HINTS': '1' if args.io_hints == 'on' else '0',
+    })
+    prepare_workspace(root, args.verify_framemd5)
+
+    # The workflows read their configuration when imported, so they are imported once the environment is set
+    sys.path.insert(0, REPO_DIR)
+    from benchmarks.dpx_generator import generate_sequence
+    from dpx_assessment import DpxAssessment
+    from dpx_rawcook import DpxRawcook
+    from dpx_post_rawcook import DpxPostRawcook
+
+    gap_check_folder = os.path.join(root, WORKING_FOLDERS['DPX_GAP_CHECK'])
+    start = time.perf_counter()
+    sequences = []
+    for index in range(args.sequences):
+        gaps = 1 if index < args.gap_sequences else 0
+        anomalous = args.gap_sequences <= index < args.gap_sequences + args.anomaly_sequences
+        sequences.append(generate_sequence(gap_check_folder, f"bench{index:04d}", args.frames, args.width,
+                                           args.height, args.bit_depth, gaps=gaps,
+                                           anomaly='user_data' if anomalous else None))
+    generation_seconds = time.perf_counter() - start
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': git_revision(),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'config': {key: value for key, value in vars(args).items() if key not in ('workdir', 'keep', 'output')},
+        'dataset': {
+            'sequences': len(sequences),
+            'frames': sum(sequence['frames'] for sequence in sequences),
+            'bytes': sum(sequence['bytes'] for sequence in sequences),
+            'generation_seconds': generation_seconds,
+        },
+        'workflows': {},
+    }
+    for name, factory in (('assessment', DpxAssessment), ('rawcook', DpxRawcook),
+                          ('post_rawcook', DpxPostRawcook)):
+        if args.cold:
+            drop_page_cache(root)
+        results['workflows'][name] = run_workflow(name, factory, STAGES[name])
+    # Aggregate rate of the cook stage over the sequences that pass the gap check
+    cooked_frames = sum(sequence['frames'] for sequence in sequences[args.gap_sequences:])
+    results['workflows']['rawcook']['frames_per_second'] = cooked_frames / results['workflows']['rawcook']['seconds']
+    results['total_seconds'] = sum(workflow['seconds'] for workflow in results['workflows'].values())
+    results['dataset']['mib_per_second'] = results['dataset']['bytes'] / 2 ** 20 / results['total_seconds']
+    results['folders'] = folder_counts(root)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(report)
+    else:
+        print(report)
+
+    if args.keep:
+        print(f"Working folder kept in {root}", file=sys.stderr)
+    elif not args.workdir:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
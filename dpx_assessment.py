@@ -1,16 +1,36 @@
 # TODO: Add logging
 
+import concurrent.futures
 import os
-import subprocess
+import threading
 
 from scripts.config import SCRIPT_LOGS_DIR, DPX_GAP_CHECK_PATH, DPX_GAP_CHECK_FAILS, \
     DPX_POLICY_CHECK_PATH, DPX_POLICY_PATH, DPX_TO_COOK_PATH, DPX_TO_COOK_V2_PATH, DPX_POLICY_CHECK_FAILS, RAWCOOK_LICENSE
-from utils.util_functions import create_file, log, find_dpx_folder_from_sequence, find_missing, \
-    check_mediaconch_policy, move_file, find_folder_name_from_sequence
+from utils.util_functions import create_file, log, find_dpx_folder_from_sequence, \
+    check_mediaconch_policy, find_folder_name_from_sequence
+from utils.dpx_header import DPX_HEADER_SIZE, check_dpx_sequence
+from utils.metrics import open_metrics
+from utils.mediaconch_policy import compile_policy
+from utils.process_runner import run_command
+from utils.result_cache import open_result_cache, file_digest, GAPS, REVERSIBILITY, DPX_POLICY
+from utils.reversibility_probe import V1, V2, probe_reversibility
+from utils.sequence_index import get_index, default_cache_dir
+from utils.transfer import transfer, is_transfer_temp
+from utils.state_journal import open_journal, directory_signature, scan_sequence, GAP_PASSED, GAP_FAILED, \
+    V2_CHECKED, POLICY_PASSED, POLICY_FAILED, TO_COOK, TO_COOK_V2
+
+REVERSIBILITY_FILE_TOO_BIG = 'Error: the reversibility file is becoming big'
+
+# Maximum number of sequences in each stage at the same time, so that the NAS is not saturated
+DEFAULT_STAGE_LIMITS = {
+    'gap_check': 4,
+    'check_v2': 2,
+    'check_dpx_policy': 4,
+}
 
 
 class DpxAssessment:
-    def __init__(self, check_gaps=True, check_policy=True):
+    def __init__(self, check_gaps=True, check_policy=True, max_workers=None, stage_limits=None):
         # Log files
         self.logfile = os.path.join(SCRIPT_LOGS_DIR, 'dpx_assessment.log')
 
@@ -28,6 +48,30 @@ class DpxAssessment:
         # Set of folders containing dpx files
         self.dpx_to_assess = set()
 
+        # Worker pool and per-stage concurrency limits of the assessment scheduler
+        self.max_workers = max_workers or int(os.environ.get('ASSESSMENT_WORKERS', os.cpu_count() or 4))
+        self.stage_limits = dict(DEFAULT_STAGE_LIMITS)
+        self.stage_limits.update(stage_limits or {})
+        self.stage_semaphores = {stage: threading.BoundedSemaphore(limit)
+                                 for stage, limit in self.stage_limits.items()}
+        # Guards dpx_to_assess, which is shared by all the workers
+        self.lock = threading.Lock()
+        self.dpx_policy = None
+        # Policy results are cached per version of the policy file
+        self.dpx_policy_kind = None
+
+        # Decide between rawcooked output version 1 and 2 from a sample of frames when it is unambiguous
+        self.fast_v2_probe = os.environ.get('FAST_V2_PROBE', '1') == '1'
+        self.v2_sample_size = int(os.environ.get('V2_PROBE_SAMPLE_SIZE', 32))
+
+        # Journal of the stages each sequence went through, so reruns can skip checks already passed
+        self.journal = open_journal(SCRIPT_LOGS_DIR)
+        # Frame index of each sequence, built once and reused by every stage
+        self.index_cache_dir = default_cache_dir(SCRIPT_LOGS_DIR)
+        self.metrics = open_metrics('dpx_assessment', SCRIPT_LOGS_DIR)
+        # Verdicts of earlier runs on sequences with the same content, checked after the journal
+        self.result_cache = open_result_cache(SCRIPT_LOGS_DIR)
+
     def process(self) -> None:
         """Initiates the workflow
 
@@ -53,180 +97,282 @@ class DpxAssessment:
 
         log(self.logfile, "\n============= DPX Assessment workflow START =============\n")
 
-    def find_dpx_to_assess(self):
-        """Finds the main folders containing dpx files in the assessment folder"""
+    def find_dpx_to_assess(self, folder=None) -> set:
+        """Finds the main folders containing dpx files in the assessment folder
+
+        Returns the sequences found, which are also added to dpx_to_assess
+        """
 
+        folder = folder or self.assessment_folder
+        found = set()
         try:
-            for seq in os.listdir(self.assessment_folder):
-                seq_path = os.path.join(self.assessment_folder, seq)
-                if not os.path.isdir(seq_path):
+            for seq in os.listdir(folder):
+                seq_path = os.path.join(folder, seq)
+                if is_transfer_temp(seq) or not os.path.isdir(seq_path):
                     continue
                 dpx_folder = find_dpx_folder_from_sequence(seq_path)
                 if dpx_folder:
-                    self.dpx_to_assess.add(dpx_folder)
-            for s in self.dpx_to_assess:  # TODO: Change this for loop to logging
+                    found.add(dpx_folder)
+            with self.lock:
+                self.dpx_to_assess |= found
+            for s in found:  # TODO: Change this for loop to logging
                 print(s)
+            return found
 
         except Exception as e:
             print(f"Error: {e}")
             raise RuntimeError("Failed to find DPX folders") from e
 
-    def gap_check(self):
-        """Function to check for gaps in the dpx sequences"""
-
-        try:
-            # TODO: Add logging
-            for seq in self.dpx_to_assess.copy():
-                has_gaps = find_missing(seq)
-                folder_name = find_folder_name_from_sequence(seq, self.assessment_folder)
-                if has_gaps:
-                    print("GAPS PRESENT IN FOLDERS:")
-                    # Renaming the folder before moving to failed folder
-                    source_path = os.path.join(self.assessment_folder, folder_name)
-                    dest_path = os.path.join(DPX_GAP_CHECK_FAILS, folder_name)
-                    move_file(source_path, dest_path)
-
-                else:
-                    # Moving to policy check
-                    source_path = os.path.join(self.assessment_folder, folder_name)
-                    dest_path = os.path.join(DPX_POLICY_CHECK_PATH, folder_name)
-                    move_file(source_path, dest_path)
-                    self.dpx_to_assess.add(seq.replace(DPX_GAP_CHECK_PATH, DPX_POLICY_CHECK_PATH))
-
-                self.dpx_to_assess.remove(seq)
-
-            # Setting the new assessment folder
-            self.assessment_folder = DPX_POLICY_CHECK_PATH
-
-        except Exception as e:
-            print(f"Error: {e}")
-            raise RuntimeError("Gap checking failed") from e
+    def record_stage(self, seq: str, assessment_folder: str, stage: str, detail: str = None) -> None:
+        """Records a stage transition of a sequence in the journal
 
-    def check_v2(self):
-        """Executes Rawcooked to check if the sequence generates a large reversibility file and moves it out of the
-        policy folder """
+        The file count and byte total are only computed again when the folder changed since the last record.
+        """
+        folder_name = find_folder_name_from_sequence(seq, assessment_folder)
+        folder_path = os.path.join(assessment_folder, folder_name)
+        signature = directory_signature(folder_path)
+        record = self.journal.get(folder_name)
+        if record and record['dir_signature'] == signature and record['file_count'] is not None:
+            file_count, byte_total = record['file_count'], record['byte_total']
+        else:
+            file_count, byte_total = scan_sequence(folder_path)
+        self.journal.record(folder_name, stage, detail, path=folder_path, dir_signature=signature,
+                            file_count=file_count, byte_total=byte_total)
+
+    def already_passed(self, seq: str, assessment_folder: str, stage: str) -> bool:
+        """Returns True if the journal shows the unchanged sequence already passed stage in an earlier run"""
+        folder_name = find_folder_name_from_sequence(seq, assessment_folder)
+        if self.journal.passed(folder_name, stage, os.path.join(assessment_folder, folder_name)):
+            log(self.logfile, f"Skipping {stage} for {seq}, already passed and unchanged since")
+            return True
+        return False
+
+    def load_dpx_policy(self) -> None:
+        self.dpx_policy = compile_policy(DPX_POLICY_PATH)
+        self.dpx_policy_kind = f"{DPX_POLICY}:{file_digest(DPX_POLICY_PATH)}"
+
+    def cached_result(self, seq: str, kind: str, stage: str):
+        """Returns (fingerprint, result of an earlier check of a sequence with the same content or None)"""
+        fingerprint, cached = self.result_cache.lookup(seq, kind, self.index_cache_dir)
+        if cached is not None:
+            log(self.logfile, f"Using the cached {stage} result of {seq}, same content as an earlier sequence")
+            self.metrics.event('result_cache_hit', stage=stage, sequence=os.path.basename(seq))
+        return fingerprint, cached
+
+    def move_sequence(self, seq: str, assessment_folder: str, dest_folder: str, stage: str = None,
+                      detail: str = None) -> str:
+        """Moves the top level folder of a sequence from assessment_folder to dest_folder
+
+        Every sequence is owned by a single worker, so the move itself needs no locking. Only the update of the
+        shared dpx_to_assess set is done under the lock. The new stage is recorded in the journal once the move is
+        done. Returns the path of the sequence in dest_folder.
+        """
+        folder_name = find_folder_name_from_sequence(seq, assessment_folder)
+        source_path = os.path.join(assessment_folder, folder_name)
+        dest_path = os.path.join(dest_folder, folder_name)
+        transfer(source_path, dest_path, self.logfile, metrics=self.metrics)
+        moved_seq = os.path.join(dest_folder, os.path.relpath(seq, assessment_folder))
+        with self.lock:
+            self.dpx_to_assess.discard(seq)
+            if dest_folder == DPX_POLICY_CHECK_PATH:
+                self.dpx_to_assess.add(moved_seq)
+        if stage:
+            self.record_stage(moved_seq, dest_folder, stage, detail)
+        return moved_seq
+
+    def gap_check_sequence(self, seq: str, assessment_folder: str):
+        """Checks one sequence for gaps
+
+        Moves it to the gap check fails folder and returns None if gaps are found, else moves it to the policy
+        check folder and returns its new path
+        """
+        if self.already_passed(seq, assessment_folder, GAP_PASSED):
+            return self.move_sequence(seq, assessment_folder, DPX_POLICY_CHECK_PATH)
+
+        # The fingerprint reads the sequence too, so it is taken within the stage limit
+        with self.stage_semaphores['gap_check']:
+            fingerprint, issues = self.cached_result(seq, GAPS, 'gap check')
+            if issues is None:
+                with self.metrics.stage('gap_check', seq) as stage:
+                    index = get_index(seq, self.index_cache_dir)
+                    issues = index.find_issues()
+                    stage.add(frames=index.frame_count)
+                self.result_cache.put(fingerprint, GAPS, issues,
+                                      find_folder_name_from_sequence(seq, assessment_folder))
+        if issues:
+            details = '; '.join(f"{kind}: {value if not isinstance(value, list) else value[:10]}"
+                                for kind, value in issues.items())
+            log(self.logfile, f"FAIL: GAPS PRESENT IN {seq} ({details}). Moving to gap check failed folder")
+            self.move_sequence(seq, assessment_folder, DPX_GAP_CHECK_FAILS, GAP_FAILED)
+            return None
+        return self.move_sequence(seq, assessment_folder, DPX_POLICY_CHECK_PATH, GAP_PASSED)
+
+    def check_v2_sequence(self, seq: str, assessment_folder: str) -> bool:
+        """Decides whether one sequence needs rawcooked output version 2
+
+        With fast_v2_probe a sample of frames is probed first and the full rawcooked run is only done when the
+        sample is ambiguous. Moves the sequence to the v2 cooking folder and returns True if the reversibility file
+        becomes too big
+        """
+        if self.already_passed(seq, assessment_folder, V2_CHECKED):
+            return False
+
+        folder_name = find_folder_name_from_sequence(seq, assessment_folder)
+        check_v2_folder = os.path.join(assessment_folder, folder_name)
+        log(self.logfile,
+            f"Checking for large reversibility file issue in {seq}")
+
+        with self.stage_semaphores['check_v2']:
+            fingerprint, verdict = self.cached_result(seq, REVERSIBILITY, 'reversibility check')
+            if verdict is None:
+                verdict = self.probe_sequence(seq, check_v2_folder)
+                self.result_cache.put(fingerprint, REVERSIBILITY, verdict, folder_name)
+
+        # Checks for sequences with large reversibility file
+        if verdict == V2:
+            log(self.logfile,
+                f"FAIL: {seq} REVERSIBILITY FILE IS TOO BIG. Moving to v2 processing folder")
+            self.move_sequence(seq, assessment_folder, DPX_TO_COOK_V2_PATH, TO_COOK_V2)
+            return True
+        self.record_stage(seq, assessment_folder, V2_CHECKED, V1)
+        return False
+
+    def probe_sequence(self, seq: str, check_v2_folder: str) -> str:
+        """Returns V2 if rawcooked reports a large reversibility file for the sequence, else V1
+
+        Called within the check_v2 stage limit.
+        """
+        with self.metrics.stage('check_v2', seq) as stage:
+            verdict = None
+            dpx_files = get_index(seq, self.index_cache_dir).paths()
+            stage.add(frames=len(dpx_files))
+            if self.fast_v2_probe:
+                verdict, reasons = probe_reversibility(dpx_files, RAWCOOK_LICENSE, REVERSIBILITY_FILE_TOO_BIG,
+                                                       self.v2_sample_size)
+                if verdict is None:
+                    log(self.logfile, f"Sampled probe of {seq} is ambiguous ({'; '.join(reasons[:5])}), "
+                                      f"checking the whole sequence")
+
+            if verdict is None:
+                # The probe is killed as soon as rawcooked reports the large reversibility file
+                command = ['rawcooked', '--license', RAWCOOK_LICENSE, '--check', '--no-encode', check_v2_folder]
+                result = run_command(command, line_callback=lambda stream, line: print(line),  # TODO: Change to logging
+                                     abort_on=[REVERSIBILITY_FILE_TOO_BIG])
+                stage.add_process(result)
+                verdict = V2 if result.found(REVERSIBILITY_FILE_TOO_BIG) else V1
+        return verdict
 
-        try:
-            if not self.dpx_to_assess:
-                print("Nothing to assess. Script Exiting")
-                raise FileNotFoundError("No sequences to assess")
+    def check_policy_sequence(self, seq: str, assessment_folder: str) -> bool:
+        """Checks every dpx file of one sequence against the dpx policy
 
-            for seq in self.dpx_to_assess.copy():
-                folder_name = find_folder_name_from_sequence(seq, self.assessment_folder)
-                check_v2_folder = os.path.join(self.assessment_folder, folder_name)
-                command = ['rawcooked', '--license', RAWCOOK_LICENSE, '--check', '--no-encode', check_v2_folder]
-                log(self.logfile,
-                    f"Checking for large reversibility file issue in {seq}")
-
-                subprocess_logs = []
-                with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as p:
-                    for line in p.stderr:  # TODO: Fix print statements and change to logging
-                        subprocess_logs.append(line)
-                        print(line)
-                    for line in p.stdout:
-                        subprocess_logs.append(line)
-                        print(line)
-
-                std_logs = ''.join(subprocess_logs)
-
-                # Checks for sequences with large reversibility file
-                if 'Error: the reversibility file is becoming big' in std_logs:
-                    log(self.logfile,
-                        f"FAIL: {seq} REVERSIBILITY FILE IS TOO BIG. Moving to v2 processing folder")
-                    folder_name = find_folder_name_from_sequence(seq, self.assessment_folder)
-                    source_path = os.path.join(self.assessment_folder, folder_name)
-                    dest_path = os.path.join(DPX_TO_COOK_V2_PATH, folder_name)
-                    move_file(source_path, dest_path)
-                    self.dpx_to_assess.remove(seq)
-        except FileNotFoundError:
-            print(f"No sequences to process in: {self.assessment_folder}")
-        except subprocess.CalledProcessError as cpe:
-            print(f"CalledProcessError: {cpe}")
-            raise RuntimeError("Rawcooked execution failed") from cpe
-        except Exception as e:
-            print(f"Error: {e}")
-            raise RuntimeError("An unexpected error occurred during Rawcooked execution") from e
+        Moves it to the dpx policy fails folder and returns True if it does not conform
+        """
+        if self.already_passed(seq, assessment_folder, POLICY_PASSED):
+            return False
 
-    def move_v1(self) -> None:
-        """Moves remaining sequences in the assessment folder to dpx_to_cook"""
+        with self.stage_semaphores['check_dpx_policy']:
+            fingerprint, cached = self.cached_result(seq, self.dpx_policy_kind, 'policy check')
+            if cached is not None:
+                failures = [(os.path.join(seq, name), reasons) for name, reasons in cached]
+            else:
+                dpx_files = get_index(seq, self.index_cache_dir).paths()
+
+                log(self.logfile, f"Checking DPX policy for {len(dpx_files)} files in: {seq}")
+                with self.metrics.stage('check_dpx_policy', seq) as stage:
+                    stage.add(frames=len(dpx_files), bytes_read=len(dpx_files) * DPX_HEADER_SIZE)
+                    failures, unresolved = check_dpx_sequence(self.dpx_policy, dpx_files)
+                    for dpx_file in unresolved.values():
+                        if not check_mediaconch_policy(DPX_POLICY_PATH, dpx_file):
+                            failures.append((dpx_file, ["mediaconch policy check failed"]))
+                # Only the first failures are kept, the verdict and the log message only need those
+                self.result_cache.put(fingerprint, self.dpx_policy_kind,
+                                      [(os.path.basename(dpx_file), reasons) for dpx_file, reasons in failures[:10]],
+                                      find_folder_name_from_sequence(seq, assessment_folder))
+
+        if failures:
+            dpx_file, reasons = failures[0]
+            log(self.logfile,
+                f"FAIL: {len(failures)} files in {seq} DO NOT CONFORM TO MEDIACONCH POLICY, first is "
+                f"{os.path.basename(dpx_file)} ({'; '.join(reasons)}). Moving to dpx policy failed folder")
+            self.move_sequence(seq, assessment_folder, DPX_POLICY_CHECK_FAILS, POLICY_FAILED,
+                               '; '.join(reasons))
+            return True
+        self.record_stage(seq, assessment_folder, POLICY_PASSED)
+        return False
+
+    def assess_sequence(self, seq: str, assessment_folder: str) -> None:
+        """Takes a single sequence through every enabled stage, independently of the other sequences
+
+        gap check -> reversibility probe -> policy check -> dpx_to_cook
+        """
+        if assessment_folder == DPX_GAP_CHECK_PATH:
+            seq = self.gap_check_sequence(seq, assessment_folder)
+            if seq is None:
+                return
+            assessment_folder = DPX_POLICY_CHECK_PATH
 
-        try:
-            if not self.dpx_to_assess:
-                print("Nothing to move. Script Exiting")
-                raise FileNotFoundError("No sequences left to move")
+        if self.check_policy:
+            if self.check_v2_sequence(seq, assessment_folder):
+                return
+            if self.check_policy_sequence(seq, assessment_folder):
+                return
 
-        except FileNotFoundError:
-            print(f"No sequences to process in: {self.assessment_folder}")
+        self.move_sequence(seq, assessment_folder, DPX_TO_COOK_PATH, TO_COOK)
 
-        try:
-            for seq in self.dpx_to_assess.copy():
-                folder_name = find_folder_name_from_sequence(seq, self.assessment_folder)
-                source_path = os.path.join(self.assessment_folder, folder_name)
-                dest_path = os.path.join(DPX_TO_COOK_PATH, folder_name)
-                move_file(source_path, dest_path)
-        except Exception as e:
-            print(f"Error: {e}")
+    def run_pipeline(self) -> None:
+        """Assesses all sequences concurrently on the worker pool
 
-    def check_dpx_policy(self) -> None:
-        """Checks if the dpx files passed as parameters match mediaconch policies"""
+        Different sequences can be in different stages at the same time, while stage_limits bounds how many
+        sequences are in each stage.
+        """
+        if self.check_policy:
+            self.load_dpx_policy()
 
-        try:
-            if not self.dpx_to_assess:
-                print("Nothing to assess. Script Exiting")
-                raise FileNotFoundError("No sequences to assess")
-
-            for seq in self.dpx_to_assess.copy():
-                # Get one dpx file from each sequence to check against mediaconch policy
-                dpx_file = None
-                with os.scandir(seq) as entries:
-                    for entry in entries:
-                        if entry.is_file() and entry.name.endswith('.dpx'):
-                            dpx_file = entry.name
-                            break
-
-                folder_name = find_folder_name_from_sequence(seq, self.assessment_folder)
-                log(self.logfile, f"Metadata file creation has started for: {dpx_file}")
-                if not check_mediaconch_policy(DPX_POLICY_PATH, os.path.join(seq, dpx_file)):
-                    log(self.logfile,
-                        f"FAIL: {dpx_file} DOES NOT CONFORM TO MEDIACONCH POLICY. Moving to dpx policy "
-                        f"failed folder")
-                    source_path = os.path.join(self.assessment_folder, folder_name)
-                    dest_path = os.path.join(DPX_POLICY_CHECK_FAILS, folder_name)
-                    move_file(source_path, dest_path)
-                    self.dpx_to_assess.remove(seq)
-
-        except FileNotFoundError:
-            print(f"No sequences to assess in {self.assessment_folder}")
-        except Exception as e:
-            print(f"Error: {e}")
-            raise RuntimeError("An unexpected error occurred during policy checking") from e
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            folders = [DPX_GAP_CHECK_PATH] if self.check_gaps else []
+            if self.check_policy:
+                folders.append(DPX_POLICY_CHECK_PATH)
+            # Every folder is listed before any sequence is submitted, as the gap check workers move sequences into
+            # the policy check folder and those must not be picked up a second time
+            found = [(seq, folder) for folder in folders for seq in self.find_dpx_to_assess(folder)]
+            for seq, folder in found:
+                futures[executor.submit(self.assess_sequence, seq, folder)] = seq
+
+            pending = len(futures)
+            self.metrics.gauge('queue_depth', pending, queue='assessment')
+            for future in concurrent.futures.as_completed(futures):
+                pending -= 1
+                self.metrics.gauge('queue_depth', pending, queue='assessment')
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error: {e}")
+                    log(self.logfile, f"ERROR: Assessment failed for {futures[future]}: {e}")
 
     def execute(self) -> None:
-        """Executes the workflow step by step as:
+        """Executes the workflow as:
 
         1. process(): Checks if .dpx files are present in the input folder and creates temporary files
-        2. find_dpx_to_assess(): Finds the lowest folder containing dpx sequences at any depth and updates the class variable dpx_to_assess
-        3. gap_check(): Checks if dpx sequences have incoherent gaps and moves them to dpx_to_review/gap_check_fails
-        4. check_v2(): It takes the dict and runs rawcooked to check if there is are large reversibility files. Removes
-        the sequence from the dict and moves it to the v2 processing folder
-        5. check_policy(): Check a randomly chosen .dpx file from each sequence
-        against mediaconch policies. If it fails moves it to review/dpx_policy_check_fails
-        6. Moves the remaining sequences to dpx_to_cook folder else moves to
+        2. run_pipeline(): Finds the lowest folder containing dpx sequences at any depth and submits each sequence to
+        the worker pool, where it goes through assess_sequence():
+            - gap_check_sequence(): Checks if the dpx sequence has incoherent gaps and moves it to
+            dpx_to_review/gap_check_fails
+            - check_v2_sequence(): Runs rawcooked to check if there is a large reversibility file and moves it to the
+            v2 processing folder
+            - check_policy_sequence(): Checks the headers of every .dpx file against the dpx policy. If it fails
+            moves it to review/dpx_policy_check_fails
+            - Moves the sequence to the dpx_to_cook folder
         """
 
         try:
             self.process()
-            if self.check_gaps:
-                self.find_dpx_to_assess()
-                self.gap_check()
-            if self.check_policy:
-                self.find_dpx_to_assess()
-                self.check_v2()
-                self.check_dpx_policy()
-            self.move_v1()
+            self.run_pipeline()
         except Exception as e:
             print(f"Error: {e}")
             raise RuntimeError("Workflow execution failed for assessment")
+        finally:
+            self.metrics.flush()
 
 
 if __name__ == '__main__':
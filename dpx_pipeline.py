@@ -0,0 +1,154 @@
+import concurrent.futures
+import os
+import signal
+import threading
+
+from dpx_assessment import DpxAssessment
+from dpx_post_rawcook import DpxPostRawcook
+from dpx_rawcook import DpxRawcook, COOK_QUEUES
+from utils.folder_watcher import FolderWatcher, SettleTracker
+from utils.transfer import is_transfer_temp
+from utils.util_functions import create_file, log, find_dpx_folder_from_sequence
+
+from scripts.config import SCRIPT_LOGS_DIR, DPX_GAP_CHECK_PATH, DPX_POLICY_CHECK_PATH, MKV_COOKED_PATH
+
+
+class DpxPipeline:
+    """Long-running service that replaces the run.sh batch chain
+
+    Assessment, cooking and post-rawcook run side by side, and each sequence moves on to the next stage as soon as
+    the previous one has finished with it. Folders are watched with inotify, falling back to polling, and a sequence
+    is only picked up once it has stopped changing, so sequences still being copied in are left alone.
+    """
+
+    def __init__(self, settle_seconds=None, poll_interval=None):
+        self.logfile = os.path.join(SCRIPT_LOGS_DIR, "dpx_pipeline.log")
+        self.settle_seconds = settle_seconds if settle_seconds is not None else \
+            float(os.environ.get('PIPELINE_SETTLE_SECONDS', 60))
+        self.poll_interval = poll_interval if poll_interval is not None else \
+            float(os.environ.get('PIPELINE_POLL_SECONDS', 30))
+        self.stop_event = threading.Event()
+        self.post_wakeup = threading.Event()
+        self.settle_tracker = SettleTracker(self.settle_seconds)
+
+        self.assessment = DpxAssessment()
+        self.rawcook = DpxRawcook()
+        self.rawcook.settle_tracker = self.settle_tracker
+        self.rawcook.poll_interval = self.poll_interval
+        self.rawcook.on_result = lambda seq_path, record: self.post_wakeup.set()
+
+    def process(self) -> None:
+        """Creates the log files of the pipeline and of each stage"""
+        try:
+            create_file(self.logfile)
+            self.assessment.process()
+            self.rawcook.process()
+        except Exception as e:
+            print(f"Error: {e}")
+
+        log(self.logfile, "============= DPX pipeline daemon START =============")
+
+    def assessment_loop(self) -> None:
+        """Submits every settled sequence of the preprocessing folders to the assessment worker pool"""
+
+        folders = []
+        if self.assessment.check_gaps:
+            folders.append(DPX_GAP_CHECK_PATH)
+        if self.assessment.check_policy:
+            folders.append(DPX_POLICY_CHECK_PATH)
+            self.assessment.load_dpx_policy()
+        if not folders:
+            return
+
+        watcher = FolderWatcher(folders, self.poll_interval)
+        in_progress = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.assessment.max_workers) as executor:
+            while not self.stop_event.is_set():
+                for future in [f for f in in_progress if f.done()]:
+                    seq_path = in_progress.pop(future)
+                    self.settle_tracker.forget(seq_path)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Error: {e}")
+                        log(self.logfile, f"ERROR: Assessment failed for {seq_path}: {e}")
+
+                # A sequence moves from the gap check folder to the policy check folder while it is assessed
+                busy = set(os.path.basename(seq_path) for seq_path in in_progress.values())
+                for folder in folders:
+                    with os.scandir(folder) as entries:
+                        candidates = [entry.path for entry in entries if entry.is_dir() and entry.name not in busy
+                                      and not is_transfer_temp(entry.name)]
+                    for seq_path in candidates:
+                        if not self.settle_tracker.is_settled(seq_path):
+                            continue
+                        dpx_folder = find_dpx_folder_from_sequence(seq_path)
+                        if not dpx_folder:
+                            continue
+                        log(self.logfile, f"Assessing {seq_path}")
+                        with self.assessment.lock:
+                            self.assessment.dpx_to_assess.add(dpx_folder)
+                        in_progress[executor.submit(self.assessment.assess_sequence, dpx_folder, folder)] = seq_path
+
+                watcher.wait(self.poll_interval)
+        watcher.close()
+
+    def cook_loop(self) -> None:
+        """Runs the rawcooked scheduler until the daemon stops"""
+
+        watcher = FolderWatcher([folder for _, folder, _ in COOK_QUEUES], self.poll_interval)
+        try:
+            self.rawcook.run_rawcooked(stop_event=self.stop_event, watcher=watcher)
+        finally:
+            watcher.close()
+
+    def post_loop(self) -> None:
+        """Runs post-rawcook whenever an encode finishes, and at every poll interval"""
+
+        while not self.stop_event.is_set():
+            self.post_wakeup.wait(self.poll_interval)
+            self.post_wakeup.clear()
+            with os.scandir(MKV_COOKED_PATH) as entries:
+                if not any(entry.name.endswith('.mkv') for entry in entries):
+                    continue
+            try:
+                DpxPostRawcook().execute()
+            except Exception as e:
+                print(f"Error: {e}")
+                log(self.logfile, f"ERROR: Post-rawcook failed: {e}")
+
+    def stop(self, *args) -> None:
+        log(self.logfile, "Stop requested, waiting for running jobs to finish")
+        self.stop_event.set()
+        self.post_wakeup.set()
+
+    def run(self) -> None:
+        """Starts the three stages in their own threads and waits until SIGINT/SIGTERM"""
+
+        self.process()
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        threads = [threading.Thread(target=self.run_stage, args=(name, target), name=name)
+                   for name, target in (('assessment', self.assessment_loop), ('rawcook', self.cook_loop),
+                                        ('post_rawcook', self.post_loop))]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+        log(self.logfile, "============= DPX pipeline daemon END =============")
+
+    def run_stage(self, name, target) -> None:
+        """Runs one stage loop and stops the whole daemon if it crashes"""
+        try:
+            target()
+        except Exception as e:
+            print(f"Error: {e}")
+            log(self.logfile, f"ERROR: {name} stage stopped: {e}")
+            self.stop()
+
+
+if __name__ == '__main__':
+    dpx_pipeline = DpxPipeline()
+    dpx_pipeline.run()
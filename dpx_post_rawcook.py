@@ -2,13 +2,23 @@
 # TODO: Add logging
 # TODO: Add error handling
 
-import mmap
+import concurrent.futures
 import sys
 import os
 from datetime import datetime
 from pathlib import Path
 
-from utils.util_functions import check_mediaconch_policy, log, move_file
+from utils.util_functions import check_mediaconch_policy, log
+from utils.framemd5_verify import CHUNK_FRAMES, verify_files
+from utils.metrics import open_metrics
+from utils.lease import open_leases
+from utils.log_scanner import scan_log, summary_path, write_summary
+from utils.mediaconch_policy import compile_policy
+from utils.mkv_header import check_mkv_header
+from utils.result_cache import open_result_cache
+from utils.segmenter import SEGMENTS_DIR, MANIFEST_SUFFIX, REEL_COOKED, read_manifest, staging_folder, remove_staging
+from utils.transfer import transfer, is_transfer_temp
+from utils.state_journal import open_journal, COOKING, COOKED, COMPLETED, MKV_POLICY_FAILED, POST_FAILED
 
 from scripts.config import SCRIPT_LOGS_DIR, MKV_POLICY_CHECK_FAILS, MKV_COOKED_PATH, MKV_POLICY_PATH, POST_RAWCOOK_FAILS, \
     MKV_COMPLETED_PATH, DPX_TO_COOK_PATH, DPX_TO_COOK_V2_PATH
@@ -27,45 +37,61 @@ class DpxPostRawcook:
         self.txt_path_set = set()
         self.missing_txt_files = set()
         self.missing_mkv_files = set()
-
-    def check_missing(self):
-        """Checks whether both mkv and txt file is present in the rawcooked folder"""
-        try:
-            for mkv_path in self.mkv_path_set:
-                txt_file_path = str(Path(mkv_path).with_suffix(".mkv.txt"))
-                if txt_file_path not in self.txt_path_set:
-                    self.missing_txt_files.add(txt_file_path)
-
-            for txt_path in self.txt_path_set:
-                mkv_file_path = str(Path(txt_path).with_suffix(""))
-                if mkv_file_path not in self.mkv_path_set:
-                    self.missing_mkv_files.add(mkv_file_path)
-
-            for file in self.missing_mkv_files:
-                print(f"MKV file not found: {file}")
-
-            for file in self.missing_txt_files:
-                print(f"TXT file not found:  {file}")
-        except Exception as e:
-            print(f"Error: {e}")
+        # Manifests of the segmented reels in mkv_cooked, {manifest path: manifest}
+        self.manifests = {}
+        # Work items, each an MKV or the segments of a reel with their .mkv.txt, framemd5 and source DPX folder
+        self.items = []
+        self.journal = open_journal(SCRIPT_LOGS_DIR)
+        # With several encode nodes the journal is local to each node, an MKV whose sequence still has a live lease is
+        # left alone instead
+        self.leases = open_leases()
+        # Items are checked and moved independently, this many at a time
+        self.post_workers = int(os.environ.get('POST_WORKERS', 4))
+
+        # Decodes every MKV and compares it frame by frame with the framemd5 rawcooked wrote for its source
+        self.verify_md5 = os.environ.get('FRAMEMD5_VERIFY', '1') == '1'
+        self.md5_workers = int(os.environ.get('FRAMEMD5_WORKERS', 0)) or os.cpu_count() or 1
+        # The decoders are shared out between the items verified at once
+        self.md5_item_workers = max(1, self.md5_workers // max(self.post_workers, 1))
+        self.md5_chunk_frames = int(os.environ.get('FRAMEMD5_CHUNK_FRAMES', CHUNK_FRAMES))
+        # mkv path -> number of frames verified
+        self.verified = {}
+        # The MKV policy is evaluated against the container metadata read in-process, mediaconch is only run for the
+        # rules that need more than that
+        self.mkv_policy_in_process = os.environ.get('MKV_POLICY_IN_PROCESS', '1') == '1'
+        self.mkv_policy = None
+        self.metrics = open_metrics('dpx_post_rawcook', SCRIPT_LOGS_DIR)
+        # MKVs are only reused for identical sequences once they passed every check here
+        self.result_cache = open_result_cache(SCRIPT_LOGS_DIR)
 
     def process(self):
         """Initiates the Post Rawcooked Workflow
         Creates the temporary and log files (if not present)
-        Also checks if the mkv_cooked folder has any files to process
+        Lists the mkv_cooked folder once and builds the work items from it
         """
         try:
             if not os.path.exists(self.logfile):
                 with open(self.logfile, 'w+'):
                     pass
 
+            with os.scandir(MKV_COOKED_PATH) as entries:
+                files = [(entry.name, entry.path) for entry in entries if entry.is_file()]
             # Check mkv_cooked/ folder populated before starting log writes
-            if any(os.scandir(MKV_COOKED_PATH)):
+            if files:
                 log(self.logfile, "===================== Post-RAWcook workflows STARTED =====================")
                 log(self.logfile, "Files present in mkv_cooked folder, checking if ready for processing...")
 
-                self.mkv_path_set = set([f.path for f in os.scandir(MKV_COOKED_PATH) if f.name.endswith(".mkv")])
-                self.txt_path_set = set([f.path for f in os.scandir(MKV_COOKED_PATH) if f.name.endswith(".mkv.txt")])
+                self.mkv_path_set = set(path for name, path in files if name.endswith(".mkv"))
+                self.txt_path_set = set(path for name, path in files if name.endswith(".mkv.txt"))
+                for name, path in files:
+                    if name.endswith(MANIFEST_SUFFIX):
+                        try:
+                            self.manifests[path] = read_manifest(path)
+                        except (OSError, ValueError) as e:
+                            print(f"Error reading segment manifest {path}: {e}")
+                self.check_missing()
+                self.items = self.find_items()
+                self.metrics.gauge('queue_depth', len(self.items), queue='post_rawcook')
 
             else:
                 print("MKV folder empty, script exiting")
@@ -77,155 +103,341 @@ class DpxPostRawcook:
         except Exception as e:
             print(f"Error occurred: {e}")
 
-    def check_mkv_policies(self):
-        """For every .mkv file it checks against the mkv policy using mediaconch
-        Scans through the mkv_cooked folder for .mkv files and runs mediaconch.
-        If a file fails the check, the path of that file and the respective .mkv.txt file get appended into a
-        temporary .txt file named temp_mediaconch_policy_fails.txt
+    def check_missing(self):
+        """Checks whether both mkv and txt file is present in the rawcooked folder"""
+        for mkv_path in self.mkv_path_set:
+            txt_file_path = mkv_path + ".txt"
+            if txt_file_path not in self.txt_path_set:
+                self.missing_txt_files.add(txt_file_path)
+
+        for txt_path in self.txt_path_set:
+            mkv_file_path = str(Path(txt_path).with_suffix(""))
+            if mkv_file_path not in self.mkv_path_set:
+                self.missing_mkv_files.add(mkv_file_path)
+
+        for file in self.missing_mkv_files:
+            print(f"MKV file not found: {file}")
+
+        for file in self.missing_txt_files:
+            print(f"TXT file not found:  {file}")
+
+    def find_source(self, name, record=None):
+        """Returns the DPX folder an MKV was cooked from, if it is still in one of the cook folders"""
+        if record and record['path'] and os.path.isdir(record['path']):
+            return record['path']
+        for folder in (DPX_TO_COOK_PATH, DPX_TO_COOK_V2_PATH):
+            path = os.path.join(folder, name)
+            if os.path.isdir(path):
+                return path
+        return None
+
+    def still_cooking(self, name):
+        """Returns True if an encode node still holds a live lease on a sequence"""
+        if self.leases is None or not self.leases.cooking(name):
+            return False
+        log(self.logfile, f"Skipping {name}, still leased by {self.leases.holder(name)}")
+        return True
+
+    def find_items(self):
+        """Builds a work item for every MKV, or segmented reel, whose rawcooked process has finished
+
+        The journal records an MKV as cooking until rawcooked exits, so a truncated MKV is never picked up and
+        post-rawcook can run while other encodes are in flight. The segments of a reel form a single item once the
+        manifest shows all of them cooked. MKVs without their .mkv.txt are left for a later run.
         """
-        for mkv_path in self.mkv_path_set.copy():
-            try:
-                mkv_file_name = Path(mkv_path).name
-                if not check_mediaconch_policy(MKV_POLICY_PATH, mkv_path):
-                    log(self.logfile, f"FAIL: RAWcooked MKV {mkv_file_name} has failed the mediaconch policy")
-                    txt_file_path = Path(mkv_path).with_suffix(".mkv.txt")
-                    txt_file_name = txt_file_path.name
-                    folder_name = f"{mkv_file_name.split('.')[0]}/"
-                    move_path = os.path.join(MKV_POLICY_CHECK_FAILS, folder_name)
-                    if not os.path.exists(move_path):
-                        os.mkdir(move_path)
-
-                    move_file(mkv_path, os.path.join(move_path, mkv_file_name))
-                    self.mkv_path_set.remove(mkv_path)
-
-                    if str(txt_file_path) in self.txt_path_set:
-                        move_file(txt_file_path, os.path.join(move_path, txt_file_name))
-                        self.txt_path_set.remove(str(txt_file_path))
-                    else:
-                        raise FileNotFoundError(f"Missing txt file: {Path(txt_file_path).name}")
-            except (FileNotFoundError, OSError) as e:
-                print(f"Error: {e}")
-            except Exception as e:
-                print(f"Error occurred: {e}")
-
-    def check_general_errors(self):
-        """Checks the mediaconch passed .mkv files for any other RAWCooked errors
-        Reads each of the .mkv.txt files and checks for messages stored in error_messages
-        If an error is found, the respective .mkv file is moved to dpx_for_review/post_rawcook_fails/mkv_files/
-        and the .mkv.txt files are moved to dpx_for_review/post_rawcook_fails/rawcook_output_logs/
+        items = []
+        segment_mkvs = set()
+        for manifest_path, manifest in self.manifests.items():
+            segment_mkvs.update(segment['mkv'] for segment in manifest['segments'])
+            if manifest['status'] != REEL_COOKED:
+                log(self.logfile, f"Skipping the segments of {manifest['name']}, the reel is {manifest['status']}")
+                continue
+            missing = [segment['name'] for segment in manifest['segments']
+                       if segment['mkv'] not in self.mkv_path_set or segment['mkv'] + ".txt" not in self.txt_path_set]
+            if missing:
+                log(self.logfile, f"Skipping {manifest['name']}, segments {', '.join(missing)} are missing")
+                continue
+            if self.still_cooking(manifest['name']):
+                continue
+            pairs = [{'name': segment['name'], 'mkv': segment['mkv'], 'txt': segment['mkv'] + ".txt",
+                      'framemd5': segment['framemd5']} for segment in manifest['segments']]
+            items.append({'name': manifest['name'], 'pairs': pairs, 'manifest': manifest_path,
+                          'source': self.find_source(manifest['name'], self.journal.get(manifest['name']))})
+
+        for mkv_path in sorted(self.mkv_path_set - segment_mkvs):
+            name = Path(mkv_path).stem
+            record = self.journal.get(name)
+            if record and record['stage'] == COOKING:
+                log(self.logfile, f"Skipping {Path(mkv_path).name}, rawcooked has not finished cooking it")
+                continue
+            if self.still_cooking(name):
+                continue
+            if record and record['stage'] == COOKED and record['output_bytes'] is not None \
+                    and os.path.getsize(mkv_path) != record['output_bytes']:
+                log(self.logfile, f"Skipping {Path(mkv_path).name}, its size differs from the one rawcooked recorded")
+                continue
+            if mkv_path + ".txt" not in self.txt_path_set:
+                continue
+            source = self.find_source(name, record)
+            framemd5_path = str(Path(source).with_suffix(".framemd5")) if source else None
+            items.append({'name': name, 'pairs': [{'name': name, 'mkv': mkv_path, 'txt': mkv_path + ".txt",
+                                                   'framemd5': framemd5_path}],
+                          'manifest': None, 'source': source})
+        return items
+
+    def check_mkv_policy(self, mkv_path):
+        """Checks one .mkv file against the mkv policy, returns (passed, reasons)
+
+        The compiled policy is evaluated against the EBML header, segment info, tracks and attachment names, and
+        mediaconch is only run when the verdict depends on rules the header reader cannot check.
         """
-        error_messages = [
-            b"Reversibility was checked, issues detected, see below.",
-            b"Error:", b"Conversion failed!",
-            b"Please contact info@mediaarea.net if you want support of such content."
-        ]
+        with self.metrics.stage('check_mkv_policy', mkv_path) as stage:
+            verdict, reasons = None, []
+            if self.mkv_policy is not None:
+                verdict, reasons, bytes_read = check_mkv_header(self.mkv_policy, mkv_path)
+                stage.add(bytes_read=bytes_read)
+            if verdict is None:
+                stage.add(mediaconch_calls=1)
+                verdict = check_mediaconch_policy(MKV_POLICY_PATH, mkv_path)
+                reasons = [] if verdict else ["mediaconch policy check failed"]
+        return verdict, reasons
+
+    def check_log(self, txt_file_path):
+        """Scans an .mkv.txt file once for all the messages in log_scanner.ERROR_MESSAGES
+
+        Writes what was found next to it as <name>.mkv.scan.json and returns the summary.
+        """
+        with self.metrics.stage('scan_log', txt_file_path) as stage:
+            summary = scan_log(txt_file_path)
+            stage.add(files=1, bytes_read=summary['bytes'])
+        try:
+            write_summary(summary, summary_path(txt_file_path))
+        except OSError as e:
+            print(f"Error writing scan summary: {e}")
+        return summary
 
-        error_file_path_list = []
+    def verify_framemd5(self, item):
+        """Checks that the MKVs of an item decode back to the exact frames of their source DPX sequence
 
-        for txt_file_path in self.txt_path_set:
-            try:
-                with open(txt_file_path, 'rb', 0) as file:
-                    s = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
-                    for msg in error_messages:
-                        if s.find(msg) != -1:
-                            error_file_path_list.append(txt_file_path)
-                            break
-            except (FileNotFoundError, OSError) as e:
-                print(f"Error reading file: {e}")
-
-        for txt_file_path in error_file_path_list:
-            try:
-                mkv_file_path = Path(txt_file_path).with_suffix('')
-                txt_file_name = Path(txt_file_path).name
-                mkv_file_name = mkv_file_path.name
-
-                folder_name = f"{txt_file_name.split('.')[0]}/"
-                move_path = os.path.join(POST_RAWCOOK_FAILS, folder_name)
-                if not os.path.exists(move_path):
-                    os.mkdir(move_path)
-
-                log(self.logfile, f"UNKNOWN ENCODING ERROR: {mkv_file_name} encountered error")
-                log(self.logfile, f"Moving {mkv_file_name} and {txt_file_name} to post_rawcook_fails for manual review")
-
-                move_file(txt_file_path, os.path.join(move_path, txt_file_name))
-                self.txt_path_set.remove(txt_file_path)
-
-                if str(mkv_file_path) in self.mkv_path_set:
-                    move_file(mkv_file_path, os.path.join(move_path, mkv_file_name))
-                    self.mkv_path_set.remove(mkv_file_path)
-                else:
-                    raise FileNotFoundError(f"Missing mkv file:{mkv_file_name}")
-            except (FileNotFoundError, OSError) as e:
-                print(f"Error: {e}")
-            except Exception as e:
-                print(f"Error occurred: {e}")
+        The per-frame MD5s of the decoded MKV are compared with the .framemd5 file rawcooked wrote next to the
+        sequence in dpx_to_cook(_v2), or next to the segment folder. MKVs with no framemd5 file are left unverified.
+        Returns (pair, errors) for the first mismatching MKV, or None.
+        """
+        if not self.verify_md5:
+            return None
 
-    def move_mkv_completed(self):
-        """Function to move the completed dpx_sequences to completed folder"""
-        for mkv_path in self.mkv_path_set:
+        pairs = {}
+        for pair in item['pairs']:
+            if pair['framemd5'] and os.path.exists(pair['framemd5']):
+                pairs[pair['mkv']] = pair['framemd5']
+            else:
+                log(self.logfile, f"No framemd5 found for {Path(pair['mkv']).name}, skipping frame verification")
+        if not pairs:
+            return None
+
+        log(self.logfile, f"Verifying {len(pairs)} MKV files of {item['name']} against their framemd5 "
+                          f"({self.md5_item_workers} workers, {self.md5_chunk_frames} frames per chunk)")
+        with self.metrics.stage('verify_framemd5', item['name']) as stage:
+            results = verify_files(pairs, self.md5_item_workers, self.md5_chunk_frames)
+            stage.add(files=len(results), frames=sum(checked for checked, _ in results.values()),
+                      bytes_read=sum(os.path.getsize(mkv_path) for mkv_path in results if os.path.exists(mkv_path)))
+        for pair in item['pairs']:
+            if pair['mkv'] not in results:
+                continue
+            checked, errors = results[pair['mkv']]
+            mkv_file_name = Path(pair['mkv']).name
+            if errors:
+                log(self.logfile, f"FAIL: {mkv_file_name} does not match its source framemd5: {'; '.join(errors)}")
+                return pair, errors
+            log(self.logfile, f"Framemd5 verified: {mkv_file_name}, {checked} frames bit-exact")
+            self.verified[pair['mkv']] = checked
+        return None
+
+    def process_item(self, item):
+        """Takes one MKV, or the segments of a reel, through the mkv policy, the log scan and the framemd5
+        verification, then moves it with its source DPX folder to the completed folder
+
+        The first failed check moves the item to the fails folder of that check instead, and the remaining checks
+        are not run. Returns the journal stage the item ended in.
+        """
+        segmented = item['manifest'] is not None
+        for pair in item['pairs']:
+            passed, reasons = self.check_mkv_policy(pair['mkv'])
+            if not passed:
+                log(self.logfile, f"FAIL: RAWcooked MKV {Path(pair['mkv']).name} has failed the mediaconch policy "
+                                  f"({'; '.join(reasons)})")
+                detail = '; '.join(reasons)
+                self.fail_item(item, MKV_POLICY_CHECK_FAILS, MKV_POLICY_FAILED,
+                               f"{Path(pair['mkv']).name}: {detail}" if segmented else detail)
+                return MKV_POLICY_FAILED
+
+        for pair in item['pairs']:
+            summary = self.check_log(pair['txt'])
+            if summary['failed']:
+                first = summary['errors'][0]
+                frame = f", frame {first['frame']}" if first['frame'] is not None else ''
+                log(self.logfile, f"UNKNOWN ENCODING ERROR: {Path(pair['mkv']).name} encountered error "
+                                  f"'{first['message']}' at byte {first['offset']}{frame}: {first['line']}")
+                detail = f"{first['message']} at byte {first['offset']}{frame}"
+                self.fail_item(item, POST_RAWCOOK_FAILS, POST_FAILED,
+                               f"{Path(pair['mkv']).name}: {detail}" if segmented else detail)
+                return POST_FAILED
+
+        mismatch = self.verify_framemd5(item)
+        if mismatch:
+            pair, errors = mismatch
+            detail = f"framemd5 mismatch: {errors[0]}"
+            self.fail_item(item, POST_RAWCOOK_FAILS, POST_FAILED,
+                           f"{Path(pair['mkv']).name}: {detail}" if segmented else detail)
+            return POST_FAILED
+
+        self.complete_item(item)
+        return COMPLETED
+
+    def move_pair(self, pair, move_path):
+        """Moves an .mkv file with its .mkv.txt file and scan summary, returns the new path of the .mkv"""
+        moved_mkv_path = os.path.join(move_path, Path(pair['mkv']).name)
+        if os.path.exists(pair['mkv']):
+            transfer(pair['mkv'], moved_mkv_path, self.logfile, metrics=self.metrics)
+        else:
+            print(f"Error: Missing mkv file: {Path(pair['mkv']).name}")
+        if os.path.exists(pair['txt']):
+            transfer(pair['txt'], os.path.join(move_path, Path(pair['txt']).name), self.logfile, metrics=self.metrics)
+            self.move_summary(pair['txt'], move_path)
+        else:
+            print(f"Error: Missing txt file: {Path(pair['txt']).name}")
+        return moved_mkv_path
+
+    def move_summary(self, txt_file_path, move_path):
+        """Moves the scan summary of an .mkv.txt file, if it has one, along with it"""
+        scan_summary_path = summary_path(txt_file_path)
+        if os.path.exists(scan_summary_path):
+            transfer(scan_summary_path, os.path.join(move_path, Path(scan_summary_path).name),
+                     self.logfile, metrics=self.metrics)
+
+    def move_source(self, name, source, move_path, dpx_name):
+        """Moves the DPX folder an item was cooked from into move_path with its framemd5 files"""
+        if source is None or not os.path.isdir(source):
+            log(self.logfile, f"No DPX folder left in the cook folders for {name}")
+            return
+        transfer(source, os.path.join(move_path, dpx_name), self.logfile, metrics=self.metrics)
+        segments_path = staging_folder(source)
+        if os.path.isdir(segments_path):
+            # A segmented reel, whose framemd5 files were written next to its segment folders
+            for md5_name in sorted(os.listdir(segments_path)):
+                if md5_name.endswith(".framemd5"):
+                    transfer(os.path.join(segments_path, md5_name), os.path.join(move_path, md5_name),
+                             self.logfile, metrics=self.metrics)
+            remove_staging(source)
+            return
+        md5_path = Path(source).with_suffix(".framemd5")
+        if os.path.exists(md5_path):
+            transfer(md5_path, os.path.join(move_path, md5_path.name), self.logfile, metrics=self.metrics)
+        else:
+            print(f"Error: MD5 file does not exist for {name}")
+
+    def fail_item(self, item, fail_folder, stage, detail=None):
+        """Moves every .mkv of an item, with its .mkv.txt and scan summary, the manifest of a segmented reel and the
+        source DPX folder to fail_folder/<name> for manual review"""
+        move_path = os.path.join(fail_folder, item['name'])
+        os.makedirs(move_path, exist_ok=True)
+        log(self.logfile, f"Moving {len(item['pairs'])} MKV files of {item['name']} and their source to {move_path} "
+                          f"for manual review")
+        for pair in item['pairs']:
+            output_path = self.move_pair(pair, move_path)
+            self.result_cache.discard(pair['mkv'])
+        if item['manifest']:
+            output_path = os.path.join(move_path, Path(item['manifest']).name)
+            transfer(item['manifest'], output_path, self.logfile, metrics=self.metrics)
+        self.journal.record(item['name'], stage, detail, output_path=output_path)
+        self.move_source(item['name'], item['source'], move_path, item['name'])
+
+    def complete_item(self, item):
+        """Moves the checked MKVs of an item, their .mkv.txt files, the manifest of a segmented reel and the source
+        DPX folder with its framemd5 files to the completed folder"""
+        log(self.logfile, f"Checks passed. Moving {item['name']} to completed folder")
+        move_path = os.path.join(MKV_COMPLETED_PATH, item['name'])
+        os.makedirs(move_path, exist_ok=True)
+        for pair in item['pairs']:
+            moved_mkv_path = self.move_pair(pair, move_path)
+            self.result_cache.relocate(pair['mkv'], moved_mkv_path, completed=True)
+            detail = f"framemd5 verified, {self.verified[pair['mkv']]} frames" if pair['mkv'] in self.verified \
+                else None
+            self.journal.record(pair['name'], COMPLETED, detail, output_path=moved_mkv_path)
+        if item['manifest']:
+            moved_manifest_path = os.path.join(move_path, Path(item['manifest']).name)
+            transfer(item['manifest'], moved_manifest_path, self.logfile, metrics=self.metrics)
+            self.journal.record(item['name'], COMPLETED, f"{len(item['pairs'])} segments",
+                                output_path=moved_manifest_path)
+        self.move_source(item['name'], item['source'], move_path, f"{item['name']}_processed_dpx")
+
+    def run_items(self):
+        """Runs process_item over the work items on a pool of POST_WORKERS threads
+
+        Every item moves through its checks on its own, so a quick MKV is completed without waiting for a long one.
+        """
+        if not self.items:
+            return
+        if self.mkv_policy_in_process and self.mkv_policy is None:
             try:
-                mkv_file_name = Path(mkv_path).name
-                txt_file_path = Path(mkv_path).with_suffix(".mkv.txt")
-                txt_file_name = txt_file_path.name
-                log(self.logfile,
-                    f"Checks passed. Moving {mkv_file_name} and {txt_file_name} to completed folder")
-                folder_name = f"{mkv_file_name.split('.')[0]}/"
-                move_path = os.path.join(MKV_COMPLETED_PATH, folder_name)
-                if not os.path.exists(move_path):
-                    os.mkdir(move_path)
-                move_file(mkv_path, os.path.join(move_path, mkv_file_name))
-                if str(txt_file_path) in self.txt_path_set:
-                    move_file(txt_file_path, os.path.join(move_path, txt_file_name))
-                else:
-                    raise FileNotFoundError(f"Missing txt file: {txt_file_name}")
-            except FileNotFoundError as e:
+                self.mkv_policy = compile_policy(MKV_POLICY_PATH)
+            except (OSError, ValueError) as e:
                 print(f"Error: {e}")
-            except Exception as e:
-                print(f"Error occurred: {e}")
+                log(self.logfile, f"Could not compile {MKV_POLICY_PATH}, checking every MKV with mediaconch: {e}")
+
+        outcomes = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.post_workers) as executor:
+            futures = {executor.submit(self.process_item, item): item for item in self.items}
+            for future in concurrent.futures.as_completed(futures):
+                item = futures[future]
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    print(f"Error occurred: {e}")
+                    log(self.logfile, f"ERROR: Post-rawcook failed for {item['name']}: {e}")
+                    outcome = 'error'
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        log(self.logfile, f"Post-rawcook finished for {len(self.items)} items: "
+                          f"{', '.join(f'{count} {outcome}' for outcome, count in sorted(outcomes.items()))}")
 
     def move_dpx_completed(self, dpx_to_cook_folder):
-        """ Moves dpx sequences that are completed into the completed folder along with the framemd5 sequences """
+        """Moves the dpx sequences left in a cook folder after their MKV was completed or failed
 
+        Items move their source with them, so this only catches the sequences whose move failed in an earlier run.
+        They go to the folder their MKV was moved to.
+        """
         try:
             with os.scandir(dpx_to_cook_folder) as entries:
-                log(self.logfile, f"Moving all processed dpx_folders to review/completed")
-                for entry in entries:
-                    try:
-                        if entry.is_dir():
-                            dpx_folder_name = str(entry.name)
-                            move_path = os.path.join(MKV_COMPLETED_PATH, dpx_folder_name)
-                            if not os.path.exists(move_path):
-                                try:
-                                    os.mkdir(move_path)
-                                except OSError as e:
-                                    print(f"Error creating directory: {e}")
-                                    continue
-                            move_dpx_path = os.path.join(move_path, dpx_folder_name + "_processed_dpx")
-
-                            move_file(entry, move_dpx_path)
-                            md5_path = Path(entry.path).with_suffix(".framemd5")
-                            move_md5_path = os.path.join(move_path, md5_path.name)
-                            if os.path.exists(md5_path):
-                                move_file(md5_path, move_md5_path)
-                            else:
-                                raise FileNotFoundError(f"MD5 file does not exist for {dpx_folder_name}")
-                    except FileNotFoundError as e:
-                        print(f"Error: {e}")
+                folders = [(entry.name, entry.path) for entry in entries
+                           if entry.is_dir() and not is_transfer_temp(entry.name) and entry.name != SEGMENTS_DIR]
         except OSError as e:
             print(f"Error scanning directory: {e}")
+            return
+
+        for dpx_folder_name, dpx_path in folders:
+            record = self.journal.get(dpx_folder_name)
+            if not record or record['stage'] not in (COMPLETED, MKV_POLICY_FAILED, POST_FAILED) \
+                    or not record['output_path'] or not os.path.isdir(os.path.dirname(record['output_path'])):
+                continue
+            move_path = os.path.dirname(record['output_path'])
+            log(self.logfile, f"Moving {dpx_folder_name}, left in {dpx_to_cook_folder}, to {move_path}")
+            try:
+                self.move_source(dpx_folder_name, dpx_path, move_path, f"{dpx_folder_name}_processed_dpx"
+                                 if record['stage'] == COMPLETED else dpx_folder_name)
+            except OSError as e:
+                print(f"Error: {e}")
 
     def execute(self):
         try:
             self.process()
-            self.check_missing()
-            self.check_mkv_policies()
-            self.check_general_errors()
-            self.move_mkv_completed()
+            self.run_items()
             self.move_dpx_completed(DPX_TO_COOK_PATH)
             self.move_dpx_completed(DPX_TO_COOK_V2_PATH)
         except Exception as e:
             print(f"Error: {e}")
             raise RuntimeError("Workflow execution failed for post_rawcook")
+        finally:
+            self.metrics.flush()
 
 
 if __name__ == '__main__':
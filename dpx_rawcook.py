@@ -1,21 +1,144 @@
 # TODO: Store license key in a separate file and read from there
 
 import concurrent.futures
+import heapq
 import os
-import subprocess
+import signal
+import time
+from pathlib import Path
 
 from utils.util_functions import log, create_file
+from utils.admission import open_admission
+from utils.concurrency import ConcurrencyController, ResourceSampler, read_process_bytes
+from utils.io_hints import open_io_hints
+from utils.lease import open_leases
+from utils.cook_planner import estimate_sequence_cost, plan_jobs, predict_finish
+from utils.metrics import open_metrics
+from utils.process_runner import run_command
+from utils.progress import StatusFeed
+from utils.result_cache import open_result_cache, find_indexes, MKV
+from utils.segmenter import SEGMENTS_DIR, MANIFEST_SUFFIX, REEL_COOKING, REEL_COOKED, REEL_FAILED, SEGMENT_QUEUED, \
+    SEGMENT_COOKED, SEGMENT_FAILED, SEGMENT_CANCELLED, plan_segments, stage_segments, remove_staging, manifest_path, \
+    write_manifest, read_manifest
+from utils.sequence_index import default_cache_dir
+from utils.transfer import transfer, is_transfer_temp
+from utils.state_journal import open_journal, is_network_filesystem, TO_COOK, TO_COOK_V2, COOKING, COOKED, \
+    COOK_FAILED, DUPLICATE
 
-from scripts.config import (SCRIPT_LOGS_DIR, RAWCOOKED_DIR, MKV_COOKED_PATH, DPX_TO_COOK_PATH, DPX_TO_COOK_V2_PATH, RAWCOOK_LICENSE)
+from scripts.config import (SCRIPT_LOGS_DIR, RAWCOOKED_DIR, MKV_COOKED_PATH, DPX_TO_COOK_PATH, DPX_TO_COOK_V2_PATH,
+                            RAWCOOK_LICENSE, RAWCOOK_FAILS)
+
+# Folder of mkv_cooked the nodes write their MKVs to while cooking when leases are used, one subfolder per node
+PARTIAL_DIR = '.partial'
+
+# Sequences in the v2 folder are cooked before the ones in dpx_to_cook
+COOK_QUEUES = (
+    (0, DPX_TO_COOK_V2_PATH, True),
+    (1, DPX_TO_COOK_PATH, False),
+)
+
+
+def default_worker_count() -> int:
+    """Derives the number of concurrent rawcooked jobs from the cores and the storage bandwidth
+
+    RAWCOOK_THREADS_PER_JOB is the number of cores a single encode keeps busy.
+    STORAGE_READ_MBPS is the aggregate read bandwidth of the DPX storage and RAWCOOK_JOB_MBPS the read rate of a
+    single encode; when set, the storage can only feed STORAGE_READ_MBPS / RAWCOOK_JOB_MBPS jobs.
+    """
+    threads_per_job = int(os.environ.get('RAWCOOK_THREADS_PER_JOB', 4))
+    workers = max(1, (os.cpu_count() or 1) // threads_per_job)
+
+    storage_mbps = float(os.environ.get('STORAGE_READ_MBPS', 0))
+    if storage_mbps > 0:
+        job_mbps = float(os.environ.get('RAWCOOK_JOB_MBPS', 150))
+        workers = min(workers, max(1, int(storage_mbps // job_mbps)))
+    return workers
 
 
 class DpxRawcook:
 
-    def __init__(self):
+    def __init__(self, max_workers=None):
         self.logfile = os.path.join(SCRIPT_LOGS_DIR, "dpx_rawcook.log")
         self.mkv_cooked_folder = os.path.join(RAWCOOKED_DIR, "mkv_cooked/")
         # TODO: Take input from GUI later
         self.md5_checksum = True
+        self.max_workers = max_workers or int(os.environ.get('RAWCOOK_WORKERS', 0)) or default_worker_count()
+
+        # The number of concurrent jobs starts at max_workers and, with RAWCOOK_ADAPTIVE, is adjusted every
+        # RAWCOOK_ADAPT_SECONDS between RAWCOOK_MIN_WORKERS and RAWCOOK_MAX_WORKERS to the most frames per second
+        self.adaptive = os.environ.get('RAWCOOK_ADAPTIVE', '1') == '1'
+        if self.adaptive:
+            floor = int(os.environ.get('RAWCOOK_MIN_WORKERS', 1))
+            ceiling = int(os.environ.get('RAWCOOK_MAX_WORKERS', 0)) or max(self.max_workers, os.cpu_count() or 1)
+        else:
+            floor = ceiling = self.max_workers
+        self.concurrency = ConcurrencyController(self.max_workers, floor, ceiling,
+                                                 float(os.environ.get('RAWCOOK_ADAPT_SECONDS', 30)))
+        self.sampler = ResourceSampler()
+        self.last_sample = 0.0
+        # Pid of the rawcooked process of each running job, keyed by sequence path
+        self.job_pids = {}
+
+        # Per-sequence success/failure records, keyed by sequence path
+        self.results = {}
+        self.queued_sequences = set()
+
+        # Job ordering: 'lpt' starts the most expensive sequences first to shorten the batch, 'fifo' only keeps the
+        # v2-before-v1 priority
+        self.plan = os.environ.get('RAWCOOK_PLAN', 'lpt')
+        # Estimate costs from one DPX header per sequence instead of stat'ing every frame
+        self.plan_from_headers = os.environ.get('RAWCOOK_PLAN_HEADERS', '0') == '1'
+        # Read throughput of a single encode, used to predict the finish time of the batch
+        self.job_bytes_per_second = float(os.environ.get('RAWCOOK_JOB_MBPS', 150)) * 1024 * 1024
+        self.costs = {}
+        self.frame_counts = {}
+
+        # Journal shared with the other scripts, used to tell complete MKVs from interrupted encodes
+        self.journal = open_journal(SCRIPT_LOGS_DIR)
+        self.index_cache_dir = default_cache_dir(SCRIPT_LOGS_DIR)
+        self.metrics = open_metrics('dpx_rawcook', SCRIPT_LOGS_DIR)
+        # Remembers the MKV cooked from each sequence content, so an identical sequence is not cooked twice
+        self.result_cache = open_result_cache(SCRIPT_LOGS_DIR)
+        # Content fingerprint of each queued sequence, keyed by sequence path
+        self.fingerprints = {}
+
+        # Sequences over RAWCOOK_SEGMENT_FRAMES frames or RAWCOOK_SEGMENT_GB GiB are cooked as several segments in
+        # parallel, tied back to the reel by a manifest in mkv_cooked (0 disables a limit, both are off by default)
+        self.segment_frames = int(os.environ.get('RAWCOOK_SEGMENT_FRAMES', 0))
+        self.segment_bytes = int(float(os.environ.get('RAWCOOK_SEGMENT_GB', 0)) * 1024 ** 3)
+        # (manifest path, manifest) of each segmented reel keyed by reel path, and the reel of each segment keyed by
+        # segment path
+        self.reels = {}
+        self.segment_reels = {}
+        self.cancelled_segments = set()
+
+        # Claims sequences through lease files on the shared file system when RAWCOOK_LEASE_DIR is set, so several
+        # nodes can drain the same cook folders without cooking a sequence twice
+        self.leases = open_leases()
+        self.lost_leases = set()
+        self.waiting_leases = set()
+        if self.leases is not None:
+            self.check_local_state()
+
+        # Holds jobs back while the predicted size of their MKV does not fit on the mkv_cooked volume
+        self.admission = open_admission(MKV_COOKED_PATH, self.journal)
+        self.held_jobs = set()
+        # Reads the head of the next queued sequence ahead and drops cooked frames from the page cache
+        self.io_hints = open_io_hints(self.index_cache_dir, self.metrics)
+
+        # Frames done, fps and ETA of every running encode, published to RAWCOOK_STATUS_FILE for the GUI. An encode
+        # without progress for RAWCOOK_STALL_MINUTES is flagged as stalled, and killed with RAWCOOK_STALL_KILL=1
+        self.status = StatusFeed(os.environ.get('RAWCOOK_STATUS_FILE',
+                                                os.path.join(SCRIPT_LOGS_DIR, 'rawcook_status.json')),
+                                 float(os.environ.get('RAWCOOK_STATUS_SECONDS', 2)),
+                                 float(os.environ.get('RAWCOOK_STALL_MINUTES', 30)) * 60)
+        self.stall_kill = os.environ.get('RAWCOOK_STALL_KILL', '0') == '1'
+        self.stalled_jobs = set()
+
+        # Set by the pipeline daemon: ignores sequences still being copied and is notified of every finished job
+        self.settle_tracker = None
+        self.on_result = None
+        self.poll_interval = 30
 
     def process(self) -> None:
         """Initiates the workflow
@@ -32,88 +155,687 @@ class DpxRawcook:
             print("Error creating logfile:", e)
             return
 
-    def rawcooked_command_executor(self, start_folder_path: str, mkv_file_name: str, v2: bool) -> None:
-        """The method passed to each process that executes rawcooked command
+    def rawcooked_command_executor(self, start_folder_path: str, mkv_file_name: str, v2: bool) -> int:
+        """The method passed to each worker that executes rawcooked command
 
         Runs rawcooked command with respective parameters
         Stores the rawcooked console output to a .txt  file named as <mkv_file_name>.mkv.txt
-        Checks if there are gaps in output v2 sequence, then that sequence is moved to rawcook fails folder
+        Raises RuntimeError if rawcooked exits with an error, after the output has been stored
         """
-        # string_command = f"rawcooked --license 004B159A2BDB07331B8F2FDF4B2F -y --all --no-accept-gaps {'--output-version 2' if v2 else ''} -s 5281680 {'--framemd5' if self.md5_checksum else ''} {start_folder_path} -o {MKV_COOKED_PATH}/{mkv_file_name}.mkv"
+        mkv_path = os.path.join(MKV_COOKED_PATH, f"{mkv_file_name}.mkv")
+        output_txt_file = os.path.join(RAWCOOKED_DIR, "mkv_cooked", f"{mkv_file_name}.mkv.txt")
+        write_path = self.mkv_write_path(mkv_file_name)
         string_command = (
             f"rawcooked --license {RAWCOOK_LICENSE} "
             f"-y --all --no-accept-gaps {'--output-version 2' if v2 else ''} "
             f"-s 5281680 {'--framemd5' if self.md5_checksum else ''} "
-            f"{start_folder_path} -o {MKV_COOKED_PATH}/{mkv_file_name}.mkv"
+            f"{start_folder_path} -o {write_path}"
         )
-        output_txt_file = os.path.join(RAWCOOKED_DIR, "mkv_cooked", f"{mkv_file_name}.mkv.txt")
         command = string_command.split(" ")
         command = [c for c in command if len(c) > 0]
         command = list(command)
         print(command)
-        subprocess_logs = []
-        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as p:
-            for line in p.stderr:
-                subprocess_logs.append(line)
-                print(f"{mkv_file_name} : {line}")
-            for line in p.stdout:
-                subprocess_logs.append(line)
-                print(f"{mkv_file_name} : {line}")
+        lease_name = self.lease_name(start_folder_path)
+        if self.leases is not None:
+            os.makedirs(os.path.dirname(write_path), exist_ok=True)
+            # Checked again right before rawcooked starts, the lease may have been reclaimed since it was taken
+            if not self.leases.owns(lease_name):
+                self.lease_lost(lease_name)
+                raise RuntimeError(f"lease of {lease_name} lost before the encode started")
+        self.journal.record(mkv_file_name, COOKING, path=start_folder_path, output_path=mkv_path)
+        self.status.start_job(start_folder_path, mkv_file_name, self.frame_counts.get(start_folder_path))
+        with self.metrics.stage('rawcook', start_folder_path) as stage:
+            # The console output is streamed into the .mkv.txt file while rawcooked runs, progress lines only update
+            # the status feed
+            try:
+                result = run_command(command, output_path=f"{write_path}.txt" if self.leases else output_txt_file,
+                                     line_callback=lambda stream, line: self.show_output(start_folder_path,
+                                                                                         mkv_file_name, line),
+                                     on_start=lambda process: self.job_pids.update({start_folder_path: process.pid}))
+                if self.leases is not None:
+                    self.publish_output(lease_name, write_path, mkv_path)
+            except Exception as e:
+                # Otherwise the sequence would look in flight to post-rawcook and to the next run
+                self.journal.record(mkv_file_name, COOK_FAILED, str(e))
+                self.status.finish_job(start_folder_path, COOK_FAILED)
+                raise
+            finally:
+                self.job_pids.pop(start_folder_path, None)
+                if self.io_hints is not None:
+                    self.io_hints.evict(start_folder_path)
 
-        if p.returncode != 0:
-            print("Rawcooked Command failed with error code:", p.returncode)
-            raise RuntimeError("Failed to call rawcooked command")
+            output_bytes = os.path.getsize(mkv_path) if os.path.exists(mkv_path) else None
+            stage.add_process(result)
+            stage.add(frames=self.frame_counts.get(start_folder_path), bytes_read=self.costs.get(start_folder_path),
+                      bytes_written=output_bytes)
+            # The source bytes are kept with the output bytes to learn the compression ratio from
+            source_bytes = {'byte_total': self.costs[start_folder_path]} if self.costs.get(start_folder_path) else {}
+            self.journal.record(mkv_file_name, COOKED if result.returncode == 0 else COOK_FAILED,
+                                exit_code=result.returncode, output_bytes=output_bytes, **source_bytes)
+            self.status.finish_job(start_folder_path, COOKED if result.returncode == 0 else COOK_FAILED)
+            if result.returncode != 0:
+                print("Rawcooked Command failed with error code:", result.returncode)
+                raise RuntimeError(f"rawcooked exited with error code {result.returncode}")
+            if start_folder_path not in self.segment_reels:
+                self.result_cache.put(self.fingerprints.get(start_folder_path), MKV,
+                                      {'name': mkv_file_name, 'path': mkv_path, 'bytes': output_bytes,
+                                       'completed': False}, mkv_file_name, mkv_path)
 
-        std_logs = ''.join(subprocess_logs)
+        return result.returncode
 
-        with open(output_txt_file, 'a+') as file:
-            file.write(std_logs)
+    def mkv_write_path(self, mkv_file_name: str) -> str:
+        """Returns the path rawcooked writes the MKV of a job to
 
-    def run_rawcooked(self, dpx_to_cook_folder_path, v2_flag) -> None:
-        """Executes Rawcooked over the sequences present in the given dpx_folders
+        With leases every node writes into its own folder under mkv_cooked/.partial, and the MKV and its .mkv.txt
+        are only renamed into mkv_cooked once cooked, so two nodes never write to the same file and post-rawcook
+        never sees an MKV still being written by another node.
+        """
+        if self.leases is None:
+            return os.path.join(MKV_COOKED_PATH, f"{mkv_file_name}.mkv")
+        return os.path.join(MKV_COOKED_PATH, PARTIAL_DIR, self.leases.node, f"{mkv_file_name}.mkv")
 
-        First pass sequences have large reversibility file and thus needs to be cooked with --output-version 2 flag.
-        Then runs Rawcooked over the sequences present in dpx_to_cook
-        Runs Rawcooked with --framemd5 flag by default (might need to take user input later)
+    def publish_output(self, lease_name: str, write_path: str, mkv_path: str) -> None:
+        """Renames the MKV and .mkv.txt of a finished encode into mkv_cooked if this node still holds the lease,
+        else removes them and reports the lease lost"""
+        if not self.leases.owns(lease_name):
+            for path in (write_path, f"{write_path}.txt"):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.lease_lost(lease_name)
+            raise RuntimeError(f"lease of {lease_name} lost while cooking")
+        # The .mkv.txt first, post-rawcook leaves an MKV alone until its .mkv.txt is there
+        for source, destination in ((f"{write_path}.txt", f"{mkv_path}.txt"), (write_path, mkv_path)):
+            if os.path.exists(source):
+                os.replace(source, destination)
+
+    def show_output(self, seq_path: str, mkv_file_name: str, line: str) -> None:
+        """Feeds a line of rawcooked output to the status feed, and prints it unless it only reports progress"""
+        if not self.status.line(seq_path, line):
+            print(f"{mkv_file_name} : {line}")
+
+    def is_ready(self, entry) -> bool:
+        """Returns False for a sequence that is still being copied into a cook folder
+
+        Sequences moved in by the assessment are ready straight away when unchanged since, others have to settle.
+        """
+        if self.settle_tracker is None:
+            return True
+        record = self.journal.get(entry.name)
+        if record and record['stage'] in (TO_COOK, TO_COOK_V2) and \
+                self.journal.passed(entry.name, record['stage'], entry.path):
+            return True
+        return self.settle_tracker.is_settled(entry.path)
+
+    def needs_cooking(self, mkv_file_name: str) -> bool:
+        """Checks the journal for the outcome of an earlier run on the same sequence
+
+        A sequence whose MKV was cooked successfully and is still in mkv_cooked at its recorded size is waiting for
+        post-rawcook and is skipped. The MKV and .mkv.txt of an interrupted encode are truncated, so they are removed
+        before the sequence is cooked again, along with every segment of an interrupted segmented reel.
+        """
+        record = self.journal.get(mkv_file_name)
+        if record is None or not record['output_path']:
+            return True
+
+        mkv_path = record['output_path']
+        if record['stage'] == COOKED and record['exit_code'] == 0 and os.path.exists(mkv_path) \
+                and os.path.getsize(mkv_path) == record['output_bytes']:
+            log(self.logfile, f"Skipping {mkv_file_name}, already cooked to {mkv_path}")
+            return False
+
+        if record['stage'] == DUPLICATE and os.path.exists(mkv_path) \
+                and os.path.getsize(mkv_path) == record['output_bytes']:
+            log(self.logfile, f"Skipping {mkv_file_name}, same content as {mkv_path}, left for review")
+            return False
+
+        if record['stage'] == COOKING:
+            log(self.logfile, f"{mkv_file_name} was interrupted while cooking, removing partial output")
+            write_path = self.mkv_write_path(mkv_file_name)
+            paths = [mkv_path, f"{mkv_path}.txt", write_path, f"{write_path}.txt"]
+            if mkv_path.endswith(MANIFEST_SUFFIX) and os.path.exists(mkv_path):
+                manifest = read_manifest(mkv_path)
+                for segment in manifest['segments']:
+                    segment_write_path = self.mkv_write_path(segment['name'])
+                    paths.extend((segment['mkv'], f"{segment['mkv']}.txt", segment['framemd5'], segment_write_path,
+                                  f"{segment_write_path}.txt"))
+                remove_staging(manifest['source'])
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        return True
+
+    def cooked_before(self, entry) -> bool:
+        """Checks the result cache for a completed MKV cooked from a sequence with the same name and content
+
+        Such a sequence is recorded as a duplicate of the earlier MKV and left in the cook folder for review instead
+        of being cooked again. The name has to match as rawcooked stores the file names in the MKV.
+        """
+        try:
+            fingerprint, cached = self.result_cache.lookup(entry.path, MKV, self.index_cache_dir)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            return False
+        self.fingerprints[entry.path] = fingerprint
+        if cached is None or cached['name'] != entry.name or not cached.get('completed'):
+            return False
+        if not os.path.exists(cached['path']) or os.path.getsize(cached['path']) != cached['bytes']:
+            return False
+
+        log(self.logfile, f"DUPLICATE: {entry.path} has the same content as the sequence cooked to {cached['path']}, "
+                          f"not cooking it again")
+        self.journal.record(entry.name, DUPLICATE, f"same content as {cached['path']}", path=entry.path,
+                            output_path=cached['path'], output_bytes=cached['bytes'])
+        self.metrics.event('result_cache_hit', stage='rawcook', sequence=entry.name)
+        return True
+
+    def find_sequences(self) -> list:
+        """Lists the sequences waiting in the cook folders that have not been queued yet
+
+        Returns (sort key, sequence path, v2 flag) tuples, where the sort key orders the queue according to the plan
         """
+        jobs = []
+        present = set()
+        listed = time.time()
+        for priority, dpx_to_cook_folder_path, v2_flag in COOK_QUEUES:
+            # Filter out only the folders as there can be .framemd5 files
+            with os.scandir(dpx_to_cook_folder_path) as entries:
+                for entry in entries:
+                    if not entry.is_dir() or is_transfer_temp(entry.name) or entry.name == SEGMENTS_DIR:
+                        continue
+                    present.add(entry.path)
+                    if entry.path not in self.queued_sequences:
+                        if not self.is_ready(entry) or not self.claim(entry):
+                            continue
+                        self.queued_sequences.add(entry.path)
+                        if not self.needs_cooking(entry.name) or self.cooked_before(entry):
+                            if self.leases is not None:
+                                self.leases.mark_done(entry.name)
+                            continue
+                        try:
+                            estimate = estimate_sequence_cost(entry.path, self.plan_from_headers,
+                                                              self.index_cache_dir)
+                        except (OSError, ValueError) as e:
+                            print(f"Error: {e}")
+                            estimate = {'frames': 0, 'bytes': 0}
+                        self.costs[entry.path] = estimate['bytes']
+                        self.frame_counts[entry.path] = estimate['frames']
+                        log(self.logfile, f"{entry.path}: {estimate['frames']} frames, "
+                                          f"{estimate['bytes'] / 1024 ** 3:.1f} GiB")
+                        segment_jobs = self.split_sequence(entry, v2_flag, priority)
+                        if segment_jobs:
+                            jobs.extend(segment_jobs)
+                            continue
+                        sort_key = (-estimate['bytes'], priority) if self.plan == 'lpt' else (priority,)
+                        jobs.append((sort_key, entry.path, v2_flag))
+
+        # Forget the sequences that left the cook folders, so one delivered again under the same name is cooked
+        self.queued_sequences &= present
+        if self.leases is not None:
+            names = {os.path.basename(path) for path in present}
+            self.lost_leases &= names
+            self.waiting_leases &= names
+            for name in self.leases.prune(names, listed):
+                log(self.logfile, f"Lease of {name} removed, the sequence has left the cook folders")
+        if jobs:
+            log(self.logfile, f"Found {len(jobs)} new sequences to cook")
+        return jobs
+
+    def check_local_state(self) -> None:
+        """Refuses to cook with leases when the journal or the result cache is on a network file system
+
+        SQLite cannot be shared between nodes over NFS or SMB, each node has to keep them on a local disk.
+        """
+        for variable, path in (('WORKFLOW_STATE_DB', self.journal.db_path),
+                               ('RESULT_CACHE_DB', self.result_cache.db_path)):
+            if path and is_network_filesystem(os.path.dirname(os.path.abspath(path))):
+                raise RuntimeError(f"{path} is on a network file system, which SQLite does not support. Set "
+                                   f"{variable} to a local path on each node when RAWCOOK_LEASE_DIR is set")
+
+    def claim(self, entry) -> bool:
+        """Takes the lease of a sequence before anything is done with it, including removing partial output
 
-        log(self.logfile, f"Checking for files in {dpx_to_cook_folder_path}")
-        sequence_path_list = [os.path.join(dpx_to_cook_folder_path, folder) for folder in
-                              os.listdir(dpx_to_cook_folder_path)]
+        A sequence leased by another node is left to it and looked at again at the next scan, in case the node dies.
+        """
+        if self.leases is None:
+            return True
+        try:
+            if self.leases.acquire(entry.name, path=entry.path):
+                self.waiting_leases.discard(entry.name)
+                return True
+        except OSError as e:
+            print(f"Error: {e}")
+            return False
+        if entry.name not in self.waiting_leases:
+            self.waiting_leases.add(entry.name)
+            log(self.logfile, f"Skipping {entry.path}, leased by {self.leases.holder(entry.name)}")
+        return False
 
-        # Filter out only the folders as there can be .framemd5 files
-        dpx_to_cook_folder_list = [sequence for sequence in sequence_path_list if os.path.isdir(sequence)]
+    def lease_name(self, seq_path: str) -> str:
+        """Returns the name a job is leased under, the reel for a segment"""
+        return os.path.basename(self.segment_reels.get(seq_path, seq_path))
 
-        if len(dpx_to_cook_folder_list) == 0:
-            log(self.logfile, f"No sequence found in {dpx_to_cook_folder_path}")
+    def finish_lease(self, name: str, released: bool) -> None:
+        """Releases the lease of a sequence moved out of the cook folders, or keeps it as done while the sequence
+        stays there"""
+        if self.leases is None:
             return
+        try:
+            if released:
+                self.leases.release(name)
+            else:
+                self.leases.mark_done(name)
+        except OSError as e:
+            print(f"Error: {e}")
 
-        with concurrent.futures.ProcessPoolExecutor(max_workers=8) as executor:
-            # Taking only 20 entries from the dictionary
-            for seq_path in dpx_to_cook_folder_list[:20]:
-                print(f"Cooking {seq_path}")
-                if v2_flag:
-                    log(self.logfile, f"{seq_path} will be cooked using RAWCooked V2")
-                else:
-                    log(self.logfile, f"{seq_path} will be cooked using RAWCooked")
+    def lease_lost(self, name: str) -> None:
+        """Stops the encodes of a sequence whose lease was reclaimed by another node, which is now cooking it"""
+        self.lost_leases.add(name)
+        log(self.logfile, f"ERROR: Lease of {name} lost to {self.leases.holder(name)}, stopping its encodes")
+        self.metrics.event('lease_lost', stage='rawcook', sequence=name)
+        for seq_path, pid in list(self.job_pids.items()):
+            if self.lease_name(seq_path) == name:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def split_sequence(self, entry, v2_flag: bool, priority: int):
+        """Splits a sequence over the segment limits into frame-range segments cooked as separate jobs
+
+        Each segment is a folder of hard links to a range of frames under the hidden .segments folder of the cook
+        folder, and is cooked to its own MKV, .mkv.txt and framemd5. A <name>.segments.json manifest in mkv_cooked
+        lists the segments of the reel for post-rawcook. Returns the segment jobs, or None when the sequence is cooked
+        whole.
+        """
+        if self.segment_frames <= 0 and self.segment_bytes <= 0:
+            return None
+        if len(plan_segments(self.frame_counts[entry.path], self.costs[entry.path], self.segment_frames,
+                             self.segment_bytes)) < 2:
+            return None
+        try:
+            indexes = find_indexes(entry.path, self.index_cache_dir)
+            if len(indexes) != 1:
+                log(self.logfile, f"{entry.path} has frames in {len(indexes)} folders, cooking it whole")
+                return None
+            index = indexes[0]
+            segments = stage_segments(entry.path, index, plan_segments(index.frame_count, index.byte_total,
+                                                                       self.segment_frames, self.segment_bytes))
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            log(self.logfile, f"ERROR: Could not split {entry.path} into segments, cooking it whole: {e}")
+            remove_staging(entry.path)
+            return None
+
+        for segment in segments:
+            segment['mkv'] = os.path.join(MKV_COOKED_PATH, f"{segment['name']}.mkv")
+        manifest = {'name': entry.name, 'source': entry.path, 'v2': v2_flag, 'frames': index.frame_count,
+                    'bytes': index.byte_total, 'status': REEL_COOKING, 'segments': segments}
+        path = manifest_path(MKV_COOKED_PATH, entry.name)
+        write_manifest(path, manifest)
+        self.reels[entry.path] = (path, manifest)
+        self.journal.record(entry.name, COOKING, f"{len(segments)} segments", path=entry.path, output_path=path)
+        log(self.logfile, f"{entry.path} split into {len(segments)} segments of about "
+                          f"{segments[0]['frames']} frames, manifest {path}")
+
+        jobs = []
+        for segment in segments:
+            self.segment_reels[segment['staging']] = entry.path
+            self.costs[segment['staging']] = segment['bytes']
+            self.frame_counts[segment['staging']] = segment['frames']
+            sort_key = (-segment['bytes'], priority) if self.plan == 'lpt' else (priority,)
+            jobs.append((sort_key, segment['staging'], v2_flag))
+        return jobs
 
-                mkv_file_name = os.path.basename(seq_path)
-                # Cooking with --framemd5 flag by default
+    def segment_finished(self, reel_path: str, segment_path: str, succeeded: bool) -> None:
+        """Records the outcome of a segment in the manifest of its reel and settles the reel once all are done
+
+        A failed segment cancels the segments of the reel not started yet. Once no segment is left running the reel
+        is recorded as cooked if every segment was, else it is moved to RAWCOOK_FAILS with the output of all its
+        segments.
+        """
+        path, manifest = self.reels[reel_path]
+        for segment in manifest['segments']:
+            if segment['staging'] == segment_path:
+                segment['status'] = SEGMENT_COOKED if succeeded else SEGMENT_FAILED
+            elif not succeeded and segment['status'] == SEGMENT_QUEUED and segment['staging'] not in self.results:
+                segment['status'] = SEGMENT_CANCELLED
+                self.cancelled_segments.add(segment['staging'])
+
+        if any(segment['status'] == SEGMENT_QUEUED for segment in manifest['segments']):
+            write_manifest(path, manifest)
+            return
+
+        if all(segment['status'] == SEGMENT_COOKED for segment in manifest['segments']):
+            manifest['status'] = REEL_COOKED
+            write_manifest(path, manifest)
+            self.journal.record(manifest['name'], COOKED, f"{len(manifest['segments'])} segments", exit_code=0,
+                                output_path=path, output_bytes=os.path.getsize(path))
+            log(self.logfile, f"SUCCESS: {reel_path} cooked in {len(manifest['segments'])} segments")
+            self.finish_lease(manifest['name'], released=False)
+            return
+
+        failed = [segment['name'] for segment in manifest['segments'] if segment['status'] == SEGMENT_FAILED]
+        manifest['status'] = REEL_FAILED
+        write_manifest(path, manifest)
+        self.journal.record(manifest['name'], COOK_FAILED, f"segments failed: {', '.join(failed)}")
+        log(self.logfile, f"FAIL: Rawcooked failed for segments {', '.join(failed)} of {reel_path}. Moving the reel "
+                          f"and all its segments to rawcooked failed folder")
+        try:
+            self.move_failed_reel(reel_path)
+            self.finish_lease(manifest['name'], released=True)
+        except Exception as move_error:
+            print(f"Error: {move_error}")
+            log(self.logfile, f"ERROR: Could not move {reel_path} to rawcooked failed folder: {move_error}")
+            self.finish_lease(manifest['name'], released=False)
+
+    def move_failed_reel(self, reel_path: str) -> None:
+        """Moves a segmented reel that failed to cook, with its manifest and the output of every segment"""
+        path, manifest = self.reels[reel_path]
+        move_path = os.path.join(RAWCOOK_FAILS, manifest['name'])
+        if not os.path.exists(move_path):
+            os.makedirs(move_path)
+
+        for segment in manifest['segments']:
+            for leftover in (segment['mkv'], f"{segment['mkv']}.txt", segment['framemd5']):
+                if os.path.exists(leftover):
+                    transfer(leftover, os.path.join(move_path, os.path.basename(leftover)), self.logfile,
+                             metrics=self.metrics)
+        transfer(path, os.path.join(move_path, os.path.basename(path)), self.logfile, metrics=self.metrics)
+        remove_staging(reel_path)
+        transfer(reel_path, os.path.join(move_path, manifest['name']), self.logfile, metrics=self.metrics)
+
+    def move_failed(self, seq_path: str) -> None:
+        """Moves a sequence that failed to cook, with its partial mkv, .mkv.txt and .framemd5, to RAWCOOK_FAILS"""
+
+        mkv_file_name = os.path.basename(seq_path)
+        move_path = os.path.join(RAWCOOK_FAILS, mkv_file_name)
+        if not os.path.exists(move_path):
+            os.makedirs(move_path)
+
+        leftovers = [
+            os.path.join(MKV_COOKED_PATH, f"{mkv_file_name}.mkv"),
+            os.path.join(MKV_COOKED_PATH, f"{mkv_file_name}.mkv.txt"),
+            str(Path(seq_path).with_suffix(".framemd5")),
+        ]
+        for path in leftovers:
+            if os.path.exists(path):
+                transfer(path, os.path.join(move_path, os.path.basename(path)), self.logfile, metrics=self.metrics)
+        transfer(seq_path, os.path.join(move_path, mkv_file_name), self.logfile, metrics=self.metrics)
+
+    def collect_result(self, future, job) -> None:
+        """Records the outcome of a finished rawcooked job and moves failed sequences to RAWCOOK_FAILS
+
+        The segments of a segmented reel are settled together by segment_finished. A job whose lease was lost is
+        left to the node that reclaimed it.
+        """
+
+        _, seq_path, v2_flag = job
+        reel_path = self.segment_reels.get(seq_path)
+        record = self.results[seq_path]
+        record['end'] = time.time()
+        self.release_space(seq_path, future.exception() is None)
+        if self.lease_name(seq_path) in self.lost_leases:
+            record['status'] = 'lost'
+            log(self.logfile, f"{seq_path} stopped, its lease was taken over by another node")
+            if reel_path is not None:
+                self.cancelled_segments.update(segment['staging'] for segment in self.reels[reel_path][1]['segments'])
+            if self.on_result:
+                self.on_result(seq_path, record)
+            return
+        try:
+            record['returncode'] = future.result()
+            record['status'] = 'success'
+            log(self.logfile, f"SUCCESS: {seq_path} cooked in {record['end'] - record['start']:.0f}s")
+            if reel_path is None:
+                self.finish_lease(os.path.basename(seq_path), released=False)
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = f"stalled and killed, {e}" if seq_path in self.stalled_jobs else str(e)
+            if reel_path is not None:
+                log(self.logfile, f"FAIL: Rawcooked failed for segment {seq_path}: {e}")
+            else:
+                log(self.logfile, f"FAIL: Rawcooked failed for {seq_path}: {e}. Moving to rawcooked failed folder")
                 try:
-                    executor.submit(self.rawcooked_command_executor, seq_path, mkv_file_name, v2_flag)
-                except Exception as e:
-                    print("Task Failed:", e)
-                    raise RuntimeError(f"Failed to run rawcooked for {seq_path}") from e
+                    self.move_failed(seq_path)
+                    self.finish_lease(os.path.basename(seq_path), released=True)
+                except Exception as move_error:
+                    print(f"Error: {move_error}")
+                    log(self.logfile, f"ERROR: Could not move {seq_path} to rawcooked failed folder: {move_error}")
+                    self.finish_lease(os.path.basename(seq_path), released=False)
+
+        if reel_path is not None:
+            self.segment_finished(reel_path, seq_path, record['status'] == 'success')
+
+        if self.on_result:
+            self.on_result(seq_path, record)
+
+    def admit(self, seq_path: str) -> bool:
+        """Reserves space on the mkv_cooked volume for the MKV of a job, returns False when it does not fit"""
+        if self.admission is None:
+            return True
+        output_path = self.mkv_write_path(os.path.basename(seq_path))
+        try:
+            admitted, needed, available = self.admission.admit(seq_path, self.costs.get(seq_path, 0), output_path)
+        except OSError as e:
+            print(f"Error: {e}")
+            return True
+        if admitted:
+            self.held_jobs.discard(seq_path)
+        elif seq_path not in self.held_jobs:
+            self.held_jobs.add(seq_path)
+            log(self.logfile, f"Holding {seq_path}: its MKV is predicted at {needed / 1024 ** 3:.1f} GiB "
+                              f"(ratio {self.admission.ratio:.2f}), only {max(available, 0) / 1024 ** 3:.1f} GiB "
+                              f"can be reserved on {MKV_COOKED_PATH}")
+            self.metrics.event('admission_held', stage='rawcook', sequence=os.path.basename(seq_path),
+                               needed_bytes=needed, available_bytes=available)
+        return admitted
+
+    def release_space(self, seq_path: str, succeeded: bool) -> None:
+        """Drops the reservation of a finished job, learning the compression ratio from its MKV if it succeeded"""
+        if self.admission is None:
+            return
+        output_path = os.path.join(MKV_COOKED_PATH, f"{os.path.basename(seq_path)}.mkv")
+        output_bytes = os.path.getsize(output_path) if succeeded and os.path.exists(output_path) else None
+        self.admission.release(seq_path, output_bytes)
+
+    def update_reservations(self) -> None:
+        """Re-estimates the output size of the running encodes from their partial MKV and the source bytes read"""
+        if self.admission is None:
+            return
+        for seq_path, pid in list(self.job_pids.items()):
+            source_read = read_process_bytes(pid)
+            if source_read is not None:
+                self.admission.update(seq_path, source_read)
+        self.metrics.gauge('reserved_bytes', self.admission.reserved(), queue='rawcook')
+
+    def check_stalls(self) -> None:
+        """Flags the encodes that made no progress for RAWCOOK_STALL_MINUTES and kills them if RAWCOOK_STALL_KILL
+        is set, so their slot is freed. A killed encode fails and is moved to the rawcooked failed folder."""
+        for seq_path in self.status.stalled():
+            job = self.status.get(seq_path)
+            if job is None:
+                continue
+            of_total = f" of {job['total_frames']}" if job['total_frames'] else ''
+            log(self.logfile, f"STALLED: {seq_path} has made no progress for {job['since_progress_seconds']}s, "
+                              f"at frame {job['frames']}{of_total}")
+            self.metrics.event('stalled', stage='rawcook', sequence=os.path.basename(seq_path),
+                               frames=job['frames'], since_progress_seconds=job['since_progress_seconds'])
+            pid = self.job_pids.get(seq_path)
+            if self.stall_kill and pid is not None:
+                log(self.logfile, f"Killing the stalled encode of {seq_path} (pid {pid})")
+                self.stalled_jobs.add(seq_path)
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def log_plan(self, queue, in_flight) -> None:
+        """Logs how the queued jobs pack onto the workers and the predicted finish time of the batch"""
+
+        now = time.time()
+        busy = []
+        for _, seq_path, _ in in_flight.values():
+            elapsed = now - self.results[seq_path]['start']
+            busy.append(max(0.0, self.costs.get(seq_path, 0) - elapsed * self.job_bytes_per_second))
+        costs = {seq_path: self.costs.get(seq_path, 0) for _, seq_path, _ in queue}
+        _, bins, makespan = plan_jobs(costs, self.concurrency.limit, busy)
+        finish = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(predict_finish(makespan, self.job_bytes_per_second,
+                                                                                   now)))
+        log(self.logfile, f"Plan: {len(queue)} queued, {len(in_flight)} running on {self.concurrency.limit} workers, "
+                          f"queued jobs per worker {[len(b) for b in bins]}, largest worker load "
+                          f"{makespan / 1024 ** 3:.1f} GiB, predicted finish {finish}")
+
+    def adjust_concurrency(self, in_flight) -> None:
+        """Samples the running encodes every RAWCOOK_ADAPT_SECONDS and lets the controller change the job limit
+
+        The throughput is the bytes read by the rawcooked processes converted to frames with the average frame size
+        of each sequence; sequences without a frame count are left out.
+        """
+        now = time.monotonic()
+        if not self.adaptive or now - self.last_sample < self.concurrency.interval:
+            return
+        self.last_sample = now
+
+        pids = dict(self.job_pids)
+        sample = self.sampler.sample(pids.values())
+        if not sample['seconds']:
+            return
+        frames = 0.0
+        for seq_path, pid in pids.items():
+            frame_count = self.frame_counts.get(seq_path)
+            if frame_count and self.costs.get(seq_path):
+                frames += sample['read_bytes'].get(pid, 0) / (self.costs[seq_path] / frame_count)
+        read_bytes = sum(sample['read_bytes'].values())
+        frames_per_second = frames / sample['seconds']
+        self.metrics.event('concurrency_sample', running=len(in_flight), limit=self.concurrency.limit,
+                           frames_per_second=round(frames_per_second, 3),
+                           read_bytes_per_second=round(read_bytes / sample['seconds']), cpu=sample['cpu'],
+                           iowait=sample['iowait'])
+
+        decision = self.concurrency.observe(len(in_flight), frames_per_second, sample['cpu'])
+        if decision:
+            limit, reason = decision
+            log(self.logfile, f"Concurrency: job limit set to {limit} ({reason})")
+            self.metrics.gauge('job_limit', limit, queue='rawcook')
+
+    def run_rawcooked(self, stop_event=None, watcher=None) -> None:
+        """Executes Rawcooked over the sequences present in the dpx_to_cook folders
+
+        The v2 and v1 folders form a single queue. With the default 'lpt' plan the most expensive sequences are
+        started first so that a large reel does not start last and stretch the batch; with 'fifo' sequences with
+        large reversibility file (cooked with --output-version 2) come first. A job is started whenever a worker is
+        free, and the folders are scanned again after each job so that sequences arriving during the batch are cooked
+        as well. The number of jobs running at once is set by the concurrency controller (see adjust_concurrency).
+        With a stop_event the scheduler keeps running until the event is set, waiting on the watcher (or polling)
+        for new sequences while it is idle. With leases the jobs of this node are renewed in the background while
+        they run.
+        Runs Rawcooked with --framemd5 flag by default (might need to take user input later)
+        """
+
+        if self.leases is not None:
+            self.leases.start(self.lease_lost)
+        try:
+            self.cook_queue(stop_event, watcher)
+        finally:
+            if self.leases is not None:
+                self.leases.stop()
+            if self.io_hints is not None:
+                self.io_hints.close()
+
+    def cook_queue(self, stop_event=None, watcher=None) -> None:
+        """Runs the rawcooked jobs of the cook folders until the queue is drained or the stop_event is set"""
+        queue = self.find_sequences()
+        heapq.heapify(queue)
+        if not queue and stop_event is None:
+            log(self.logfile, "No sequence found in the cook folders")
+            return
+        if queue:
+            self.log_plan(queue, {})
+
+        in_flight = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency.ceiling) as executor:
+            while queue or in_flight or (stop_event is not None and not stop_event.is_set()):
+                # Jobs whose MKV does not fit yet, smaller jobs further down the queue may still be started
+                held = []
+                while queue and len(in_flight) < self.concurrency.limit:
+                    job = heapq.heappop(queue)
+                    _, seq_path, v2_flag = job
+                    if seq_path in self.cancelled_segments or self.lease_name(seq_path) in self.lost_leases:
+                        continue
+                    if not self.admit(seq_path):
+                        held.append(job)
+                        continue
+                    print(f"Cooking {seq_path}")
+                    if v2_flag:
+                        log(self.logfile, f"{seq_path} will be cooked using RAWCooked V2")
+                    else:
+                        log(self.logfile, f"{seq_path} will be cooked using RAWCooked")
+
+                    mkv_file_name = os.path.basename(seq_path)
+                    self.results[seq_path] = {'v2': v2_flag, 'status': 'running', 'start': time.time()}
+                    # Cooking with --framemd5 flag by default
+                    future = executor.submit(self.rawcooked_command_executor, seq_path, mkv_file_name, v2_flag)
+                    in_flight[future] = job
+                for job in held:
+                    heapq.heappush(queue, job)
+                if queue and in_flight and self.io_hints is not None:
+                    # The next job to start, read ahead while the running encodes keep the workers busy
+                    self.io_hints.prefetch(queue[0][1])
+                if held and not in_flight and stop_event is None:
+                    log(self.logfile, f"Not enough space on {MKV_COOKED_PATH} for the {len(held)} sequences left, "
+                                      f"leaving them for the next run")
+                    queue = []
+                    continue
+
+                self.metrics.gauge('queue_depth', len(queue), queue='rawcook')
+                self.metrics.gauge('running_jobs', len(in_flight), queue='rawcook')
+                self.status.set_queue(queued=len(queue), running=len(in_flight), limit=self.concurrency.limit)
+                self.status.publish()
+                if in_flight:
+                    # Wakes up at least every interval to sample the encodes, even when none finishes
+                    timeout = min(self.poll_interval if stop_event is not None else self.concurrency.interval,
+                                  self.concurrency.interval)
+                    done, _ = concurrent.futures.wait(in_flight, timeout=timeout,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        self.collect_result(future, in_flight.pop(future))
+                    self.adjust_concurrency(in_flight)
+                    self.update_reservations()
+                    self.check_stalls()
+                elif watcher is not None:
+                    watcher.wait(self.poll_interval)
+                else:
+                    stop_event.wait(self.poll_interval)
+
+                if stop_event is not None and stop_event.is_set():
+                    # Let the running encodes finish but do not start new ones
+                    queue = []
+                    continue
+
+                new_jobs = self.find_sequences()
+                for job in new_jobs:
+                    heapq.heappush(queue, job)
+                if new_jobs:
+                    self.log_plan(queue, in_flight)
+
+        self.status.set_queue(queued=0, running=0, limit=self.concurrency.limit)
+        self.status.publish(force=True)
+        succeeded = [seq for seq, record in self.results.items() if record['status'] == 'success']
+        failed = [seq for seq, record in self.results.items() if record['status'] == 'failed']
+        log(self.logfile, f"Rawcooked finished: {len(succeeded)} succeeded, {len(failed)} failed")
+        for seq in failed:
+            log(self.logfile, f"FAILED: {seq}: {self.results[seq].get('error')}")
 
     def execute(self):
         try:
             self.process()
-            self.run_rawcooked(DPX_TO_COOK_V2_PATH, True)
-            self.run_rawcooked(DPX_TO_COOK_PATH, False)
+            self.run_rawcooked()
             log(self.logfile, "============= DPX RAWcook script END =============")
         except Exception as e:
             print(f"Error: {e}")
             raise RuntimeError("Workflow execution failed for rawcooked")
+        finally:
+            self.metrics.flush()
 
 
 if __name__ == '__main__':
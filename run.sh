@@ -1,5 +1,10 @@
 #!/bin/bash
 
+# Run as a long-running service where the three stages overlap
+if [ "$1" = "--daemon" ]; then
+    echo "Running dpx_pipeline.py..."
+    exec python3 dpx_pipeline.py
+fi
 
 # Run assessment
 echo "Running dpx_assessment.py..."
@@ -0,0 +1,125 @@
+import os
+import threading
+
+# MKV bytes per DPX byte assumed until enough encodes have been measured. RAWcooked's FFV1 output is typically between
+# a half and three quarters of the DPX size
+DEFAULT_RATIO = 0.65
+# Predictions are inflated by this factor, as sequences differ in how well they compress
+MARGIN = 1.15
+# Space kept free on the output volume on top of the reservations
+MIN_FREE_BYTES = 20 * 1024 ** 3
+# Number of past encodes the ratio is learned from
+SAMPLES = 50
+# Fraction of its source an encode has to have read before its partial output is trusted over the learned ratio
+MIN_PROGRESS = 0.05
+
+
+def free_bytes(path: str) -> int:
+    """Returns the bytes available to unprivileged users on the volume of path"""
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def current_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class SpaceAdmission:
+    """Reserves the predicted output size of each encode against the free space of the output volume
+
+    The output size is predicted from the source bytes with a compression ratio learned from past encodes, the total
+    output bytes over the total source bytes of the last SAMPLES of them. A job is admitted when its prediction, the
+    part of the running reservations not written yet and min_free bytes all fit in the free space reported by statvfs.
+    While an encode runs, its reservation is re-estimated from the partial output and the fraction of the source read
+    so far.
+    """
+
+    def __init__(self, output_dir: str, ratio: float = DEFAULT_RATIO, margin: float = MARGIN,
+                 min_free: int = MIN_FREE_BYTES, samples=()):
+        self.output_dir = output_dir
+        self.default_ratio = ratio
+        self.margin = margin
+        self.min_free = min_free
+        self.lock = threading.Lock()
+        # (source bytes, output bytes) of the last encodes, oldest first
+        self.samples = list(samples)[-SAMPLES:]
+        # key -> {'source', 'predicted', 'path'}
+        self.reservations = {}
+
+    @property
+    def ratio(self) -> float:
+        with self.lock:
+            source = sum(sample[0] for sample in self.samples)
+            output = sum(sample[1] for sample in self.samples)
+        return output / source if source else self.default_ratio
+
+    def predict(self, source_bytes: int) -> int:
+        return int(source_bytes * self.ratio * self.margin)
+
+    def learn(self, source_bytes: int, output_bytes: int) -> None:
+        if source_bytes and output_bytes:
+            with self.lock:
+                self.samples.append((source_bytes, output_bytes))
+                del self.samples[:-SAMPLES]
+
+    def outstanding(self) -> int:
+        """Returns the bytes the running encodes are still expected to write"""
+        with self.lock:
+            reservations = list(self.reservations.values())
+        return sum(max(0, reservation['predicted'] - current_size(reservation['path'])) for reservation in reservations)
+
+    def admit(self, key: str, source_bytes: int, output_path: str):
+        """Reserves space for an encode, returns (admitted, needed bytes, available bytes)
+
+        The available bytes are the free space less the outstanding reservations and min_free.
+        """
+        needed = self.predict(source_bytes)
+        available = free_bytes(self.output_dir) - self.outstanding() - self.min_free
+        if needed > available:
+            return False, needed, available
+        with self.lock:
+            self.reservations[key] = {'source': source_bytes, 'predicted': needed, 'path': output_path}
+        return True, needed, available
+
+    def update(self, key: str, source_read: int) -> None:
+        """Re-estimates the output of a running encode from its partial output and the source bytes read so far"""
+        with self.lock:
+            reservation = self.reservations.get(key)
+        if reservation is None or not reservation['source']:
+            return
+        progress = min(1.0, source_read / reservation['source'])
+        if progress < MIN_PROGRESS:
+            return
+        written = current_size(reservation['path'])
+        estimate = int(written / progress * (1 + (self.margin - 1) * (1 - progress)))
+        with self.lock:
+            reservation['predicted'] = max(written, estimate)
+
+    def release(self, key: str, output_bytes: int = None) -> None:
+        """Drops the reservation of a finished encode, learning from its output when it succeeded"""
+        with self.lock:
+            reservation = self.reservations.pop(key, None)
+        if reservation is not None and output_bytes:
+            self.learn(reservation['source'], output_bytes)
+
+    def reserved(self) -> int:
+        with self.lock:
+            return sum(reservation['predicted'] for reservation in self.reservations.values())
+
+
+def open_admission(output_dir: str, journal=None):
+    """Returns the admission control of the encodes writing to output_dir, or None when RAWCOOK_ADMISSION=0
+
+    The ratio is learned from the encodes recorded in the journal. RAWCOOK_COMPRESSION_RATIO sets the ratio used
+    before any is known, RAWCOOK_SIZE_MARGIN the safety factor and RAWCOOK_MIN_FREE_GB the space always kept free.
+    """
+    if os.environ.get('RAWCOOK_ADMISSION', '1') != '1':
+        return None
+    samples = journal.compression_samples(SAMPLES) if journal is not None else ()
+    return SpaceAdmission(output_dir, float(os.environ.get('RAWCOOK_COMPRESSION_RATIO', DEFAULT_RATIO)),
+                          float(os.environ.get('RAWCOOK_SIZE_MARGIN', MARGIN)),
+                          int(float(os.environ.get('RAWCOOK_MIN_FREE_GB', MIN_FREE_BYTES / 1024 ** 3)) * 1024 ** 3),
+                          samples)
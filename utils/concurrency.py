@@ -0,0 +1,135 @@
+import time
+
+# Fraction of the CPU time above which more encodes cannot go faster
+CPU_SATURATED = 0.92
+# Relative difference in throughput below which two worker counts are considered equal
+TOLERANCE = 0.05
+# Measurements older than this many sample intervals are forgotten, so the controller probes again when the load or
+# the storage changes
+MEMORY_INTERVALS = 10
+
+
+def read_cpu_times():
+    """Returns (busy, iowait, total) jiffies of all the CPUs from /proc/stat"""
+    with open('/proc/stat') as file:
+        fields = [int(value) for value in file.readline().split()[1:]]
+    idle = fields[3]
+    iowait = fields[4] if len(fields) > 4 else 0
+    total = sum(fields[:8])
+    return total - idle - iowait, iowait, total
+
+
+def read_process_bytes(pid: int):
+    """Returns the bytes read by a process (rchar, which includes network file systems), or None if it is gone"""
+    try:
+        with open(f'/proc/{pid}/io') as file:
+            for line in file:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+class ResourceSampler:
+    """Samples CPU utilisation and the read rate of a set of processes between two calls to sample()"""
+
+    def __init__(self):
+        self.last_cpu = None
+        self.last_time = None
+        self.last_bytes = {}
+
+    def sample(self, pids) -> dict:
+        """Returns {'cpu', 'iowait', 'seconds', 'read_bytes': {pid: bytes read since the last sample}}"""
+        now = time.monotonic()
+        try:
+            cpu = read_cpu_times()
+        except (OSError, ValueError, IndexError):
+            cpu = None
+
+        read_bytes = {}
+        current = {}
+        for pid in pids:
+            value = read_process_bytes(pid)
+            if value is None:
+                continue
+            current[pid] = value
+            # A process seen for the first time only counts from now on
+            read_bytes[pid] = value - self.last_bytes.get(pid, value)
+
+        result = {'cpu': None, 'iowait': None, 'seconds': now - self.last_time if self.last_time else 0.0,
+                  'read_bytes': read_bytes}
+        if cpu and self.last_cpu:
+            total = cpu[2] - self.last_cpu[2]
+            if total > 0:
+                result['cpu'] = (cpu[0] - self.last_cpu[0]) / total
+                result['iowait'] = (cpu[1] - self.last_cpu[1]) / total
+        self.last_cpu = cpu
+        self.last_time = now
+        self.last_bytes = current
+        return result
+
+
+class ConcurrencyController:
+    """Hill-climbs the number of concurrent jobs towards the highest aggregate throughput
+
+    observe() is given the number of jobs running and the throughput measured over the last interval. The throughput
+    of each job count is kept as a moving average, and the limit moves one step at a time:
+        - down when one job less did better (the storage is thrashing) or the CPU is saturated and one job less did
+          as well,
+        - up, within the ceiling, when the next job count is unknown or did better and the CPU is not saturated,
+        - otherwise it stays.
+    Measurements are only taken into account once the jobs running match the limit, and the first interval after
+    the job count changed is skipped while the new job ramps up.
+    """
+
+    def __init__(self, initial: int, floor: int = 1, ceiling: int = None, interval: float = 30.0):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling or initial)
+        self.limit = min(max(initial, self.floor), self.ceiling)
+        self.interval = interval
+        # job count -> (moving average of the throughput, time of the last measurement)
+        self.throughput = {}
+        self.last_running = None
+
+    def _known(self, level: int, now: float):
+        entry = self.throughput.get(level)
+        if entry is None or now - entry[1] > self.interval * MEMORY_INTERVALS:
+            return None
+        return entry[0]
+
+    def observe(self, running: int, throughput: float, cpu: float = None, now: float = None):
+        """Records a measurement and returns (new limit, reason) when the limit changes, else None"""
+        now = time.monotonic() if now is None else now
+        settled = running == self.last_running
+        self.last_running = running
+        if not settled or running == 0:
+            return None
+
+        previous = self._known(running, now)
+        average = throughput if previous is None else (previous + throughput) / 2
+        self.throughput[running] = (average, now)
+        if running != self.limit:
+            return None
+
+        current = average
+        lower = self._known(self.limit - 1, now) if self.limit > self.floor else None
+        upper = self._known(self.limit + 1, now) if self.limit < self.ceiling else None
+        cpu_saturated = cpu is not None and cpu >= CPU_SATURATED
+
+        if lower is not None and lower > current * (1 + TOLERANCE):
+            return self._set(self.limit - 1, f"{self.limit - 1} jobs did {lower:.1f}/s, {self.limit} do "
+                                             f"{current:.1f}/s")
+        if cpu_saturated:
+            if lower is not None and lower >= current * (1 - TOLERANCE):
+                return self._set(self.limit - 1, f"CPU saturated ({cpu:.0%}) and {self.limit - 1} jobs did as well")
+            return None
+        if self.limit < self.ceiling and (upper is None or upper > current * (1 + TOLERANCE)):
+            reason = "probing" if upper is None else f"{self.limit + 1} jobs did {upper:.1f}/s"
+            return self._set(self.limit + 1, f"{reason}, {self.limit} do {current:.1f}/s"
+                                             f"{'' if cpu is None else f', CPU {cpu:.0%}'}")
+        return None
+
+    def _set(self, limit: int, reason: str):
+        self.limit = limit
+        return limit, reason
@@ -0,0 +1,73 @@
+import heapq
+import os
+import time
+
+from utils.dpx_header import read_dpx_header
+from utils.sequence_index import load_cached_index
+
+
+def estimate_sequence_cost(seq_path: str, read_headers: bool = False, index_cache_dir: str = None) -> dict:
+    """Estimates the amount of work needed to cook a sequence folder
+
+    Counts the .dpx files at any depth of the folder. By default the cost is the sum of the frame sizes from a stat
+    pass. With read_headers the frame size comes from the file size field of the first DPX header instead, so only
+    one file is opened and no file is stat'ed, which is much cheaper on NAS mounts. Folders with a valid cached
+    sequence index are not listed at all.
+    """
+    frames = 0
+    total_bytes = 0
+    first_dpx = None
+    folders = [seq_path]
+    while folders:
+        folder = folders.pop()
+        index = load_cached_index(folder, index_cache_dir) if index_cache_dir else None
+        if index is not None and index.frame_count:
+            frames += index.frame_count
+            total_bytes += index.byte_total
+            first_dpx = first_dpx or index.paths()[0]
+            continue
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    folders.append(entry.path)
+                elif entry.name.endswith('.dpx'):
+                    frames += 1
+                    if first_dpx is None:
+                        first_dpx = entry.path
+                    if not read_headers:
+                        total_bytes += entry.stat().st_size
+
+    estimate = {'frames': frames, 'bytes': total_bytes, 'width': None, 'height': None}
+    if read_headers and first_dpx and not total_bytes:
+        header = read_dpx_header(first_dpx)
+        frame_bytes = header.file_size or os.path.getsize(first_dpx)
+        estimate.update(bytes=frames * frame_bytes, width=header.width, height=header.height)
+    return estimate
+
+
+def plan_jobs(costs: dict, workers: int, busy=()):
+    """Orders jobs longest-first and packs them onto workers (LPT scheduling)
+
+    Jobs are handed to the least loaded worker in decreasing order of cost, which is what the cook scheduler does
+    when it starts the next queued job on whichever worker frees up first. busy holds the remaining cost of the jobs
+    already running, one per occupied worker.
+    Returns (ordered job keys, list of per-worker job lists, makespan in cost units)
+    """
+    order = sorted(costs, key=lambda key: costs[key], reverse=True)
+    remaining = sorted(busy, reverse=True)
+    loads = [(remaining[worker] if worker < len(remaining) else 0, worker)
+             for worker in range(max(1, workers, len(remaining)))]
+    heapq.heapify(loads)
+    bins = [[] for _ in loads]
+    for key in order:
+        load, worker = heapq.heappop(loads)
+        bins[worker].append(key)
+        heapq.heappush(loads, (load + costs[key], worker))
+    makespan = max(load for load, _ in loads)
+    return order, bins, makespan
+
+
+def predict_finish(makespan_bytes: float, job_bytes_per_second: float, start=None) -> float:
+    """Returns the predicted finish timestamp of a plan, given the read throughput of a single job"""
+    start = time.time() if start is None else start
+    return start + makespan_bytes / max(job_bytes_per_second, 1)
@@ -0,0 +1,176 @@
+import os
+import struct
+from collections import namedtuple
+
+from utils.mediaconch_policy import UNSUPPORTED
+
+# The generic (768 bytes) and image (640 bytes) headers both fit in the first 2048 bytes of a DPX file
+DPX_HEADER_SIZE = 2048
+DPX_MAGIC_BIG = b'SDPX'
+DPX_MAGIC_LITTLE = b'XPDS'
+
+# MediaInfo names used by mediaconch policies for the SMPTE 268M enumerations
+DESCRIPTORS = {
+    1: 'R', 2: 'G', 3: 'B', 4: 'A', 6: 'Y', 7: 'CbCr', 8: 'Z', 9: 'Composite',
+    50: 'RGB', 51: 'RGBA', 52: 'ABGR', 100: 'YUV', 101: 'YUVA', 102: 'YUV', 103: 'YUVA',
+}
+TRANSFER_CHARACTERISTICS = {
+    0: 'User-defined', 1: 'Printing density', 2: 'Linear', 3: 'Logarithmic', 4: 'Unspecified video',
+    5: 'SMPTE 274M', 6: 'BT.709', 7: 'BT.601 (625)', 8: 'BT.601 (525)', 9: 'Composite NTSC',
+    10: 'Composite PAL', 11: 'Z (depth) - linear', 12: 'Z (depth) - homogeneous',
+}
+# The colorimetric specification shares the codes of the transfer characteristic, without linear, logarithmic and depth
+COLOUR_PRIMARIES = {
+    0: 'User-defined', 1: 'Printing density', 4: 'Unspecified video', 5: 'SMPTE 274M', 6: 'BT.709',
+    7: 'BT.601 (625)', 8: 'BT.601 (525)', 9: 'Composite NTSC', 10: 'Composite PAL',
+}
+PACKINGS = {0: 'Packed', 1: 'Filled A', 2: 'Filled B'}
+# Image data encodings: none or run length, both lossless
+COMPRESSIONS = {0: None, 1: 'RLE'}
+# MediaInfo track types, a DPX file only has the General and Image ones
+TRACK_TYPES = ('General', 'Video', 'Audio', 'Text', 'Other', 'Image', 'Menu')
+# Number of components per pixel for each descriptor
+COMPONENTS = {1: 1, 2: 1, 3: 1, 4: 1, 6: 1, 7: 2, 8: 1, 9: 1, 50: 3, 51: 4, 52: 4, 100: 2, 101: 3, 102: 3, 103: 4}
+# Value of the padding fields when they are not defined
+UNDEFINED_U32 = 0xFFFFFFFF
+
+DpxHeader = namedtuple('DpxHeader', [
+    'endianness', 'version', 'image_offset', 'file_size', 'user_data_size', 'width', 'height', 'element_count',
+    'descriptor', 'transfer', 'colorimetric', 'bit_depth', 'packing', 'encoding', 'data_offset',
+    'eol_padding', 'eoi_padding',
+])
+
+
+def parse_dpx_header(buffer) -> DpxHeader:
+    """Parses the generic and image headers from the first 2048 bytes of a DPX file"""
+    if len(buffer) < DPX_HEADER_SIZE:
+        raise ValueError("Truncated DPX header")
+
+    magic = bytes(buffer[0:4])
+    if magic == DPX_MAGIC_BIG:
+        endian = '>'
+    elif magic == DPX_MAGIC_LITTLE:
+        endian = '<'
+    else:
+        raise ValueError(f"Not a DPX file (magic {magic!r})")
+
+    image_offset, = struct.unpack_from(endian + 'I', buffer, 4)
+    version = bytes(buffer[8:16]).split(b'\0', 1)[0].decode('ascii', 'replace')
+    file_size, = struct.unpack_from(endian + 'I', buffer, 16)
+    user_data_size, = struct.unpack_from(endian + 'I', buffer, 32)
+    _, element_count, width, height = struct.unpack_from(endian + 'HHII', buffer, 768)
+    # First image element, which is the only one rawcooked supports
+    (descriptor, transfer, colorimetric, bit_depth, packing, encoding, data_offset, eol_padding,
+     eoi_padding) = struct.unpack_from(endian + 'BBBBHHIII', buffer, 800)
+
+    return DpxHeader(
+        endianness='Big' if endian == '>' else 'Little',
+        version=version,
+        image_offset=image_offset,
+        file_size=file_size,
+        user_data_size=user_data_size,
+        width=width,
+        height=height,
+        element_count=element_count,
+        descriptor=descriptor,
+        transfer=transfer,
+        colorimetric=colorimetric,
+        bit_depth=bit_depth,
+        packing=packing,
+        encoding=encoding,
+        data_offset=data_offset,
+        eol_padding=eol_padding,
+        eoi_padding=eoi_padding,
+    )
+
+
+def expected_image_size(header: DpxHeader):
+    """Returns the size in bytes of the image data described by the header, or None if it cannot be computed"""
+    components = COMPONENTS.get(header.descriptor)
+    if not components or header.bit_depth not in (1, 8, 10, 12, 16, 32, 64) or header.encoding != 0:
+        return None
+
+    samples_per_line = header.width * components
+    if header.packing == 0 or header.bit_depth > 32:
+        words_per_line = -(-samples_per_line * header.bit_depth // 32)
+    else:
+        words_per_line = -(-samples_per_line // (32 // header.bit_depth))
+    eol_padding = 0 if header.eol_padding == UNDEFINED_U32 else header.eol_padding
+    eoi_padding = 0 if header.eoi_padding == UNDEFINED_U32 else header.eoi_padding
+    return (words_per_line * 4 + eol_padding) * header.height + eoi_padding
+
+
+def read_dpx_header(dpx_path: str) -> DpxHeader:
+    """Reads only the header block of a DPX file"""
+    fd = os.open(dpx_path, os.O_RDONLY)
+    try:
+        return parse_dpx_header(os.pread(fd, DPX_HEADER_SIZE, 0))
+    finally:
+        os.close(fd)
+
+
+def header_field_lookup(header: DpxHeader):
+    """Returns a lookup(tracktype, field) exposing a header with the MediaInfo field names used in policies
+
+    Fields of the other track types do not exist in a DPX file, so comparisons against them fail. Fields the header
+    does not define and values outside the SMPTE 268M enumerations are UNSUPPORTED and left to mediaconch.
+    """
+    version = header.version.lstrip('Vv')
+    general = {
+        'Format': 'DPX',
+        'Format_Version': version,
+    }
+    image = {
+        'Format': 'DPX',
+        'Format_Version': version,
+        'Format_Settings_Endianness': header.endianness,
+        'Format_Settings_Packing': PACKINGS.get(header.packing, UNSUPPORTED),
+        'Width': header.width,
+        'Height': header.height,
+        'BitDepth': header.bit_depth,
+        'ColorSpace': DESCRIPTORS.get(header.descriptor, UNSUPPORTED),
+        'transfer_characteristics': TRANSFER_CHARACTERISTICS.get(header.transfer, UNSUPPORTED),
+        'colour_primaries': COLOUR_PRIMARIES.get(header.colorimetric, UNSUPPORTED),
+        'Format_Compression': COMPRESSIONS.get(header.encoding, UNSUPPORTED),
+        'Compression_Mode': 'Lossless' if header.encoding in COMPRESSIONS else UNSUPPORTED,
+    }
+
+    def lookup(tracktype, field):
+        if tracktype == 'General':
+            return general.get(field, UNSUPPORTED)
+        if tracktype == 'Image':
+            return image.get(field, UNSUPPORTED)
+        return None if tracktype in TRACK_TYPES else UNSUPPORTED
+
+    return lookup
+
+
+def check_dpx_sequence(policy, dpx_paths):
+    """Checks the header of every DPX file against a compiled mediaconch policy
+
+    Headers are evaluated once per distinct header, as a sequence is normally uniform.
+    Returns a tuple (failures, unresolved) where failures is a list of (path, reasons) for frames that break the
+    policy and unresolved maps each header whose verdict depends on rules the reader cannot check to the first
+    file carrying it, so the caller can confirm those with mediaconch.
+    """
+    verdicts = {}
+    failures = []
+    unresolved = {}
+    for dpx_path in dpx_paths:
+        try:
+            header = read_dpx_header(dpx_path)
+        except (OSError, ValueError) as e:
+            failures.append((dpx_path, [str(e)]))
+            continue
+
+        if header not in verdicts:
+            reasons = []
+            verdicts[header] = (policy.evaluate(header_field_lookup(header), reasons), reasons)
+        verdict, reasons = verdicts[header]
+
+        if verdict is False:
+            failures.append((dpx_path, reasons))
+        elif verdict is None and header not in unresolved:
+            unresolved[header] = dpx_path
+
+    return failures, unresolved
@@ -0,0 +1,101 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import threading
+import time
+
+from utils.state_journal import directory_signature, scan_sequence
+
+# inotify event masks from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class FolderWatcher:
+    """Waits for entries to appear in or leave a set of folders
+
+    Uses inotify when the C library provides it. inotify does not see changes made by other machines on network
+    mounts, so wait() also returns after the poll interval and callers rescan their folders either way. Without
+    inotify the watcher only polls.
+    """
+
+    def __init__(self, folders, poll_interval: float = 30):
+        self.folders = list(folders)
+        self.poll_interval = poll_interval
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            for folder in self.folders:
+                if libc.inotify_add_watch(fd, os.fsencode(folder), WATCH_MASK) < 0:
+                    os.close(fd)
+                    raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder}")
+            self.fd = fd
+        except (OSError, AttributeError, TypeError) as e:
+            print(f"inotify unavailable, polling every {poll_interval}s: {e}")
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self.fd is not None
+
+    def wait(self, timeout: float = None) -> bool:
+        """Blocks until a watched folder changes or the timeout (default: poll interval) elapses
+
+        Returns True if a change was reported by inotify
+        """
+        timeout = self.poll_interval if timeout is None else timeout
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # Drain every queued event, the caller rescans the folders anyway
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SettleTracker:
+    """Decides when a sequence folder has stopped changing, so partially copied sequences are not picked up
+
+    A folder is settled once its directory signature and byte total stayed the same for settle_seconds.
+    """
+
+    def __init__(self, settle_seconds: float = 60):
+        self.settle_seconds = settle_seconds
+        self.lock = threading.Lock()
+        # path -> (signature, first time it was seen with that signature)
+        self.seen = {}
+
+    def is_settled(self, path: str) -> bool:
+        try:
+            signature = (directory_signature(path), scan_sequence(path))
+        except OSError:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            previous = self.seen.get(path)
+            if previous is None or previous[0] != signature:
+                self.seen[path] = (signature, now)
+                return self.settle_seconds <= 0
+            return now - previous[1] >= self.settle_seconds
+
+    def forget(self, path: str) -> None:
+        with self.lock:
+            self.seen.pop(path, None)
@@ -0,0 +1,146 @@
+import array
+import concurrent.futures
+import os
+import threading
+from fractions import Fraction
+
+from utils.process_runner import run_command
+
+# Frames decoded by a single ffmpeg process, the unit of parallelism within one MKV
+CHUNK_FRAMES = 1000
+DIGEST_SIZE = 16
+
+
+class FrameMd5:
+    """Per-frame MD5 digests of the first video stream of a .framemd5 file
+
+    Digests are kept packed in a single bytearray and timestamps in an array, so a sequence of a few hundred thousand
+    frames only takes a few megabytes.
+    """
+
+    def __init__(self, time_base, pts, durations, digests):
+        self.time_base = time_base
+        self.pts = pts
+        self.durations = durations
+        self.digests = digests
+
+    def __len__(self):
+        return len(self.pts)
+
+    def digest(self, frame: int) -> bytes:
+        return bytes(self.digests[frame * DIGEST_SIZE:(frame + 1) * DIGEST_SIZE])
+
+    def seek_seconds(self, frame: int) -> float:
+        """Returns a seek time half a frame before a frame, so rounded container timestamps still land on it"""
+        return float((self.pts[frame] - Fraction(self.durations[frame], 2)) * self.time_base)
+
+
+def read_framemd5(path: str, stream: int = 0) -> FrameMd5:
+    """Reads the frame digests of one stream from a framemd5 file written by ffmpeg or rawcooked"""
+    time_base = Fraction(1, 1)
+    pts = array.array('q')
+    durations = array.array('q')
+    digests = bytearray()
+    with open(path, 'r') as file:
+        for line in file:
+            if line.startswith(f"#tb {stream}:"):
+                time_base = Fraction(line.split(':', 1)[1].strip())
+                continue
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = [field.strip() for field in line.split(',')]
+            if int(fields[0]) != stream:
+                continue
+            pts.append(int(fields[2]))
+            durations.append(int(fields[3]))
+            digests.extend(bytes.fromhex(fields[-1]))
+    return FrameMd5(time_base, pts, durations, digests)
+
+
+class _Mismatch(Exception):
+    pass
+
+
+def verify_chunk(mkv_path: str, reference: FrameMd5, start: int, count: int, cancel: threading.Event = None):
+    """Decodes count frames of an MKV from frame start and compares their MD5 against the reference
+
+    ffmpeg hashes the decoded frames itself and only its framemd5 text output is read, line by line, so no decoded
+    frame is written to disk or held in memory. The last chunk asks for one extra frame to catch MKVs longer than
+    the source. Returns (frames checked, error or None).
+    """
+    if cancel is not None and cancel.is_set():
+        return 0, None
+    last = start + count >= len(reference)
+    command = ['ffmpeg', '-nostdin', '-hide_banner', '-v', 'error', '-threads', '1']
+    if start:
+        command += ['-ss', f"{reference.seek_seconds(start):.6f}"]
+    command += ['-i', mkv_path, '-map', '0:v:0', '-frames:v', str(count + 1 if last else count), '-f', 'framemd5',
+                '-']
+
+    checked = 0
+
+    def compare(name, line):
+        nonlocal checked
+        if name != 'stdout' or line.startswith('#') or not line.strip():
+            return
+        frame = start + checked
+        if frame >= len(reference):
+            raise _Mismatch(f"MKV has more frames than the {len(reference)} of the source")
+        digest = line.rsplit(',', 1)[-1].strip()
+        if bytes.fromhex(digest) != reference.digest(frame):
+            raise _Mismatch(f"frame {frame}: expected {reference.digest(frame).hex()}, decoded {digest}")
+        checked += 1
+
+    try:
+        # Raising from the callback kills ffmpeg straight away
+        result = run_command(command, line_callback=compare, tail_lines=20)
+    except _Mismatch as e:
+        return checked, str(e)
+    if result.returncode != 0:
+        errors = [line for line in result.tail if line.strip()]
+        return checked, f"ffmpeg exited with code {result.returncode}: {errors[-1] if errors else ''}"
+    if checked < count:
+        return checked, f"MKV ended at frame {start + checked}, the source has {len(reference)} frames"
+    return checked, None
+
+
+def verify_files(pairs: dict, max_workers: int = None, chunk_frames: int = CHUNK_FRAMES) -> dict:
+    """Verifies MKVs against their source framemd5 files, {mkv path: framemd5 path}
+
+    Every MKV is split into chunks of chunk_frames frames and the chunks of all the files share one pool, so a single
+    long MKV is decoded by several ffmpeg processes at once. The first mismatch of an MKV cancels its pending chunks.
+    Returns {mkv path: (frames checked, list of errors)}, with an empty list for a bit-exact MKV.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    results = {}
+    futures = {}
+    cancels = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for mkv_path, framemd5_path in pairs.items():
+            results[mkv_path] = [0, []]
+            try:
+                reference = read_framemd5(framemd5_path)
+            except (OSError, ValueError, IndexError) as e:
+                results[mkv_path][1].append(f"Unreadable framemd5 {framemd5_path}: {e}")
+                continue
+            if not len(reference):
+                results[mkv_path][1].append(f"No frames in {framemd5_path}")
+                continue
+            cancels[mkv_path] = threading.Event()
+            for start in range(0, len(reference), chunk_frames):
+                count = min(chunk_frames, len(reference) - start)
+                future = executor.submit(verify_chunk, mkv_path, reference, start, count, cancels[mkv_path])
+                futures[future] = mkv_path
+
+        for future in concurrent.futures.as_completed(futures):
+            mkv_path = futures[future]
+            try:
+                checked, error = future.result()
+            except Exception as e:
+                checked, error = 0, str(e)
+            results[mkv_path][0] += checked
+            if error:
+                results[mkv_path][1].append(error)
+                cancels[mkv_path].set()
+
+    return {mkv_path: (checked, errors) for mkv_path, (checked, errors) in results.items()}
@@ -0,0 +1,163 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+from utils.result_cache import find_indexes
+
+# Frames and MiB read ahead from the head of the next sequence in the queue, and whether the frames of a sequence are
+# dropped from the page cache once it is cooked
+PREFETCH_FRAMES = 64
+PREFETCH_MB = 1024
+EVICT = True
+
+SUPPORTED = hasattr(os, 'posix_fadvise')
+
+
+def advise(path: str, advice: int, length: int = 0) -> bool:
+    """Gives the kernel an access hint for the first length bytes of a file (all of it with 0)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.posix_fadvise(fd, 0, length, advice)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def parse_tiers(text: str) -> list:
+    """Parses IO_HINTS_TIERS, '<path>:prefetch_frames=N,prefetch_mb=N,evict=0|1;<path>:...'
+
+    Returns (path, settings) pairs, longest path first so the most specific tier wins.
+    """
+    tiers = []
+    for part in filter(None, (part.strip() for part in text.split(';'))):
+        path, _, options = part.rpartition(':')
+        if not path:
+            raise ValueError(f"IO_HINTS_TIERS entry '{part}' has no path")
+        settings = {}
+        for option in filter(None, options.split(',')):
+            key, _, value = option.partition('=')
+            if key == 'prefetch_frames':
+                settings[key] = int(value)
+            elif key == 'prefetch_mb':
+                settings[key] = float(value)
+            elif key == 'evict':
+                settings[key] = value == '1'
+            else:
+                raise ValueError(f"Unknown IO_HINTS_TIERS setting '{key}'")
+        tiers.append((os.path.normpath(path), settings))
+    return sorted(tiers, key=lambda tier: len(tier[0]), reverse=True)
+
+
+class IoHints:
+    """Page cache hints around the cook stage
+
+    prefetch() asks the kernel, with posix_fadvise(WILLNEED), to read the head of a queued sequence in the background
+    while the current encodes run, so the next encode does not start on cold storage. evict() drops the frames of a
+    cooked sequence with DONTNEED, so hundreds of GB read once do not push out the next sequences and the MKVs
+    post-rawcook is about to check. The settings can differ per storage tier, matched by path prefix.
+    """
+
+    def __init__(self, defaults: dict, tiers=(), index_cache_dir: str = None, metrics=None):
+        self.defaults = defaults
+        self.tiers = list(tiers)
+        self.index_cache_dir = index_cache_dir
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.prefetched = set()
+        # A single thread, the hints are cheap but opening thousands of files on a NAS is not
+        self.executor = None
+
+    def settings(self, path: str) -> dict:
+        path = os.path.normpath(path)
+        for prefix, settings in self.tiers:
+            if path == prefix or path.startswith(prefix + os.sep):
+                return {**self.defaults, **settings}
+        return self.defaults
+
+    def frames(self, seq_path: str):
+        """Yields (path, size) of the frames of a sequence in order"""
+        for index in find_indexes(seq_path, self.index_cache_dir):
+            for name, size in zip(index.names, index.sizes):
+                yield os.path.join(index.folder, name), int(size)
+
+    def prefetch(self, seq_path: str) -> None:
+        """Reads the head of a sequence into the page cache in the background, once per sequence"""
+        settings = self.settings(seq_path)
+        if settings['prefetch_frames'] <= 0 or settings['prefetch_mb'] <= 0:
+            return
+        with self.lock:
+            if seq_path in self.prefetched:
+                return
+            self.prefetched.add(seq_path)
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='io-hints')
+            executor = self.executor
+        executor.submit(self._prefetch, seq_path, settings)
+
+    def _prefetch(self, seq_path: str, settings: dict) -> None:
+        start = time.perf_counter()
+        frames = 0
+        byte_total = 0
+        limit = settings['prefetch_mb'] * 1024 ** 2
+        try:
+            for path, size in self.frames(seq_path):
+                if frames >= settings['prefetch_frames'] or byte_total + size > limit:
+                    break
+                if advise(path, os.POSIX_FADV_WILLNEED):
+                    frames += 1
+                    byte_total += size
+        except (OSError, ValueError) as e:
+            print(f"Error prefetching {seq_path}: {e}")
+        self._event('prefetch', seq_path, frames, byte_total, start)
+
+    def evict(self, seq_path: str) -> None:
+        """Drops the frames of a sequence that was cooked from the page cache, in the calling thread"""
+        with self.lock:
+            self.prefetched.discard(seq_path)
+        if not self.settings(seq_path)['evict']:
+            return
+        start = time.perf_counter()
+        frames = 0
+        byte_total = 0
+        try:
+            for path, size in self.frames(seq_path):
+                if advise(path, os.POSIX_FADV_DONTNEED):
+                    frames += 1
+                    byte_total += size
+        except (OSError, ValueError) as e:
+            print(f"Error evicting {seq_path}: {e}")
+        self._event('evict', seq_path, frames, byte_total, start)
+
+    def _event(self, kind: str, seq_path: str, frames: int, byte_total: int, start: float) -> None:
+        if self.metrics is not None:
+            self.metrics.event('io_hint', stage='rawcook', hint=kind, sequence=os.path.basename(seq_path),
+                               frames=frames, bytes=byte_total, seconds=round(time.perf_counter() - start, 3))
+
+    def close(self) -> None:
+        """Waits for the pending prefetches"""
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def open_io_hints(index_cache_dir: str = None, metrics=None):
+    """Returns the page cache hints configured by the environment, or None when IO_HINTS=0 or unsupported
+
+    IO_PREFETCH_FRAMES and IO_PREFETCH_MB bound the read ahead, IO_EVICT=0 keeps cooked frames cached and
+    IO_HINTS_TIERS overrides them per storage path, see parse_tiers.
+    """
+    if os.environ.get('IO_HINTS', '1') != '1' or not SUPPORTED:
+        return None
+    defaults = {
+        'prefetch_frames': int(os.environ.get('IO_PREFETCH_FRAMES', PREFETCH_FRAMES)),
+        'prefetch_mb': float(os.environ.get('IO_PREFETCH_MB', PREFETCH_MB)),
+        'evict': os.environ.get('IO_EVICT', '1' if EVICT else '0') == '1',
+    }
+    return IoHints(defaults, parse_tiers(os.environ.get('IO_HINTS_TIERS', '')), index_cache_dir, metrics)
@@ -0,0 +1,291 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+LEASE_SUFFIX = '.lease'
+BREAK_SUFFIX = '.break'
+# A lease not renewed for TTL seconds belongs to a node that died or lost the shared file system, and can be reclaimed.
+# The clocks of the nodes have to be kept in sync (NTP) for the expiry to be judged the same way on every node
+TTL = 300.0
+HEARTBEAT = 30.0
+
+# An active lease is renewed while its sequence is cooking, a done lease keeps the sequence away from the other nodes
+# until it leaves the cook folders
+ACTIVE = 'active'
+DONE = 'done'
+
+
+def default_node() -> str:
+    return os.environ.get('RAWCOOK_NODE') or socket.gethostname()
+
+
+def pid_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, TypeError):
+        return True
+    return True
+
+
+class LeaseManager:
+    """Claims sequences for one node through lease files in a folder of the shared file system
+
+    A lease is created with O_CREAT | O_EXCL, which is atomic on local file systems and on NFSv3 and later, so a
+    single node wins each sequence. The lease is renewed by touching it every heartbeat seconds from a background
+    thread, and a lease left unrenewed for ttl seconds is removed by the one node holding its .break file before it
+    is created again. A node finding its own lease taken over while it still cooks is told through on_lost, so it can
+    stop its encode.
+    """
+
+    def __init__(self, lease_dir: str, node: str = None, ttl: float = TTL, heartbeat: float = HEARTBEAT):
+        self.lease_dir = lease_dir
+        self.node = node or default_node()
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        os.makedirs(lease_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # name -> content of the leases held by this process
+        self.held = {}
+        self.on_lost = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.lease_dir, f"{name}{LEASE_SUFFIX}")
+
+    def read(self, name: str):
+        """Returns (content, stat) of a lease, or None when there is none. A lease still being written reads as {}"""
+        path = self.path(name)
+        try:
+            stat = os.stat(path)
+            with open(path) as file:
+                text = file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            content = json.loads(text)
+        except ValueError:
+            content = {}
+        return content, stat
+
+    def expired(self, content: dict, stat, now: float = None) -> bool:
+        if content.get('state') == DONE:
+            return False
+        if content.get('node') == self.node and content.get('host') == socket.gethostname() \
+                and content.get('pid') != os.getpid() and not pid_alive(content.get('pid')):
+            # Left by an earlier run of this node
+            return True
+        now = time.time() if now is None else now
+        return now - stat.st_mtime > self.ttl
+
+    def cooking(self, name: str) -> bool:
+        """Returns True while a node holds a live active lease on a sequence"""
+        lease = self.read(name)
+        if lease is None:
+            return False
+        content, stat = lease
+        return content.get('state', ACTIVE) == ACTIVE and time.time() - stat.st_mtime <= self.ttl
+
+    def holder(self, name: str) -> str:
+        """Describes the holder of a lease for the logs"""
+        lease = self.read(name)
+        if lease is None:
+            return "nobody"
+        content, stat = lease
+        return (f"{content.get('node', '?')} ({content.get('state', ACTIVE)}, renewed "
+                f"{time.time() - stat.st_mtime:.0f}s ago)")
+
+    def acquire(self, name: str, **info) -> bool:
+        """Claims a sequence, returns False when another node holds a live lease on it
+
+        Leases this node left done in an earlier run are taken back, as the journal of the node knows what became of
+        the sequence.
+        """
+        path = self.path(name)
+        for _ in range(3):
+            with self.lock:
+                if name in self.held:
+                    return True
+            content = {'node': self.node, 'host': socket.gethostname(), 'pid': os.getpid(),
+                       'token': uuid.uuid4().hex, 'state': ACTIVE, 'acquired': time.time(), **info}
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                lease = self.read(name)
+                if lease is None:
+                    continue
+                current, stat = lease
+                if current.get('node') == self.node and current.get('state') == DONE:
+                    with self.lock:
+                        self.held[name] = current
+                    self._write(name, dict(current, state=ACTIVE, pid=os.getpid()))
+                    return True
+                if not self.expired(current, stat):
+                    return False
+                self._break(path, stat)
+                continue
+            with os.fdopen(fd, 'w') as file:
+                json.dump(content, file)
+                file.flush()
+                os.fsync(file.fileno())
+            with self.lock:
+                self.held[name] = content
+            return True
+        return False
+
+    def _break(self, path: str, stat) -> None:
+        """Removes an expired lease, unless it was renewed or replaced since it was read
+
+        Breaking is serialised by a .break file created with O_EXCL, so a single node checks the lease again and
+        removes it, and a lease another node created in the meantime is never removed. A .break file left by a node
+        that died while breaking expires like a lease.
+        """
+        break_path = f"{path}{BREAK_SUFFIX}"
+        try:
+            fd = os.open(break_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(break_path).st_mtime > self.ttl:
+                    os.remove(break_path)
+            except FileNotFoundError:
+                pass
+            return
+        os.close(fd)
+        try:
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                return
+            if (current.st_ino, current.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns):
+                os.remove(path)
+        finally:
+            os.remove(break_path)
+
+    def _write(self, name: str, content: dict) -> None:
+        """Replaces the content of a held lease atomically"""
+        path = self.path(name)
+        temp_path = f"{path}.{content['token']}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(content, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        with self.lock:
+            self.held[name] = content
+
+    def owns(self, name: str) -> bool:
+        """Checks that the lease file still carries the token of this process"""
+        with self.lock:
+            content = self.held.get(name)
+        lease = self.read(name)
+        return content is not None and lease is not None and lease[0].get('token') == content['token']
+
+    def mark_done(self, name: str) -> None:
+        """Keeps the claim on a sequence that was cooked, or could not be moved out, without renewing it"""
+        with self.lock:
+            content = self.held.get(name)
+        if content is not None and self.owns(name):
+            self._write(name, dict(content, state=DONE, finished=time.time()))
+
+    def release(self, name: str) -> None:
+        """Gives a sequence back, once it has left the cook folders"""
+        with self.lock:
+            content = self.held.pop(name, None)
+        lease = self.read(name)
+        if content is not None and lease is not None and lease[0].get('token') == content['token']:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+    def renew(self) -> list:
+        """Touches the active leases held and returns the names of those taken over by another node"""
+        with self.lock:
+            held = [(name, content) for name, content in self.held.items() if content['state'] == ACTIVE]
+        lost = []
+        for name, content in held:
+            lease = self.read(name)
+            if lease is None or lease[0].get('token') != content['token']:
+                lost.append(name)
+                with self.lock:
+                    self.held.pop(name, None)
+                continue
+            try:
+                os.utime(self.path(name))
+            except FileNotFoundError:
+                lost.append(name)
+                with self.lock:
+                    self.held.pop(name, None)
+        return lost
+
+    def prune(self, present: set, before: float) -> list:
+        """Removes the done and expired leases of sequences no longer in the cook folders
+
+        Only leases renewed before the folders were listed are considered, so a sequence that arrived and was claimed
+        after the listing keeps its lease. Returns the names removed.
+        """
+        removed = []
+        now = time.time()
+        with os.scandir(self.lease_dir) as entries:
+            names = [entry.name[:-len(LEASE_SUFFIX)] for entry in entries if entry.name.endswith(LEASE_SUFFIX)]
+        for name in names:
+            if name in present:
+                continue
+            lease = self.read(name)
+            if lease is None:
+                continue
+            content, stat = lease
+            if stat.st_mtime >= before or (content.get('state') != DONE and not self.expired(content, stat, now)):
+                continue
+            with self.lock:
+                self.held.pop(name, None)
+            try:
+                os.remove(self.path(name))
+                removed.append(name)
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def start(self, on_lost=None) -> None:
+        """Starts renewing the active leases in a background thread, calling on_lost(name) for each lease lost"""
+        self.on_lost = on_lost
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._renew_loop, name='lease-heartbeat', daemon=True)
+        self.thread.start()
+
+    def _renew_loop(self) -> None:
+        while not self.stop_event.wait(self.heartbeat):
+            try:
+                lost = self.renew()
+            except OSError as e:
+                print(f"Error renewing leases: {e}")
+                continue
+            for name in lost:
+                if self.on_lost:
+                    self.on_lost(name)
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def open_leases(default_dir: str = None):
+    """Returns the lease manager configured by RAWCOOK_LEASE_DIR, or None when the node cooks alone
+
+    RAWCOOK_NODE names the node (the host name by default, set it when several workers run on one host),
+    RAWCOOK_LEASE_TTL and RAWCOOK_LEASE_HEARTBEAT set the expiry and renewal period in seconds.
+    """
+    lease_dir = os.environ.get('RAWCOOK_LEASE_DIR', default_dir or '')
+    if not lease_dir:
+        return None
+    return LeaseManager(lease_dir, default_node(), float(os.environ.get('RAWCOOK_LEASE_TTL', TTL)),
+                        float(os.environ.get('RAWCOOK_LEASE_HEARTBEAT', HEARTBEAT)))
@@ -0,0 +1,144 @@
+import collections
+import json
+import re
+from pathlib import Path
+
+# Messages in a rawcooked output log that make the encode fail post-rawcook
+ERROR_MESSAGES = (
+    b"Reversibility was checked, issues detected, see below.",
+    b"Error:", b"Conversion failed!",
+    b"Please contact info@mediaarea.net if you want support of such content."
+)
+
+# Logs are read in blocks cut at line endings, a line longer than MAX_LINE_LENGTH is cut where it stands
+READ_SIZE = 8 * 1024 * 1024
+MAX_LINE_LENGTH = 1024 * 1024
+# Frame number from a DPX file name or from an ffmpeg style "frame=" field
+FRAME_PATTERN = re.compile(rb'(\d+)\.dpx\b|\bframe[=:# ]+(\d+)', re.IGNORECASE)
+SUMMARY_SUFFIX = '.scan.json'
+
+
+def compile_messages(messages=ERROR_MESSAGES):
+    """Combines the messages into a single alternation so a log is scanned once whatever the number of messages"""
+    return re.compile(b'|'.join(re.escape(message) for message in messages))
+
+
+ERROR_PATTERN = compile_messages()
+
+
+def _lines_before(block, line_start: int, count: int) -> list:
+    lines = []
+    end = line_start - 1
+    while len(lines) < count and end >= 0:
+        begin = block.rfind(b'\n', 0, end) + 1
+        lines.insert(0, block[begin:end])
+        end = begin - 1
+    return lines
+
+
+def _lines_after(block, line_end: int, count: int) -> list:
+    lines = []
+    position = line_end + 1
+    while len(lines) < count and position < len(block):
+        end = block.find(b'\n', position)
+        end = len(block) if end == -1 else end
+        lines.append(block[position:end])
+        position = end + 1
+    return lines
+
+
+def _frame_number(lines) -> int:
+    for line in lines:
+        match = FRAME_PATTERN.search(line)
+        if match:
+            return int(match.group(1) or match.group(2))
+    return None
+
+
+def _decode(line: bytes) -> str:
+    return line.decode('utf-8', 'replace').rstrip('\r')
+
+
+def scan_log(path: str, pattern=ERROR_PATTERN, context_lines: int = 2, max_errors: int = 100) -> dict:
+    """Scans a log once for all the messages of pattern and returns a summary of what was found
+
+    The log is read in large blocks with plain reads, which release the GIL, so several logs can be scanned by a
+    thread pool. Each error records the message, the byte offset of the line, the frame number when the line or its
+    context names one, and context_lines lines on each side. Every match is counted, only the first max_errors are
+    detailed.
+    """
+    counts = collections.Counter()
+    errors = []
+    # (error, number of lines missing) for the errors of the previous block still waiting for their following context
+    pending = []
+    # Last lines of the previous block, the preceding context of an error on the first lines of a block
+    previous_lines = collections.deque(maxlen=context_lines)
+    offset = 0
+    carry = b''
+
+    with open(path, 'rb') as file:
+        while True:
+            data = file.read(READ_SIZE)
+            block = carry + data
+            carry = b''
+            if data:
+                cut = block.rfind(b'\n') + 1
+                if not cut and len(block) < MAX_LINE_LENGTH:
+                    carry = block
+                    continue
+                if cut:
+                    block, carry = block[:cut], block[cut:]
+            if not block:
+                break
+
+            for error, missing in pending:
+                error['context'].extend(_decode(line) for line in _lines_after(block, -1, missing))
+            pending = []
+
+            for match in pattern.finditer(block):
+                message = match.group().decode('utf-8', 'replace')
+                counts[message] += 1
+                if len(errors) >= max_errors:
+                    continue
+                line_start = block.rfind(b'\n', 0, match.start()) + 1
+                line_end = block.find(b'\n', match.end())
+                line_end = len(block) if line_end == -1 else line_end
+                line = block[line_start:line_end]
+
+                before = _lines_before(block, line_start, context_lines)
+                if len(before) < context_lines and previous_lines:
+                    before = list(previous_lines)[-(context_lines - len(before)):] + before
+                after = _lines_after(block, line_end, context_lines)
+                error = {
+                    'message': message,
+                    'offset': offset + line_start,
+                    'frame': _frame_number([line] + before[::-1] + after),
+                    'line': _decode(line),
+                    'context': [_decode(context_line) for context_line in before + [line] + after],
+                }
+                errors.append(error)
+                if len(after) < context_lines:
+                    pending.append((error, context_lines - len(after)))
+
+            previous_lines.extend(block.rstrip(b'\n').rsplit(b'\n', context_lines)[-context_lines:])
+            offset += len(block)
+            if not data:
+                break
+
+    return {
+        'log': str(path),
+        'bytes': offset,
+        'failed': bool(counts),
+        'counts': dict(counts),
+        'errors': errors,
+    }
+
+
+def summary_path(txt_file_path) -> str:
+    """Path of the summary of a .mkv.txt log: <name>.mkv.scan.json next to it"""
+    return str(Path(txt_file_path).with_suffix(SUMMARY_SUFFIX))
+
+
+def write_summary(summary: dict, path: str) -> None:
+    with open(path, 'w') as file:
+        json.dump(summary, file, indent=2)
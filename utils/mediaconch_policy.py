@@ -0,0 +1,125 @@
+import operator
+import xml.etree.ElementTree as ET
+
+# Sentinel returned by a field lookup when a value is not known to the in-process reader
+UNSUPPORTED = object()
+
+_COMPARATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def _strip_namespace(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def _coerce(actual, expected):
+    """Compares numerically when both sides look like numbers, as mediaconch does"""
+    try:
+        return float(actual), float(expected)
+    except (TypeError, ValueError):
+        return str(actual), str(expected)
+
+
+class PolicyRule:
+    """A single <rule> element of a mediaconch policy"""
+
+    def __init__(self, name, field, tracktype, op, expected):
+        self.name = name
+        self.field = field
+        self.tracktype = tracktype
+        self.op = op
+        self.expected = expected
+
+    def evaluate(self, lookup):
+        """Returns True/False, or None if the field or operator cannot be evaluated in-process"""
+        actual = lookup(self.tracktype, self.field)
+        if actual is UNSUPPORTED:
+            return None
+        if self.op == 'exists':
+            return actual is not None
+        if self.op == 'must not exist':
+            return actual is None
+        if self.op not in _COMPARATORS:
+            return None
+        if actual is None:
+            return False
+        return _COMPARATORS[self.op](*_coerce(actual, self.expected))
+
+    def describe(self):
+        return f"{self.name or self.field}: {self.tracktype}/{self.field} {self.op} {self.expected}"
+
+
+class CompiledPolicy:
+    """A <policy> element compiled into a tree of rules combined with "and"/"or"
+
+    Evaluation is three-valued: a rule the in-process reader cannot check yields None, so callers know when the
+    verdict has to be confirmed with mediaconch.
+    """
+
+    def __init__(self, name, policy_type, children):
+        self.name = name
+        self.policy_type = policy_type
+        self.children = children
+
+    def evaluate(self, lookup, failures=None):
+        """Evaluates the policy against a field lookup(tracktype, field)
+
+        Appends the description of every failing rule to failures if a list is given.
+        """
+        results = []
+        child_failures = []
+        for child in self.children:
+            if isinstance(child, CompiledPolicy):
+                result = child.evaluate(lookup, child_failures)
+            else:
+                result = child.evaluate(lookup)
+                if result is False:
+                    child_failures.append(child.describe())
+            results.append(result)
+
+        if self.policy_type == 'or':
+            if True in results:
+                return True
+            verdict = None if None in results else False
+        else:
+            if False in results:
+                verdict = False
+            else:
+                verdict = None if None in results else True
+
+        if verdict is False and failures is not None:
+            failures.extend(child_failures)
+        return verdict
+
+
+def _compile_element(element):
+    children = []
+    for child in element:
+        tag = _strip_namespace(child.tag)
+        if tag == 'policy':
+            children.append(_compile_element(child))
+        elif tag == 'rule':
+            children.append(PolicyRule(
+                name=child.get('name', ''),
+                field=child.get('value', ''),
+                tracktype=child.get('tracktype', 'General'),
+                op=child.get('operator', 'exists'),
+                expected=(child.text or '').strip(),
+            ))
+    return CompiledPolicy(element.get('name', ''), element.get('type', 'and').lower(), children)
+
+
+def compile_policy(policy_path: str) -> CompiledPolicy:
+    """Parses a mediaconch XML policy file into a CompiledPolicy"""
+    root = ET.parse(policy_path).getroot()
+    if _strip_namespace(root.tag) != 'policy':
+        root = next((e for e in root.iter() if _strip_namespace(e.tag) == 'policy'), None)
+        if root is None:
+            raise ValueError(f"No <policy> element found in {policy_path}")
+    return _compile_element(root)
@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+import time
+
+METRICS_EVENTS_NAME = 'metrics.jsonl'
+PROMETHEUS_PREFIX = 'rawcook_workflow'
+# Minimum time between two rewrites of the Prometheus text file, it is always written by flush()
+PROMETHEUS_WRITE_SECONDS = 15
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+class Stage:
+    """One run of a stage, timed as a context manager
+
+    The amounts of work done while it runs (frames, bytes_read, bytes_written, ...) are added with add(), the
+    resource use of the subprocesses it ran with add_process().
+    """
+
+    def __init__(self, metrics, name, sequence=None):
+        self.metrics = metrics
+        self.name = name
+        self.sequence = os.path.basename(os.path.normpath(sequence)) if sequence else None
+        self.amounts = {}
+        self.start = None
+
+    def add(self, **amounts) -> None:
+        for key, value in amounts.items():
+            if value:
+                self.amounts[key] = self.amounts.get(key, 0) + value
+
+    def add_process(self, result) -> None:
+        """Adds the wall and CPU time of a process run with process_runner.run_command"""
+        if result is None or result.rusage is None:
+            return
+        self.add(processes=1, process_wall_seconds=result.seconds, process_user_seconds=result.rusage.ru_utime,
+                 process_system_seconds=result.rusage.ru_stime)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics.end_stage(self, time.perf_counter() - self.start, exc)
+        return False
+
+
+class Metrics:
+    """Stage timers, work counters and queue depths of one workflow script
+
+    Every finished stage is written as an event to a JSON-lines file, and the running totals and gauges can be
+    exposed as a Prometheus text file (for the node_exporter textfile collector).
+    """
+
+    def __init__(self, script: str, events_path: str = None, prometheus_path: str = None):
+        self.script = script
+        self.events_path = events_path
+        self.prometheus_path = prometheus_path
+        self.lock = threading.Lock()
+        # stage -> {counter: total}
+        self.counters = {}
+        # (gauge, sorted label items) -> value
+        self.gauges = {}
+        self.last_write = 0.0
+        self.events = open(events_path, 'a', buffering=1) if events_path else None
+
+    def stage(self, name: str, sequence: str = None) -> Stage:
+        return Stage(self, name, sequence)
+
+    def end_stage(self, stage: Stage, seconds: float, exc=None) -> None:
+        event = {'stage': stage.name, 'sequence': stage.sequence, 'seconds': round(seconds, 6), 'ok': exc is None}
+        event.update(stage.amounts)
+        if seconds > 0:
+            if stage.amounts.get('frames'):
+                event['frames_per_second'] = round(stage.amounts['frames'] / seconds, 3)
+            if stage.amounts.get('bytes_read'):
+                event['read_bytes_per_second'] = round(stage.amounts['bytes_read'] / seconds)
+        if exc is not None:
+            event['error'] = str(exc)
+
+        with self.lock:
+            counters = self.counters.setdefault(stage.name, {})
+            for key, value in (('calls', 1), ('failures', int(exc is not None)), ('seconds', seconds),
+                               *stage.amounts.items()):
+                counters[key] = counters.get(key, 0) + value
+        self.event('stage', **event)
+        self.write_prometheus()
+
+    def gauge(self, name: str, value, **labels) -> None:
+        """Sets a gauge such as a queue depth, an event is only written when the value changes"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            changed = self.gauges.get(key) != value
+            self.gauges[key] = value
+        if changed:
+            self.event('gauge', name=name, value=value, **labels)
+            self.write_prometheus()
+
+    def event(self, kind: str, **fields) -> None:
+        if self.events is None:
+            return
+        line = json.dumps({'time': round(time.time(), 3), 'script': self.script, 'event': kind, **fields})
+        with self.lock:
+            self.events.write(line + '\n')
+
+    def write_prometheus(self, force: bool = False) -> None:
+        """Rewrites the Prometheus text file, at most every PROMETHEUS_WRITE_SECONDS unless forced"""
+        if not self.prometheus_path:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.last_write < PROMETHEUS_WRITE_SECONDS:
+                return
+            self.last_write = now
+            samples = {}
+            for stage, counters in self.counters.items():
+                for key, value in counters.items():
+                    samples.setdefault(f"{PROMETHEUS_PREFIX}_stage_{key}_total", []).append(({'stage': stage},
+                                                                                             value))
+            for (name, labels), value in self.gauges.items():
+                samples.setdefault(f"{PROMETHEUS_PREFIX}_{name}", []).append((dict(labels), value))
+
+            lines = []
+            for metric, values in sorted(samples.items()):
+                lines.append(f"# TYPE {metric} {'counter' if metric.endswith('_total') else 'gauge'}")
+                for labels, value in values:
+                    label_text = ','.join(f'{key}="{label}"' for key, label in {'script': self.script,
+                                                                                  **labels}.items())
+                    lines.append(f"{metric}{{{label_text}}} {value}")
+            # Written under the lock and renamed into place, so the collector never reads a partial file
+            temp_path = f"{self.prometheus_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as file:
+                file.write('\n'.join(lines) + '\n')
+            os.replace(temp_path, self.prometheus_path)
+
+    def flush(self) -> None:
+        self.write_prometheus(force=True)
+        if self.events is not None:
+            self.events.flush()
+
+
+def open_metrics(script: str, logs_dir: str) -> Metrics:
+    """Returns the metrics of a workflow script, shared by every instance of it in the process
+
+    Events go to METRICS_EVENTS (default <logs>/metrics.jsonl, empty to disable) and, when METRICS_PROM_DIR is set,
+    totals and gauges to <METRICS_PROM_DIR>/<script>.prom
+    """
+    with _instances_lock:
+        if script not in _instances:
+            events_path = os.environ.get('METRICS_EVENTS', os.path.join(logs_dir, METRICS_EVENTS_NAME))
+            prometheus_dir = os.environ.get('METRICS_PROM_DIR')
+            _instances[script] = Metrics(script, events_path or None,
+                                         os.path.join(prometheus_dir, f"{script}.prom") if prometheus_dir else None)
+        return _instances[script]
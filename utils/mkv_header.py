@@ -0,0 +1,348 @@
+import os
+import struct
+
+from utils.mediaconch_policy import UNSUPPORTED
+
+# Bytes read from the start of the file in one go, enough for the EBML header, seek head, info and tracks that
+# ffmpeg writes before the first cluster
+PREFIX_SIZE = 64 * 1024
+# Longest element value read, larger values (attachment data, big codec private data) are skipped
+MAX_VALUE_SIZE = 64 * 1024
+# Maximum number of top level elements looked at before giving up on finding the metadata
+MAX_TOP_LEVEL_ELEMENTS = 64
+
+EBML = 0x1A45DFA3
+DOC_TYPE = 0x4282
+DOC_TYPE_VERSION = 0x4287
+DOC_TYPE_READ_VERSION = 0x4285
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMESTAMP_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TITLE = 0x7BA9
+MUXING_APP = 0x4D80
+WRITING_APP = 0x5741
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_TYPE = 0x83
+CODEC_ID = 0x86
+CODEC_PRIVATE = 0x63A2
+DEFAULT_DURATION = 0x23E383
+NAME = 0x536E
+LANGUAGE = 0x22B59C
+VIDEO = 0xE0
+PIXEL_WIDTH = 0xB0
+PIXEL_HEIGHT = 0xBA
+FLAG_INTERLACED = 0x9A
+AUDIO = 0xE1
+SAMPLING_FREQUENCY = 0xB5
+CHANNELS = 0x9F
+BIT_DEPTH = 0x6264
+ATTACHMENTS = 0x1941A469
+ATTACHED_FILE = 0x61A7
+FILE_NAME = 0x466E
+FILE_MIME_TYPE = 0x4660
+CLUSTER = 0x1F43B675
+
+UINTEGER = 'uint'
+FLOAT = 'float'
+STRING = 'string'
+BINARY = 'binary'
+# Types of the leaf elements read, every other element is skipped
+_LEAVES = {
+    DOC_TYPE: STRING, DOC_TYPE_VERSION: UINTEGER, DOC_TYPE_READ_VERSION: UINTEGER,
+    SEEK_ID: BINARY, SEEK_POSITION: UINTEGER,
+    TIMESTAMP_SCALE: UINTEGER, DURATION: FLOAT, TITLE: STRING, MUXING_APP: STRING, WRITING_APP: STRING,
+    TRACK_NUMBER: UINTEGER, TRACK_TYPE: UINTEGER, CODEC_ID: STRING, CODEC_PRIVATE: BINARY,
+    DEFAULT_DURATION: UINTEGER, NAME: STRING, LANGUAGE: STRING,
+    PIXEL_WIDTH: UINTEGER, PIXEL_HEIGHT: UINTEGER, FLAG_INTERLACED: UINTEGER,
+    SAMPLING_FREQUENCY: FLOAT, CHANNELS: UINTEGER, BIT_DEPTH: UINTEGER,
+    FILE_NAME: STRING, FILE_MIME_TYPE: STRING,
+}
+_MASTERS = {EBML, SEEK_HEAD, SEEK, INFO, TRACKS, TRACK_ENTRY, VIDEO, AUDIO, ATTACHMENTS, ATTACHED_FILE}
+
+TRACK_TYPES = {1: 'Video', 2: 'Audio', 17: 'Text'}
+# MediaInfo format names of the Matroska codec ids
+CODEC_FORMATS = {
+    'V_FFV1': 'FFV1', 'V_MPEG4/ISO/AVC': 'AVC', 'V_MPEGH/ISO/HEVC': 'HEVC', 'V_VP9': 'VP9', 'V_AV1': 'AV1',
+    'V_PRORES': 'ProRes', 'V_UNCOMPRESSED': 'YUV',
+    'A_FLAC': 'FLAC', 'A_PCM/INT/LIT': 'PCM', 'A_PCM/INT/BIG': 'PCM', 'A_PCM/FLOAT/IEEE': 'PCM', 'A_AAC': 'AAC',
+    'A_AC3': 'AC-3', 'A_OPUS': 'Opus',
+    'S_TEXT/UTF8': 'UTF-8', 'S_TEXT/ASS': 'ASS',
+}
+SCAN_TYPES = {1: 'Interlaced', 2: 'Progressive'}
+
+
+class _Source:
+    """Reads a file through a prefix buffer, with positioned reads past it"""
+
+    def __init__(self, fd, prefix_size):
+        self.fd = fd
+        self.size = os.fstat(fd).st_size
+        self.prefix = os.pread(fd, prefix_size, 0)
+        self.bytes_read = len(self.prefix)
+
+    def read(self, offset, length):
+        if offset + length <= len(self.prefix):
+            return self.prefix[offset:offset + length]
+        data = os.pread(self.fd, length, offset)
+        self.bytes_read += len(data)
+        return data
+
+
+def _read_vint(source, offset, keep_marker):
+    """Reads an EBML variable length integer, returns (value, length) or (None, length) for an unknown size"""
+    first = source.read(offset, 1)
+    if not first:
+        raise ValueError(f"Unexpected end of file at {offset}")
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first[0] & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ValueError(f"Invalid EBML number at {offset}")
+    data = source.read(offset, length)
+    if len(data) < length:
+        raise ValueError(f"Unexpected end of file at {offset}")
+    value = int.from_bytes(data, 'big')
+    if keep_marker:
+        return value, length
+    value &= (1 << (7 * length)) - 1
+    if value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+
+def _read_element_header(source, offset):
+    """Returns (element id, data offset, data size or None for an unknown size)"""
+    element_id, id_length = _read_vint(source, offset, True)
+    size, size_length = _read_vint(source, offset + id_length, False)
+    return element_id, offset + id_length + size_length, size
+
+
+def _decode(kind, data):
+    if kind == UINTEGER:
+        return int.from_bytes(data, 'big')
+    if kind == FLOAT:
+        if len(data) == 4:
+            return struct.unpack('>f', data)[0]
+        if len(data) == 8:
+            return struct.unpack('>d', data)[0]
+        return None
+    if kind == STRING:
+        return data.split(b'\0', 1)[0].decode('utf-8', 'replace')
+    return bytes(data)
+
+
+def _read_children(source, start, end):
+    """Reads the children of a master element into a list of (id, value), descending into known masters
+
+    Values larger than MAX_VALUE_SIZE and unknown elements are skipped without being read.
+    """
+    children = []
+    offset = start
+    while offset < end:
+        element_id, data_offset, size = _read_element_header(source, offset)
+        if size is None:
+            if element_id in _MASTERS:
+                size = end - data_offset
+            else:
+                break
+        if element_id in _MASTERS:
+            children.append((element_id, _read_children(source, data_offset, min(data_offset + size, end))))
+        elif element_id in _LEAVES and size <= MAX_VALUE_SIZE:
+            children.append((element_id, _decode(_LEAVES[element_id], source.read(data_offset, size))))
+        offset = data_offset + size
+    return children
+
+
+def _first(children, element_id, default=None):
+    return next((value for child_id, value in children if child_id == element_id), default)
+
+
+class MkvHeader:
+    """Container level metadata of a Matroska file: EBML header, segment info, tracks and attachment names"""
+
+    def __init__(self, doc_type, doc_type_version, info, tracks, attachments, bytes_read):
+        self.doc_type = doc_type
+        self.doc_type_version = doc_type_version
+        self.info = info
+        # One dict of the TrackEntry fields per track, in file order
+        self.tracks = tracks
+        self.attachments = attachments
+        self.bytes_read = bytes_read
+
+
+def _track_fields(entry):
+    video = _first(entry, VIDEO, [])
+    audio = _first(entry, AUDIO, [])
+    return {
+        'type': TRACK_TYPES.get(_first(entry, TRACK_TYPE)),
+        'number': _first(entry, TRACK_NUMBER),
+        'codec_id': _first(entry, CODEC_ID),
+        'codec_private': _first(entry, CODEC_PRIVATE),
+        'default_duration': _first(entry, DEFAULT_DURATION),
+        'name': _first(entry, NAME),
+        'language': _first(entry, LANGUAGE),
+        'width': _first(video, PIXEL_WIDTH),
+        'height': _first(video, PIXEL_HEIGHT),
+        'interlaced': _first(video, FLAG_INTERLACED),
+        'sampling_frequency': _first(audio, SAMPLING_FREQUENCY),
+        'channels': _first(audio, CHANNELS),
+        'bit_depth': _first(audio, BIT_DEPTH),
+    }
+
+
+def read_mkv_header(mkv_path: str, prefix_size: int = PREFIX_SIZE) -> MkvHeader:
+    """Reads the container metadata of a Matroska file without reading its clusters
+
+    The top level elements of the segment are walked up to the first cluster. Info, tracks or attachments written
+    after the clusters are found through the seek head and read with positioned reads.
+    Raises ValueError if the file is not a Matroska file or the metadata cannot be found.
+    """
+    fd = os.open(mkv_path, os.O_RDONLY)
+    try:
+        source = _Source(fd, prefix_size)
+        element_id, data_offset, size = _read_element_header(source, 0)
+        if element_id != EBML:
+            raise ValueError(f"{mkv_path} is not an EBML file")
+        ebml = _read_children(source, data_offset, data_offset + size)
+        offset = data_offset + size
+
+        element_id, segment_start, segment_size = _read_element_header(source, offset)
+        if element_id != SEGMENT:
+            raise ValueError(f"No segment found in {mkv_path}")
+        segment_end = source.size if segment_size is None else min(segment_start + segment_size, source.size)
+
+        found = {}
+        seek_positions = {}
+        offset = segment_start
+        for _ in range(MAX_TOP_LEVEL_ELEMENTS):
+            if offset >= segment_end:
+                break
+            element_id, data_offset, size = _read_element_header(source, offset)
+            if element_id == CLUSTER or size is None:
+                break
+            if element_id == SEEK_HEAD:
+                for seek_id, seek in _read_children(source, data_offset, data_offset + size):
+                    target = _first(seek, SEEK_ID)
+                    position = _first(seek, SEEK_POSITION)
+                    if seek_id == SEEK and target and position is not None:
+                        seek_positions.setdefault(int.from_bytes(target, 'big'), segment_start + position)
+            elif element_id in (INFO, TRACKS, ATTACHMENTS):
+                found[element_id] = _read_children(source, data_offset, data_offset + size)
+            offset = data_offset + size
+
+        # Elements the muxer wrote after the clusters
+        for element_id in (INFO, TRACKS, ATTACHMENTS):
+            if element_id not in found and element_id in seek_positions:
+                target_id, data_offset, size = _read_element_header(source, seek_positions[element_id])
+                if target_id == element_id and size is not None:
+                    found[element_id] = _read_children(source, data_offset, data_offset + size)
+        if TRACKS not in found:
+            raise ValueError(f"No tracks found in {mkv_path}")
+
+        info = found.get(INFO, [])
+        return MkvHeader(
+            doc_type=_first(ebml, DOC_TYPE, 'matroska'),
+            doc_type_version=_first(ebml, DOC_TYPE_VERSION),
+            info={
+                'timestamp_scale': _first(info, TIMESTAMP_SCALE, 1000000),
+                'duration': _first(info, DURATION),
+                'title': _first(info, TITLE),
+                'muxing_app': _first(info, MUXING_APP),
+                'writing_app': _first(info, WRITING_APP),
+            },
+            tracks=[_track_fields(entry) for child_id, entry in found[TRACKS] if child_id == TRACK_ENTRY],
+            attachments=[_first(attached, FILE_NAME) for child_id, attached in found.get(ATTACHMENTS, [])
+                         if child_id == ATTACHED_FILE],
+            bytes_read=source.bytes_read,
+        )
+    finally:
+        os.close(fd)
+
+
+def _codec_format(track):
+    codec_id = track['codec_id'] or ''
+    if codec_id == 'V_MS/VFW/FOURCC':
+        # BITMAPINFOHEADER, the compression fourcc is at offset 16
+        private = track['codec_private'] or b''
+        return private[16:20].decode('ascii', 'replace').strip() if len(private) >= 20 else UNSUPPORTED
+    return CODEC_FORMATS.get(codec_id, UNSUPPORTED)
+
+
+def _number(value):
+    if value is None:
+        return None
+    return int(value) if float(value).is_integer() else round(value, 3)
+
+
+def mkv_field_lookup(header: MkvHeader):
+    """Returns a lookup(tracktype, field) exposing a Matroska header with the MediaInfo field names used in policies
+
+    Only container level fields are known. Codec level fields (FFV1 version, slices, bit depth of the video...) are
+    UNSUPPORTED, as are the fields of a track type present more than once, so those rules go to mediaconch.
+    """
+    general = {
+        'Format': 'WebM' if header.doc_type == 'webm' else 'Matroska',
+        'Format_Version': header.doc_type_version,
+        'Title': header.info['title'],
+        'Encoded_Application': header.info['writing_app'],
+        'Encoded_Library': header.info['muxing_app'],
+        'Attachments': ' / '.join(name for name in header.attachments if name) or None,
+    }
+    by_type = {}
+    for track in header.tracks:
+        by_type.setdefault(track['type'], []).append(track)
+    for tracktype in TRACK_TYPES.values():
+        general[f'{tracktype}Count'] = len(by_type.get(tracktype, [])) or None
+
+    def track_fields(track):
+        frame_rate = None
+        if track['default_duration']:
+            frame_rate = _number(1e9 / track['default_duration'])
+        return {
+            'Format': _codec_format(track),
+            'CodecID': track['codec_id'],
+            'Title': track['name'],
+            'Language': track['language'],
+            'Width': track['width'],
+            'Height': track['height'],
+            'FrameRate': frame_rate,
+            'ScanType': SCAN_TYPES.get(track['interlaced']),
+            'Channels': track['channels'],
+            'SamplingRate': _number(track['sampling_frequency']),
+            'BitDepth': track['bit_depth'] if track['type'] == 'Audio' else UNSUPPORTED,
+        }
+
+    tracks = {tracktype: track_fields(tracks[0]) for tracktype, tracks in by_type.items() if len(tracks) == 1}
+
+    def lookup(tracktype, field):
+        if tracktype == 'General':
+            return general.get(field, UNSUPPORTED)
+        if tracktype not in tracks:
+            # No track of that type: nothing exists, several: the rule may be about any of them
+            return None if tracktype in TRACK_TYPES.values() and tracktype not in by_type else UNSUPPORTED
+        return tracks[tracktype].get(field, UNSUPPORTED)
+
+    return lookup
+
+
+def check_mkv_header(policy, mkv_path: str):
+    """Evaluates a compiled policy against the container metadata of an MKV
+
+    Returns (verdict, reasons, bytes read), the verdict being None when the policy has rules only mediaconch can
+    check or the file could not be parsed.
+    """
+    try:
+        header = read_mkv_header(mkv_path)
+    except (OSError, ValueError) as e:
+        return None, [str(e)], 0
+    reasons = []
+    return policy.evaluate(mkv_field_lookup(header), reasons), reasons, header.bytes_read
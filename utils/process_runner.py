@@ -0,0 +1,145 @@
+import collections
+import os
+import re
+import selectors
+import subprocess
+import time
+
+# Size of the write buffer of the output file and of a single read from a pipe
+BUFFER_SIZE = 64 * 1024
+# Longest line kept in memory before it is flushed without its line ending
+MAX_LINE_LENGTH = 64 * 1024
+
+
+class RunResult:
+    """Outcome of run_command"""
+
+    def __init__(self, returncode, matched, aborted, tail, seconds=None, rusage=None):
+        self.returncode = returncode
+        # Watched or abort messages seen in the output, in order, as (message, line)
+        self.matched = matched
+        # Set to the abort message that made run_command kill the process
+        self.aborted = aborted
+        # Last lines of the output
+        self.tail = tail
+        # Wall time of the process and its own resource use (resource.struct_rusage), from os.wait4
+        self.seconds = seconds
+        self.rusage = rusage
+
+    def found(self, message: str) -> bool:
+        return any(m == message for m, _ in self.matched)
+
+
+_LINE_ENDING = re.compile(rb'\r\n|\r|\n')
+
+
+class _LineSplitter:
+    """Splits a byte stream into lines ended by \\n, \\r or \\r\\n, like text mode pipes do"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # Set when a chunk ended with \\r, so a \\n starting the next chunk is not taken as an empty line
+        self.pending_cr = False
+
+    def feed(self, chunk: bytes) -> list:
+        if self.pending_cr and chunk.startswith(b'\n'):
+            chunk = chunk[1:]
+        self.pending_cr = False
+        self.buffer.extend(chunk)
+
+        lines = []
+        start = 0
+        for match in _LINE_ENDING.finditer(self.buffer):
+            lines.append(bytes(self.buffer[start:match.start()]))
+            start = match.end()
+        if start == len(self.buffer) and self.buffer.endswith(b'\r'):
+            self.pending_cr = True
+        del self.buffer[:start]
+
+        if len(self.buffer) > MAX_LINE_LENGTH:
+            lines.append(bytes(self.buffer))
+            del self.buffer[:]
+        return lines
+
+    def flush(self) -> list:
+        lines = [bytes(self.buffer)] if self.buffer else []
+        del self.buffer[:]
+        return lines
+
+
+def run_command(command, output_path=None, line_callback=None, watch_for=(), abort_on=(), tail_lines=200,
+                append=True, on_start=None) -> RunResult:
+    """Runs a command and streams stdout and stderr as they are produced
+
+    Both pipes are multiplexed with a selector, so a child writing a lot to one pipe cannot block on it while the
+    other one is being read. Each line is written to output_path as soon as it is complete and passed to
+    line_callback(stream_name, line). Only the last tail_lines lines are kept in memory.
+    Messages in watch_for are recorded when they appear in a line. If a message in abort_on appears, the process is
+    killed straight away and the rest of its output is drained.
+    The process is reaped with os.wait4, so the CPU time reported in the result is the process's own even when
+    several commands run at once from different threads.
+    on_start(process) is called once the process has been started, for callers that monitor it by pid.
+    """
+    output = open(output_path, 'a' if append else 'w', buffering=BUFFER_SIZE) if output_path else None
+    tail = collections.deque(maxlen=tail_lines)
+    matched = []
+    aborted = None
+    selector = selectors.DefaultSelector()
+    process = None
+    rusage = None
+    start = time.perf_counter()
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if on_start:
+            on_start(process)
+        buffers = {}
+        for name, pipe in (('stdout', process.stdout), ('stderr', process.stderr)):
+            os.set_blocking(pipe.fileno(), False)
+            buffers[name] = _LineSplitter()
+            selector.register(pipe, selectors.EVENT_READ, name)
+
+        def handle(name, raw_line):
+            nonlocal aborted
+            line = raw_line.decode('utf-8', 'replace')
+            tail.append(line)
+            if output:
+                output.write(line + '\n')
+            if line_callback:
+                line_callback(name, line)
+            for message in watch_for:
+                if message in line:
+                    matched.append((message, line))
+            for message in abort_on:
+                if message in line:
+                    matched.append((message, line))
+                    if aborted is None:
+                        aborted = message
+                        process.kill()
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                try:
+                    chunk = os.read(key.fileobj.fileno(), BUFFER_SIZE)
+                except BlockingIOError:
+                    continue
+                splitter = buffers[key.data]
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    raw_lines = splitter.flush()
+                else:
+                    raw_lines = splitter.feed(chunk)
+                for raw_line in raw_lines:
+                    handle(key.data, raw_line)
+
+        _, status, rusage = os.wait4(process.pid, 0)
+        returncode = process.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        selector.close()
+        if process and process.poll() is None:
+            process.kill()
+            process.wait()
+        if output:
+            output.close()
+
+    return RunResult(returncode, matched, aborted, list(tail), time.perf_counter() - start, rusage)
@@ -0,0 +1,206 @@
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+# Progress fields of the rawcooked output: ffmpeg's 'frame= 1234 fps= 24.0 ...' lines and rawcooked's percentage
+FRAME_PATTERN = re.compile(r'frame=\s*(\d+)')
+FPS_PATTERN = re.compile(r'fps=\s*(\d+(?:\.\d+)?)')
+PERCENT_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*%')
+# Seconds between two writes of the status file
+PUBLISH_INTERVAL = 2.0
+# Finished jobs kept in the status file
+RECENT_JOBS = 20
+
+RUNNING = 'running'
+STALLED = 'stalled'
+
+
+def parse_progress(line: str):
+    """Returns the {'frames', 'fps', 'percent'} found in a line of rawcooked output, or None for other lines"""
+    if '=' not in line and '%' not in line:
+        return None
+    progress = {}
+    match = FRAME_PATTERN.search(line)
+    if match:
+        progress['frames'] = int(match.group(1))
+    match = FPS_PATTERN.search(line)
+    if match:
+        progress['fps'] = float(match.group(1))
+    match = PERCENT_PATTERN.search(line)
+    if match and float(match.group(1)) <= 100:
+        progress['percent'] = float(match.group(1))
+    return progress or None
+
+
+class JobProgress:
+    """Progress of one encode, updated from its output lines"""
+
+    def __init__(self, name: str, path: str, total_frames: int = None, now: float = None):
+        self.name = name
+        self.path = path
+        self.total_frames = total_frames or None
+        self.started = time.time() if now is None else now
+        self.frames = 0
+        self.fps = None
+        self.percent = None
+        self.status = RUNNING
+        # Time of the last line reporting more frames or a higher percentage
+        self.last_progress = self.started
+        self.finished = None
+
+    def update(self, progress: dict, now: float) -> None:
+        advanced = False
+        if progress.get('frames', 0) > self.frames:
+            self.frames = progress['frames']
+            advanced = True
+        if 'percent' in progress and (self.percent is None or progress['percent'] > self.percent):
+            self.percent = progress['percent']
+            advanced = True
+        if 'fps' in progress:
+            self.fps = progress['fps']
+        if advanced:
+            self.last_progress = now
+            if self.status == STALLED:
+                self.status = RUNNING
+
+    def fraction(self):
+        if self.total_frames and self.frames:
+            return min(1.0, self.frames / self.total_frames)
+        if self.percent is not None:
+            return self.percent / 100
+        return None
+
+    def eta(self, now: float):
+        """Returns the seconds left, from the reported fps when there is one, else from the average rate so far"""
+        if self.total_frames and self.frames:
+            remaining = max(0, self.total_frames - self.frames)
+            rate = self.fps or self.frames / max(now - self.started, 1e-6)
+            return remaining / rate if rate > 0 else None
+        fraction = self.fraction()
+        if fraction:
+            return (now - self.started) * (1 - fraction) / fraction
+        return None
+
+    def snapshot(self, now: float) -> dict:
+        fraction = self.fraction()
+        eta = self.eta(now) if self.finished is None else None
+        return {
+            'name': self.name,
+            'path': self.path,
+            'status': self.status,
+            'frames': self.frames,
+            'total_frames': self.total_frames,
+            'percent': round(fraction * 100, 1) if fraction is not None else None,
+            'fps': self.fps,
+            'eta_seconds': round(eta) if eta is not None else None,
+            'elapsed_seconds': round((self.finished or now) - self.started),
+            'since_progress_seconds': round(now - self.last_progress) if self.finished is None else None,
+        }
+
+
+class StatusFeed:
+    """Tracks the progress of the running encodes and publishes it as a small JSON file
+
+    Output lines only update the jobs in memory. The file is rewritten at most every interval seconds, atomically,
+    so a GUI or a monitoring script can poll it without parsing the logs or ever reading a partial file.
+    """
+
+    def __init__(self, path: str = None, interval: float = PUBLISH_INTERVAL, stall_seconds: float = 0):
+        self.path = path
+        self.interval = interval
+        self.stall_seconds = stall_seconds
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.recent = collections.deque(maxlen=RECENT_JOBS)
+        self.queue = {}
+        self.dirty = False
+        self.last_publish = 0.0
+
+    def start_job(self, key: str, name: str, total_frames: int = None) -> None:
+        with self.lock:
+            self.jobs[key] = JobProgress(name, key, total_frames)
+            self.dirty = True
+
+    def line(self, key: str, line: str) -> bool:
+        """Feeds an output line of a job, returns True when it was a progress line"""
+        progress = parse_progress(line)
+        if progress is None:
+            return False
+        now = time.time()
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                return True
+            job.update(progress, now)
+            self.dirty = True
+        self.publish()
+        return True
+
+    def finish_job(self, key: str, status: str) -> None:
+        with self.lock:
+            job = self.jobs.pop(key, None)
+            if job is None:
+                return
+            job.status = status
+            job.finished = time.time()
+            self.recent.appendleft(job)
+            self.dirty = True
+        self.publish()
+
+    def set_queue(self, **counts) -> None:
+        with self.lock:
+            if counts != self.queue:
+                self.queue = counts
+                self.dirty = True
+
+    def stalled(self, now: float = None) -> list:
+        """Flags the jobs without progress for stall_seconds, returns the keys of the ones newly flagged"""
+        if self.stall_seconds <= 0:
+            return []
+        now = time.time() if now is None else now
+        flagged = []
+        with self.lock:
+            for key, job in self.jobs.items():
+                if job.status == RUNNING and now - job.last_progress > self.stall_seconds:
+                    job.status = STALLED
+                    flagged.append(key)
+                    self.dirty = True
+        return flagged
+
+    def get(self, key: str):
+        with self.lock:
+            job = self.jobs.get(key)
+            return job.snapshot(time.time()) if job else None
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self.lock:
+            return {
+                'updated': now,
+                'pid': os.getpid(),
+                'queue': dict(self.queue),
+                'jobs': [job.snapshot(now) for job in self.jobs.values()],
+                'finished': [job.snapshot(now) for job in self.recent],
+            }
+
+    def publish(self, force: bool = False) -> None:
+        """Writes the status file if it changed and the last write is older than the interval, or when forced"""
+        if not self.path:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if not force and (not self.dirty or now - self.last_publish < self.interval):
+                return
+            self.dirty = False
+            self.last_publish = now
+        snapshot = self.snapshot()
+        temp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'w') as file:
+                json.dump(snapshot, file, indent=1)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Error writing status file {self.path}: {e}")
@@ -0,0 +1,310 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from utils.dpx_header import DPX_HEADER_SIZE
+from utils.sequence_index import FRAME_PATTERN, get_index, load_cached_index
+
+RESULT_CACHE_NAME = 'result_cache.db'
+# 'sampled' hashes the headers and a block from the middle of a sample of frames, 'full' hashes every byte
+SAMPLED = 'sampled'
+FULL = 'full'
+SAMPLE_FILES = 16
+SAMPLE_BLOCK_SIZE = 64 * 1024
+READ_SIZE = 8 * 1024 * 1024
+# Entries are evicted once unused for this long, and least recently used first once the cache holds more bytes
+MAX_AGE_DAYS = 180
+MAX_BYTES = 64 * 1024 * 1024
+# Number of writes between two evictions
+EVICT_EVERY = 100
+# Number of folders whose frame modification times are kept in memory
+MTIMES_KEPT = 64
+
+# Kinds of results remembered
+GAPS = 'gaps'
+REVERSIBILITY = 'reversibility'
+DPX_POLICY = 'dpx_policy'
+MKV = 'mkv'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    fingerprint TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    name TEXT,
+    path TEXT,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (fingerprint, kind)
+);
+CREATE INDEX IF NOT EXISTS results_used ON results (used);
+CREATE INDEX IF NOT EXISTS results_path ON results (path);
+"""
+
+
+def file_digest(path: str) -> str:
+    """Returns the MD5 of a whole file, used to key results by the policy they were checked against"""
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        while True:
+            data = file.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def find_indexes(seq_path: str, index_cache_dir: str = None) -> list:
+    """Returns the sequence index of every folder holding DPX files at any depth of seq_path
+
+    Folders with a valid cached index are not listed.
+    """
+    indexes = []
+    folders = [seq_path]
+    while folders:
+        folder = folders.pop()
+        index = load_cached_index(folder, index_cache_dir) if index_cache_dir else None
+        if index is not None and index.frame_count:
+            indexes.append(index)
+            continue
+        has_frames = False
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    folders.append(entry.path)
+                elif FRAME_PATTERN.match(entry.name):
+                    has_frames = True
+        if has_frames:
+            indexes.append(get_index(folder, index_cache_dir))
+    return sorted(indexes, key=lambda index: index.folder)
+
+
+def frame_mtimes(index) -> np.ndarray:
+    """Returns the modification time of every frame, from the index when it was just built, else stat'ed
+
+    A cached index is not trusted for them, as a frame rewritten in place leaves the folder and its index unchanged.
+    """
+    if index.mtimes is not None:
+        return index.mtimes
+    return np.array([os.stat(path).st_mtime_ns for path in index.paths()], dtype=np.int64)
+
+
+def metadata_digest(indexes: list, root: str, mtimes: list) -> str:
+    """Returns a digest of the relative path, size and modification time of every frame"""
+    digest = hashlib.md5()
+    for index, index_mtimes in zip(indexes, mtimes):
+        digest.update(f"{os.path.relpath(index.folder, root)}\0".encode())
+        digest.update('\0'.join(index.names).encode())
+        digest.update(index.sizes.tobytes())
+        digest.update(index_mtimes.tobytes())
+    return digest.hexdigest()
+
+
+def sequence_fingerprint(indexes: list, root: str, mode: str = SAMPLED, samples: int = SAMPLE_FILES,
+                         mtimes: list = None) -> str:
+    """Returns a fingerprint of the content of a sequence
+
+    Covers the frame count, the byte total and the relative path, size and modification time of every frame, plus
+    either the DPX header and a block from the middle of up to samples frames spread over each folder, or every byte
+    with the full mode. DPX frames all have the same size, so the mtimes are what catches a change to a frame outside
+    the sample. A sequence moved between folders keeps them, one copied without preserving them is checked again.
+    """
+    if mtimes is None:
+        mtimes = [frame_mtimes(index) for index in indexes]
+    digest = hashlib.md5(metadata_digest(indexes, root, mtimes).encode())
+    frames = 0
+    byte_total = 0
+    for index in indexes:
+        frames += index.frame_count
+        byte_total += index.byte_total
+
+        if mode == FULL:
+            chosen = range(index.frame_count)
+        else:
+            count = min(samples, index.frame_count)
+            chosen = sorted({round(i * (index.frame_count - 1) / max(count - 1, 1)) for i in range(count)})
+        for position in chosen:
+            size = int(index.sizes[position])
+            with open(os.path.join(index.folder, index.names[position]), 'rb') as file:
+                if mode == FULL:
+                    while True:
+                        data = file.read(READ_SIZE)
+                        if not data:
+                            break
+                        digest.update(data)
+                else:
+                    digest.update(file.read(DPX_HEADER_SIZE))
+                    if size > DPX_HEADER_SIZE + SAMPLE_BLOCK_SIZE:
+                        file.seek(size // 2)
+                        digest.update(file.read(SAMPLE_BLOCK_SIZE))
+    return f"{mode}:{frames}:{byte_total}:{digest.hexdigest()}"
+
+
+class ResultCache:
+    """SQLite cache of the results of expensive checks, keyed by the content fingerprint of a sequence
+
+    Remembers the gap check, reversibility probe and policy verdicts and the location of cooked MKVs, so a sequence
+    coming back unchanged from a review folder, or delivered again, is not assessed or cooked a second time. Shared
+    by the workflow scripts like the state journal. A cache opened without a path is disabled and misses every time.
+    """
+
+    def __init__(self, db_path: str = None, mode: str = SAMPLED, max_age_days: float = MAX_AGE_DAYS,
+                 max_bytes: int = MAX_BYTES):
+        self.db_path = db_path
+        self.mode = mode
+        self.max_age = max_age_days * 24 * 3600
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # (mode, digest of the frame paths, sizes and mtimes) -> fingerprint, so the stages of one run read the
+        # sampled content of a sequence once
+        self.fingerprints = {}
+        # dir_stat of a folder -> mtimes of its frames, so the stages of one run stat a folder once at most
+        self.mtimes = {}
+        self.writes = 0
+        self.connection = None
+        if db_path:
+            self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.executescript(_SCHEMA)
+            self.evict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.connection is not None
+
+    def fingerprint(self, seq_path: str, index_cache_dir: str = None) -> str:
+        """Returns the fingerprint of a sequence folder, its content is only read again when a frame changed"""
+        indexes = find_indexes(seq_path, index_cache_dir)
+        mtimes = [self.frame_mtimes(index) for index in indexes]
+        key = (self.mode, metadata_digest(indexes, seq_path, mtimes))
+        with self.lock:
+            fingerprint = self.fingerprints.get(key)
+        if fingerprint is None:
+            fingerprint = sequence_fingerprint(indexes, seq_path, self.mode, mtimes=mtimes)
+            with self.lock:
+                self.fingerprints[key] = fingerprint
+        return fingerprint
+
+    def frame_mtimes(self, index) -> np.ndarray:
+        """Returns the frame modification times of an index, remembered for the process by folder dir_stat"""
+        with self.lock:
+            mtimes = self.mtimes.get(index.dir_stat)
+        if mtimes is None:
+            mtimes = frame_mtimes(index)
+            with self.lock:
+                self.mtimes[index.dir_stat] = mtimes
+                if len(self.mtimes) > MTIMES_KEPT:
+                    del self.mtimes[next(iter(self.mtimes))]
+        return mtimes
+
+    def get(self, fingerprint: str, kind: str):
+        """Returns the value stored for a fingerprint, or None, and marks it as recently used"""
+        if not self.enabled:
+            return None
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM results WHERE fingerprint = ? AND kind = ?',
+                                          (fingerprint, kind)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE results SET used = ? WHERE fingerprint = ? AND kind = ?',
+                                    (time.time(), fingerprint, kind))
+        return json.loads(row[0])
+
+    def put(self, fingerprint: str, kind: str, value, name: str = None, path: str = None) -> None:
+        """Stores a JSON serialisable value, replacing the previous one of the same kind"""
+        if not self.enabled:
+            return
+        text = json.dumps(value)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO results (fingerprint, kind, value, name, path, size, created, used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (fingerprint, kind, text, name, path, len(text), now, now))
+            self.writes += 1
+            evict = self.writes % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def lookup(self, seq_path: str, kind: str, index_cache_dir: str = None):
+        """Returns (fingerprint, cached value or None), the fingerprint being None when the cache is disabled"""
+        if not self.enabled:
+            return None, None
+        fingerprint = self.fingerprint(seq_path, index_cache_dir)
+        return fingerprint, self.get(fingerprint, kind)
+
+    def relocate(self, old_path: str, new_path: str, **fields) -> None:
+        """Updates the location of a file recorded in the cache after it was moved, along with any value fields"""
+        if not self.enabled:
+            return
+        with self.lock:
+            rows = self.connection.execute('SELECT fingerprint, kind, value FROM results WHERE path = ?',
+                                           (old_path,)).fetchall()
+            for fingerprint, kind, text in rows:
+                value = json.loads(text)
+                if isinstance(value, dict):
+                    value.update(fields)
+                    if value.get('path') == old_path:
+                        value['path'] = new_path
+                    text = json.dumps(value)
+                self.connection.execute('UPDATE results SET path = ?, value = ?, size = ? '
+                                        'WHERE fingerprint = ? AND kind = ?',
+                                        (new_path, text, len(text), fingerprint, kind))
+
+    def discard(self, path: str) -> None:
+        """Forgets the results recorded for a file, such as an MKV that failed its checks"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.connection.execute('DELETE FROM results WHERE path = ?', (path,))
+
+    def evict(self) -> None:
+        """Drops the entries unused for longer than max_age, then the least recently used beyond max_bytes"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.connection.execute('DELETE FROM results WHERE used < ?', (time.time() - self.max_age,))
+            total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            excess = total - self.max_bytes
+            cutoff = None
+            for used, size in self.connection.execute('SELECT used, size FROM results ORDER BY used'):
+                excess -= size
+                cutoff = used
+                if excess <= 0:
+                    break
+            self.connection.execute('DELETE FROM results WHERE used <= ?', (cutoff,))
+
+    def close(self) -> None:
+        if self.enabled:
+            with self.lock:
+                self.connection.close()
+
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def open_result_cache(logs_dir: str) -> ResultCache:
+    """Opens the result cache shared by the workflow scripts of the process
+
+    RESULT_CACHE_DB overrides its location (empty disables it), RESULT_CACHE_HASH selects the 'sampled' or 'full'
+    fingerprint, RESULT_CACHE_MAX_AGE_DAYS and RESULT_CACHE_MAX_MB bound what it keeps.
+    """
+    db_path = os.environ.get('RESULT_CACHE_DB', os.path.join(logs_dir, RESULT_CACHE_NAME)) or None
+    with _instances_lock:
+        if db_path not in _instances:
+            mode = os.environ.get('RESULT_CACHE_HASH', SAMPLED)
+            if mode not in (SAMPLED, FULL):
+                raise ValueError(f"RESULT_CACHE_HASH must be {SAMPLED} or {FULL}, not {mode}")
+            _instances[db_path] = ResultCache(db_path, mode,
+                                              float(os.environ.get('RESULT_CACHE_MAX_AGE_DAYS', MAX_AGE_DAYS)),
+                                              int(float(os.environ.get('RESULT_CACHE_MAX_MB', MAX_BYTES / 2 ** 20))
+                                                  * 2 ** 20))
+        return _instances[db_path]
@@ -0,0 +1,126 @@
+import array
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from utils.dpx_header import DPX_HEADER_SIZE, UNDEFINED_U32, expected_image_size, read_dpx_header
+from utils.process_runner import run_command
+
+# Number of image bytes checked for non-zero padding bits in each sampled frame
+PADDING_SCAN_BYTES = 256 * 1024
+
+# Verdicts of probe_reversibility
+V1 = 'v1'
+V2 = 'v2'
+
+
+def _padding_mask(header):
+    """Returns the mask of the padding bits in each 32-bit word of filled image data, or 0 if there are none"""
+    if header.packing not in (1, 2):
+        return 0
+    if header.bit_depth == 10:
+        return 0x00000003 if header.packing == 1 else 0xC0000000
+    if header.bit_depth == 12:
+        return 0x000F000F if header.packing == 1 else 0xF000F000
+    return 0
+
+
+def find_header_anomalies(dpx_path: str) -> list:
+    """Lists the characteristics of a DPX file which rawcooked has to keep in the reversibility data
+
+    Checks for user data, trailing data after the image, non-zero bytes between the headers and the image data, a
+    file size field that does not match the file, unusual packing and non-zero padding bits at the start of the image
+    data.
+    """
+    anomalies = []
+    header = read_dpx_header(dpx_path)
+    actual_size = os.path.getsize(dpx_path)
+    image_offset = header.data_offset if header.data_offset not in (0, UNDEFINED_U32) else header.image_offset
+
+    if header.file_size != actual_size:
+        anomalies.append(f"file size field {header.file_size} != {actual_size}")
+    if header.packing not in (0, 1) or (header.packing == 0 and header.bit_depth in (10, 12)):
+        anomalies.append(f"{header.bit_depth}-bit with packing {header.packing}")
+
+    image_size = expected_image_size(header)
+    if image_size is not None and actual_size > image_offset + image_size:
+        anomalies.append(f"{actual_size - image_offset - image_size} bytes of trailing data")
+
+    mask = _padding_mask(header)
+    with open(dpx_path, 'rb') as file:
+        if header.user_data_size not in (0, UNDEFINED_U32):
+            anomalies.append(f"{header.user_data_size} bytes of user data")
+            user_data_end = DPX_HEADER_SIZE + header.user_data_size
+        else:
+            user_data_end = DPX_HEADER_SIZE
+        if image_offset > user_data_end:
+            file.seek(user_data_end)
+            if file.read(image_offset - user_data_end).strip(b'\0'):
+                anomalies.append("non-zero bytes between headers and image data")
+        if mask:
+            file.seek(image_offset)
+            data = file.read(min(PADDING_SCAN_BYTES, image_size or PADDING_SCAN_BYTES))
+            words = array.array('I')
+            words.frombytes(data[:len(data) - len(data) % 4])
+            if (header.endianness == 'Big') == (sys.byteorder == 'little'):
+                words.byteswap()
+            if any(word & mask for word in words):
+                anomalies.append("non-zero padding bits")
+
+    return anomalies
+
+
+def sample_frames(dpx_files: list, sample_size: int, seed=None) -> list:
+    """Picks a stratified random sample of frames: the first and last frame plus one random frame per stratum"""
+    if len(dpx_files) <= sample_size:
+        return list(dpx_files)
+    rng = random.Random(seed)
+    strata = sample_size - 2
+    picks = {0, len(dpx_files) - 1}
+    for stratum in range(strata):
+        start = 1 + stratum * (len(dpx_files) - 2) // strata
+        end = 1 + (stratum + 1) * (len(dpx_files) - 2) // strata
+        picks.add(rng.randrange(start, max(end, start + 1)))
+    return [dpx_files[i] for i in sorted(picks)]
+
+
+def probe_reversibility(dpx_files: list, license_key: str, abort_message: str, sample_size: int = 32,
+                        line_callback=None):
+    """Classifies a sequence as needing rawcooked output version 1 or 2 from a sample of its frames
+
+    The sampled frames are linked into a temporary, gapless sequence which is checked with rawcooked --check
+    --no-encode, and their headers are scanned for characteristics known to produce large reversibility data.
+    Returns (verdict, reasons) where verdict is V2 if the sample already triggers abort_message, V1 if the sample is
+    clean and has no anomalies, or None when the result is ambiguous and the whole sequence has to be checked.
+    """
+    if not dpx_files:
+        return None, ["no DPX files"]
+    sample = sample_frames(dpx_files, sample_size, seed=os.path.dirname(dpx_files[0]))
+
+    reasons = []
+    for dpx_file in sample:
+        try:
+            reasons.extend(f"{os.path.basename(dpx_file)}: {a}" for a in find_header_anomalies(dpx_file))
+        except (OSError, ValueError) as e:
+            reasons.append(f"{os.path.basename(dpx_file)}: {e}")
+
+    temp_dir = tempfile.mkdtemp(prefix='v2_probe_')
+    try:
+        sample_dir = os.path.join(temp_dir, 'sample')
+        os.mkdir(sample_dir)
+        for index, dpx_file in enumerate(sample):
+            os.symlink(os.path.abspath(dpx_file), os.path.join(sample_dir, f"sample_{index:07d}.dpx"))
+        command = ['rawcooked', '--license', license_key, '--check', '--no-encode', sample_dir]
+        result = run_command(command, line_callback=line_callback, abort_on=[abort_message])
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if result.found(abort_message):
+        return V2, [f"sample of {len(sample)} frames: {abort_message}"] + reasons
+    if result.returncode != 0:
+        return None, [f"sample probe exited with code {result.returncode}"] + reasons
+    if reasons:
+        return None, reasons
+    return V1, []
@@ -0,0 +1,116 @@
+import json
+import math
+import os
+import shutil
+
+# Hidden folder of each cook folder holding the frame-range views of the segmented sequences. It is on the same file
+# system as the sequences, so the views are made of hard links and cost no copy
+SEGMENTS_DIR = '.segments'
+MANIFEST_SUFFIX = '.segments.json'
+
+# Status of a reel and of each of its segments in the manifest
+REEL_COOKING = 'cooking'
+REEL_COOKED = 'cooked'
+REEL_FAILED = 'failed'
+SEGMENT_QUEUED = 'queued'
+SEGMENT_COOKED = 'cooked'
+SEGMENT_FAILED = 'failed'
+SEGMENT_CANCELLED = 'cancelled'
+
+
+def segment_name(name: str, number: int) -> str:
+    return f"{name}_part{number:02d}"
+
+
+def plan_segments(frame_count: int, byte_total: int, max_frames: int = 0, max_bytes: int = 0) -> list:
+    """Splits a sequence into the fewest equal frame ranges under max_frames frames and max_bytes bytes
+
+    Returns a list of (start, stop) frame positions, with a single range when the sequence is under both limits or
+    no limit is set.
+    """
+    count = 1
+    if max_frames > 0:
+        count = max(count, math.ceil(frame_count / max_frames))
+    if max_bytes > 0:
+        count = max(count, math.ceil(byte_total / max_bytes))
+    count = min(count, max(frame_count, 1))
+    bounds = [round(i * frame_count / count) for i in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def staging_folder(seq_path: str) -> str:
+    """Returns the folder holding the segment views of a sequence, in the hidden folder of its cook folder"""
+    cook_folder, name = os.path.split(os.path.normpath(seq_path))
+    return os.path.join(cook_folder, SEGMENTS_DIR, name)
+
+
+def _link(source: str, destination: str) -> None:
+    try:
+        os.link(source, destination)
+    except OSError:
+        # File systems without hard links, rawcooked reads through the symlink
+        os.symlink(source, destination)
+
+
+def stage_segments(seq_path: str, index, ranges: list) -> list:
+    """Creates one folder per frame range holding links to its frames, under the same relative path as in seq_path
+
+    Each segment folder is cooked on its own and rawcooked writes its framemd5 next to it. Returns the segment
+    records of the manifest.
+    """
+    name = os.path.basename(os.path.normpath(seq_path))
+    root = staging_folder(seq_path)
+    if os.path.exists(root):
+        # Left behind by an interrupted run
+        shutil.rmtree(root)
+    relative = os.path.relpath(index.folder, seq_path)
+
+    segments = []
+    for number, (start, stop) in enumerate(ranges, 1):
+        segment = segment_name(name, number)
+        segment_path = os.path.join(root, segment)
+        frames_folder = os.path.normpath(os.path.join(segment_path, relative))
+        os.makedirs(frames_folder)
+        for frame_name in index.names[start:stop]:
+            _link(os.path.join(index.folder, frame_name), os.path.join(frames_folder, frame_name))
+        segments.append({
+            'name': segment,
+            'staging': segment_path,
+            'framemd5': f"{segment_path}.framemd5",
+            'first_frame': int(index.numbers[start]),
+            'last_frame': int(index.numbers[stop - 1]),
+            'frames': stop - start,
+            'bytes': int(index.sizes[start:stop].sum()),
+            'status': SEGMENT_QUEUED,
+        })
+    return segments
+
+
+def remove_staging(seq_path: str) -> None:
+    """Removes the segment views of a sequence, the links only, the frames themselves are left untouched"""
+    root = staging_folder(seq_path)
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    segments_dir = os.path.dirname(root)
+    try:
+        os.rmdir(segments_dir)
+    except OSError:
+        pass
+
+
+def manifest_path(mkv_folder: str, name: str) -> str:
+    return os.path.join(mkv_folder, f"{name}{MANIFEST_SUFFIX}")
+
+
+def write_manifest(path: str, manifest: dict) -> None:
+    """Writes a manifest atomically, so post-rawcook never reads a partial one"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(temp_path, path)
+
+
+def read_manifest(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
@@ -0,0 +1,181 @@
+import os
+import re
+import threading
+
+import numpy as np
+
+# <prefix><frame number>.dpx, the frame number being the last run of digits before the extension
+FRAME_PATTERN = re.compile(r'^(?P<prefix>.*?)(?P<number>\d+)\.dpx$', re.IGNORECASE)
+INDEX_VERSION = 1
+INDEX_CACHE_NAME = 'sequence_index'
+
+
+class SequenceIndex:
+    """Frame numbers, file names and sizes of the DPX files of one sequence folder, built from a single scandir"""
+
+    def __init__(self, folder, names, numbers, widths, sizes, prefixes, dir_stat, mtimes=None):
+        self.folder = folder
+        # Sorted by frame number, then by name
+        self.names = names
+        self.numbers = numbers
+        self.widths = widths
+        self.sizes = sizes
+        self.prefixes = prefixes
+        # (st_dev, st_ino, st_mtime_ns) of the folder when the index was built, used to find and validate the cache
+        self.dir_stat = dir_stat
+        # Modification times of the frames, only known for an index just built as they are not kept in the cache
+        self.mtimes = mtimes
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.numbers)
+
+    @property
+    def byte_total(self) -> int:
+        return int(self.sizes.sum())
+
+    def paths(self) -> list:
+        return [os.path.join(self.folder, name) for name in self.names]
+
+    def find_issues(self) -> dict:
+        """Finds gaps, out of range frames, duplicate frame numbers, mixed padding widths and mixed file name prefixes
+
+        Returns a dict with one entry per kind of issue found, an empty dict for a clean sequence.
+        """
+        issues = {}
+        if not len(self.numbers):
+            return {'empty': True}
+
+        steps = np.diff(self.numbers)
+        gap_positions = np.nonzero(steps > 1)[0]
+        if len(gap_positions):
+            issues['gaps'] = [(int(self.numbers[i]) + 1, int(self.numbers[i + 1]) - 1) for i in gap_positions]
+            issues['missing_frames'] = int((steps[gap_positions] - 1).sum())
+            low, high = self.main_range(gap_positions)
+            outside = self.numbers[(self.numbers < low) | (self.numbers > high)]
+            if len(outside):
+                issues['out_of_range'] = sorted(set(int(n) for n in outside))
+
+        duplicate_positions = np.nonzero(steps == 0)[0]
+        if len(duplicate_positions):
+            issues['duplicates'] = sorted(set(int(self.numbers[i]) for i in duplicate_positions))
+
+        # Numbers with more digits than the padding can legitimately be wider, only shorter widths are mixed padding
+        digits = np.floor(np.log10(np.maximum(self.numbers, 1))).astype(np.int64) + 1
+        padded = self.widths > digits
+        padded_widths = np.unique(self.widths[padded])
+        if len(padded_widths) > 1 or (len(padded_widths) == 1 and np.any(self.widths[~padded] < padded_widths[0])):
+            issues['mixed_padding'] = [int(w) for w in np.unique(self.widths)]
+
+        if len(self.prefixes) > 1:
+            issues['mixed_prefixes'] = list(self.prefixes)
+
+        return issues
+
+    def main_range(self, gap_positions) -> tuple:
+        """Returns the first and last frame numbers of the main run of the sequence
+
+        Starts from the longest run of consecutive numbers and takes in the neighbouring runs while the gap to them
+        is not longer than the range gathered so far. Frames outside it are too far away to belong to the sequence,
+        such as a stray frame 0 before a sequence numbered from a timecode.
+        """
+        starts = np.concatenate(([0], gap_positions + 1))
+        ends = np.concatenate((gap_positions, [len(self.numbers) - 1]))
+        first = last = int(np.argmax(self.numbers[ends] - self.numbers[starts]))
+        extended = True
+        while extended:
+            extended = False
+            span = self.numbers[ends[last]] - self.numbers[starts[first]] + 1
+            if first > 0 and self.numbers[starts[first]] - self.numbers[ends[first - 1]] - 1 <= span:
+                first -= 1
+                extended = True
+            if last < len(starts) - 1 and self.numbers[starts[last + 1]] - self.numbers[ends[last]] - 1 <= span:
+                last += 1
+                extended = True
+        return int(self.numbers[starts[first]]), int(self.numbers[ends[last]])
+
+
+def _dir_stat(folder: str):
+    stat = os.stat(folder)
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns
+
+
+def build_index(folder: str) -> SequenceIndex:
+    """Indexes the DPX files of a folder with a single scandir pass"""
+    dir_stat = _dir_stat(folder)
+    names = []
+    numbers = []
+    widths = []
+    sizes = []
+    mtimes = []
+    prefixes = set()
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            match = FRAME_PATTERN.match(entry.name)
+            if not match or not entry.is_file():
+                continue
+            number = match.group('number')
+            names.append(entry.name)
+            numbers.append(int(number))
+            widths.append(len(number))
+            stat = entry.stat()
+            sizes.append(stat.st_size)
+            mtimes.append(stat.st_mtime_ns)
+            prefixes.add(match.group('prefix'))
+
+    numbers = np.array(numbers, dtype=np.int64)
+    names = np.array(names, dtype=str)
+    order = np.lexsort((names, numbers)) if len(names) else np.array([], dtype=np.int64)
+    return SequenceIndex(folder, names[order].tolist(), numbers[order], np.array(widths, dtype=np.int64)[order],
+                         np.array(sizes, dtype=np.int64)[order], sorted(prefixes), dir_stat,
+                         np.array(mtimes, dtype=np.int64)[order])
+
+
+def _cache_path(cache_dir: str, dir_stat) -> str:
+    # Keyed by device and inode, which a folder keeps while it is renamed between stage folders. The index is kept
+    # out of the sequence folder itself as rawcooked would attach any extra file to the MKV
+    return os.path.join(cache_dir, f"{dir_stat[0]}-{dir_stat[1]}.index.npz")
+
+
+def load_cached_index(folder: str, cache_dir: str):
+    """Returns the cached index of a folder if the folder has not changed since it was built, else None"""
+    try:
+        dir_stat = _dir_stat(folder)
+        with np.load(_cache_path(cache_dir, dir_stat)) as data:
+            if int(data['version']) != INDEX_VERSION or tuple(int(v) for v in data['dir_stat']) != dir_stat:
+                return None
+            return SequenceIndex(folder, data['names'].tolist(), data['numbers'], data['widths'], data['sizes'],
+                                 data['prefixes'].tolist(), dir_stat)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def save_index(index: SequenceIndex, cache_dir: str) -> None:
+    """Writes an index to the cache, atomically so a concurrent reader never sees a partial file"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(cache_dir, index.dir_stat)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+    np.savez(temp_path, version=INDEX_VERSION, names=np.array(index.names, dtype=str), numbers=index.numbers,
+             widths=index.widths, sizes=index.sizes, prefixes=np.array(index.prefixes, dtype=str),
+             dir_stat=np.array(index.dir_stat, dtype=np.uint64))
+    os.replace(temp_path, path)
+
+
+def get_index(folder: str, cache_dir: str = None) -> SequenceIndex:
+    """Returns the index of a folder from the cache when it is still valid, else builds and caches it"""
+    if cache_dir:
+        index = load_cached_index(folder, cache_dir)
+        if index is not None:
+            return index
+    index = build_index(folder)
+    if cache_dir:
+        try:
+            save_index(index, cache_dir)
+        except OSError as e:
+            print(f"Error caching sequence index: {e}")
+    return index
+
+
+def default_cache_dir(logs_dir: str) -> str:
+    """Returns the index cache folder shared by the workflow scripts, SEQUENCE_INDEX_CACHE overrides it"""
+    return os.environ.get('SEQUENCE_INDEX_CACHE', os.path.join(logs_dir, INDEX_CACHE_NAME))
@@ -0,0 +1,202 @@
+import os
+import sqlite3
+import threading
+import time
+
+STATE_DB_NAME = 'workflow_state.db'
+
+# Stages recorded by the workflow scripts
+GAP_PASSED = 'gap_passed'
+GAP_FAILED = 'gap_failed'
+V2_CHECKED = 'v2_checked'
+POLICY_PASSED = 'policy_passed'
+POLICY_FAILED = 'policy_failed'
+TO_COOK = 'to_cook'
+TO_COOK_V2 = 'to_cook_v2'
+COOKING = 'cooking'
+COOKED = 'cooked'
+COOK_FAILED = 'cook_failed'
+MKV_POLICY_FAILED = 'mkv_policy_failed'
+POST_FAILED = 'post_failed'
+COMPLETED = 'completed'
+# Same name and content as a sequence already completed, not cooked again
+DUPLICATE = 'duplicate'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    path TEXT,
+    file_count INTEGER,
+    byte_total INTEGER,
+    dir_signature TEXT,
+    exit_code INTEGER,
+    output_path TEXT,
+    output_bytes INTEGER,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    from_stage TEXT,
+    to_stage TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS transitions_name ON transitions (name);
+"""
+
+# File systems SQLite's locking and WAL mode do not work over, so a database on them cannot be shared between nodes
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', 'ceph', 'glusterfs', 'lustre', 'gpfs', '9p',
+                       'fuse.sshfs')
+
+_FIELDS = ('path', 'file_count', 'byte_total', 'dir_signature', 'exit_code', 'output_path', 'output_bytes')
+
+
+def directory_signature(seq_path: str) -> str:
+    """Returns a signature of a sequence folder built from the mtimes of its directories only
+
+    Adding, removing or renaming a frame changes the mtime of its directory, so an unchanged signature means the file
+    list is unchanged without stat'ing every frame.
+    """
+    parts = []
+    folders = [seq_path]
+    while folders:
+        folder = folders.pop()
+        parts.append(f"{os.path.relpath(folder, seq_path)}:{os.stat(folder).st_mtime_ns}")
+        with os.scandir(folder) as entries:
+            folders.extend(entry.path for entry in entries if entry.is_dir())
+    return '|'.join(sorted(parts))
+
+
+def filesystem_type(path: str):
+    """Returns the type of the file system path is on, from the longest matching mount point of /proc/mounts, or None
+    where /proc/mounts is not available"""
+    path = os.path.realpath(path)
+    mount_point = ''
+    fstype = None
+    try:
+        with open('/proc/mounts') as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces in mount points are escaped as \040
+                point = fields[1].replace('\\040', ' ')
+                if (path == point or path.startswith(point.rstrip('/') + '/')) and len(point) >= len(mount_point):
+                    mount_point, fstype = point, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+
+def is_network_filesystem(path: str) -> bool:
+    return filesystem_type(path) in NETWORK_FILESYSTEMS
+
+
+def scan_sequence(seq_path: str):
+    """Counts the files and bytes of a sequence folder with a single stat pass"""
+    file_count = 0
+    byte_total = 0
+    folders = [seq_path]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    folders.append(entry.path)
+                else:
+                    file_count += 1
+                    byte_total += entry.stat().st_size
+    return file_count, byte_total
+
+
+class StateJournal:
+    """SQLite journal of the stage transitions of every sequence, keyed by sequence folder name
+
+    Shared by the assessment, rawcook and post-rawcook scripts so that reruns can skip verified work and tell a
+    complete MKV from one left behind by an interrupted encode.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        # WAL lets the scripts and the daemon read while another process writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(_SCHEMA)
+
+    def get(self, name: str):
+        """Returns the journal record of a sequence as a dict, or None"""
+        with self.lock:
+            cursor = self.connection.execute('SELECT * FROM sequences WHERE name = ?', (name,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([column[0] for column in cursor.description], row))
+
+    def record(self, name: str, stage: str, detail: str = None, **fields) -> None:
+        """Records that a sequence reached a stage, along with any of the sequence fields"""
+        unknown = set(fields) - set(_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown journal fields: {', '.join(sorted(unknown))}")
+
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.connection.execute('SELECT stage FROM sequences WHERE name = ?', (name,)).fetchone()
+                previous = row[0] if row else None
+                if row is None:
+                    self.connection.execute('INSERT INTO sequences (name, stage, updated) VALUES (?, ?, ?)',
+                                            (name, stage, now))
+                assignments = ', '.join(f"{field} = ?" for field in fields)
+                self.connection.execute(
+                    f"UPDATE sequences SET stage = ?, updated = ?{', ' + assignments if fields else ''} "
+                    f"WHERE name = ?", (stage, now, *fields.values(), name))
+                self.connection.execute(
+                    'INSERT INTO transitions (name, from_stage, to_stage, timestamp, detail) VALUES (?, ?, ?, ?, ?)',
+                    (name, previous, stage, now, detail))
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def history(self, name: str) -> list:
+        """Returns the (from_stage, to_stage, timestamp, detail) transitions of a sequence in order"""
+        with self.lock:
+            return self.connection.execute(
+                'SELECT from_stage, to_stage, timestamp, detail FROM transitions WHERE name = ? ORDER BY id',
+                (name,)).fetchall()
+
+    def compression_samples(self, limit: int) -> list:
+        """Returns (source bytes, output bytes) of the last MKVs cooked successfully, oldest first
+
+        Segmented reels, recorded with their manifest as output, are left out, their segments are counted instead.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT byte_total, output_bytes FROM sequences WHERE stage IN (?, ?) AND byte_total > 0 "
+                "AND output_bytes > 0 AND output_path LIKE '%.mkv' ORDER BY updated DESC LIMIT ?",
+                (COOKED, COMPLETED, limit)).fetchall()
+        return rows[::-1]
+
+    def passed(self, name: str, stage: str, seq_path: str) -> bool:
+        """Returns True if the sequence already went through stage and its folder has not changed since"""
+        record = self.get(name)
+        if record is None or record['dir_signature'] is None:
+            return False
+        if stage not in (to_stage for _, to_stage, _, _ in self.history(name)):
+            return False
+        try:
+            return directory_signature(seq_path) == record['dir_signature']
+        except OSError:
+            return False
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def open_journal(logs_dir: str) -> StateJournal:
+    """Opens the journal shared by the workflow scripts, WORKFLOW_STATE_DB overrides its location"""
+    return StateJournal(os.environ.get('WORKFLOW_STATE_DB', os.path.join(logs_dir, STATE_DB_NAME)))
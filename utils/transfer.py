@@ -0,0 +1,259 @@
+import concurrent.futures
+import errno
+import os
+import shutil
+import threading
+import time
+
+from utils.lease import default_node
+from utils.util_functions import log
+
+# Cross-device moves are staged under a hidden name in the destination folder and only renamed into place once
+# verified. Scripts scanning the stage folders skip names with this prefix.
+TRANSFER_PREFIX = '.transfer-'
+# Separates the node from the pid in the staging names, as process ids are only meaningful on their own node
+NODE_SEPARATOR = '@'
+CHUNK_SIZE = 64 * 1024 * 1024
+PROGRESS_SECONDS = 10
+
+# Errors copy_file_range and sendfile return when they cannot copy between the two files
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+
+def is_transfer_temp(name: str) -> bool:
+    """Returns True for the staging and clean-up entries of a cross-device move in progress"""
+    return name.startswith(TRANSFER_PREFIX)
+
+
+def transfer_temp_name(name: str) -> str:
+    """Returns the staging name of name for this process, <prefix><node>@<pid>-<name>"""
+    node = default_node().replace(NODE_SEPARATOR, '_')
+    return f"{TRANSFER_PREFIX}{node}{NODE_SEPARATOR}{os.getpid()}-{name}"
+
+
+def same_device(source: str, destination: str) -> bool:
+    """Returns True if source can be renamed to destination, which does not need to exist yet"""
+    return os.stat(source).st_dev == os.stat(os.path.dirname(os.path.abspath(destination)) or '.').st_dev
+
+
+class TransferResult:
+    """Outcome of transfer"""
+
+    def __init__(self, renamed, files=0, byte_total=0, seconds=0.0):
+        # True when the move was a single rename, no data was copied
+        self.renamed = renamed
+        self.files = files
+        self.byte_total = byte_total
+        self.seconds = seconds
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.byte_total / self.seconds if self.seconds else 0.0
+
+
+class _Progress:
+    """Reports the bytes copied at most every PROGRESS_SECONDS"""
+
+    def __init__(self, name, byte_total, logfile):
+        self.name = name
+        self.byte_total = byte_total
+        self.logfile = logfile
+        self.done = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.lock = threading.Lock()
+
+    def add(self, count: int) -> None:
+        with self.lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self.last_report < PROGRESS_SECONDS:
+                return
+            self.last_report = now
+            done = self.done
+        self.report(f"{done / max(self.byte_total, 1):.0%} of {self.byte_total / 2 ** 30:.1f} GiB at "
+                    f"{done / (now - self.start) / 2 ** 20:.0f} MiB/s")
+
+    def report(self, message: str) -> None:
+        message = f"Moving {self.name}: {message}"
+        if self.logfile:
+            log(self.logfile, message)
+        else:
+            print(message)
+
+
+def _copy_range(source: str, destination: str, offset: int, length: int, progress: _Progress) -> None:
+    """Copies length bytes at offset, in kernel space with copy_file_range or sendfile where the kernel allows it"""
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        destination_fd = os.open(destination, os.O_WRONLY)
+        try:
+            end = offset + length
+            position = offset
+            method = 'copy_file_range' if hasattr(os, 'copy_file_range') else 'sendfile'
+            while position < end:
+                count = min(end - position, CHUNK_SIZE)
+                try:
+                    if method == 'copy_file_range':
+                        copied = os.copy_file_range(source_fd, destination_fd, count, position, position)
+                    elif method == 'sendfile':
+                        os.lseek(destination_fd, position, os.SEEK_SET)
+                        copied = os.sendfile(destination_fd, source_fd, position, count)
+                    else:
+                        copied = os.pwrite(destination_fd, os.pread(source_fd, count, position), position)
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED or method == 'pwrite':
+                        raise
+                    method = 'sendfile' if method == 'copy_file_range' else 'pwrite'
+                    continue
+                if copied == 0:
+                    raise OSError(errno.EIO, f"{source} is shorter than expected")
+                position += copied
+                progress.add(copied)
+        finally:
+            os.close(destination_fd)
+    finally:
+        os.close(source_fd)
+
+
+def _finish_file(source: str, destination: str, size: int) -> None:
+    """Flushes a copied file to disk and checks its size before the source can be deleted"""
+    fd = os.open(destination, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        copied_size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+    if copied_size != size:
+        raise OSError(errno.EIO, f"{destination} is {copied_size} bytes, {source} is {size}")
+    shutil.copystat(source, destination)
+
+
+def remove_stale_transfers(folder: str) -> None:
+    """Deletes the staging and clean-up entries left in folder by interrupted moves of processes no longer running
+
+    Only the entries of this node are considered, a shared stage folder also holds the moves in progress of others.
+    """
+    node = default_node().replace(NODE_SEPARATOR, '_')
+    try:
+        with os.scandir(folder) as entries:
+            temps = [entry for entry in entries if is_transfer_temp(entry.name)]
+    except OSError:
+        return
+    for entry in temps:
+        owner, separator, rest = entry.name[len(TRANSFER_PREFIX):].partition(NODE_SEPARATOR)
+        if not separator or owner != node:
+            continue
+        try:
+            pid = int(rest.split('-', 1)[0])
+            os.kill(pid, 0)
+            continue
+        except (ValueError, ProcessLookupError):
+            pass
+        except PermissionError:
+            continue
+        print(f"Removing leftover of an interrupted move: {entry.path}")
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.remove(entry.path)
+
+
+def _copy_tree(source: str, staging: str, workers: int, logfile) -> tuple:
+    """Copies a file or folder to staging with a pool of chunked copies, returns (files, bytes)"""
+    files = []
+    if os.path.isdir(source):
+        for folder, dir_names, file_names in os.walk(source):
+            target_folder = os.path.join(staging, os.path.relpath(folder, source))
+            os.makedirs(target_folder, exist_ok=True)
+            for file_name in file_names:
+                path = os.path.join(folder, file_name)
+                target = os.path.join(target_folder, file_name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), target)
+                else:
+                    files.append((path, target, os.path.getsize(path)))
+    else:
+        files.append((source, staging, os.path.getsize(source)))
+
+    byte_total = sum(size for _, _, size in files)
+    progress = _Progress(os.path.basename(source), byte_total, logfile)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        chunks = []
+        for path, target, size in files:
+            with open(target, 'wb') as file:
+                file.truncate(size)
+            chunks += [executor.submit(_copy_range, path, target, offset, min(CHUNK_SIZE, size - offset), progress)
+                       for offset in range(0, size, CHUNK_SIZE)]
+        for future in concurrent.futures.as_completed(chunks):
+            future.result()
+        for future in [executor.submit(_finish_file, path, target, size) for path, target, size in files]:
+            future.result()
+
+    if os.path.isdir(source):
+        for folder, _, _ in os.walk(source):
+            shutil.copystat(folder, os.path.join(staging, os.path.relpath(folder, source)))
+    return len(files), byte_total
+
+
+def transfer(source, destination, logfile: str = None, workers: int = None, metrics=None) -> TransferResult:
+    """Moves a file or folder to destination, the full destination path, see _move
+
+    With metrics, the move is recorded as a 'move' stage with the files and bytes copied.
+    """
+    if metrics is None:
+        return _move(source, destination, logfile, workers)
+    with metrics.stage('move', destination) as stage:
+        result = _move(source, destination, logfile, workers)
+        stage.add(renames=int(result.renamed), files=result.files, bytes_read=result.byte_total,
+                  bytes_written=result.byte_total)
+    return result
+
+
+def _move(source, destination, logfile: str = None, workers: int = None) -> TransferResult:
+    """Moves a file or folder to destination
+
+    On the same device this is a single rename whatever the size of the folder. Across devices the data is copied by
+    a pool of workers, chunk by chunk, into a hidden staging entry next to destination, flushed and checked, and only
+    then renamed to destination. The source is renamed to a hidden name before being deleted, so an interrupted move
+    leaves either the complete source or the complete destination in the stage folders, never half a sequence. The
+    hidden leftovers of interrupted moves are removed by the next move to the same folder. Progress and throughput
+    of cross-device moves go to logfile, or are printed.
+    """
+    source = os.fspath(source)
+    destination = os.fspath(destination)
+    if same_device(source, destination):
+        os.rename(source, destination)
+        return TransferResult(True)
+
+    if os.path.lexists(destination):
+        raise FileExistsError(f"Cannot move {source}, {destination} already exists")
+    workers = workers or int(os.environ.get('TRANSFER_WORKERS', 8))
+    destination_folder = os.path.dirname(os.path.abspath(destination))
+    remove_stale_transfers(destination_folder)
+    staging = os.path.join(destination_folder, transfer_temp_name(os.path.basename(destination)))
+
+    start = time.monotonic()
+    try:
+        files, byte_total = _copy_tree(source, staging, workers, logfile)
+        os.rename(staging, destination)
+    except BaseException:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging, ignore_errors=True)
+        elif os.path.lexists(staging):
+            os.remove(staging)
+        raise
+
+    source_folder = os.path.dirname(os.path.abspath(source))
+    trash = os.path.join(source_folder, transfer_temp_name(f"{os.path.basename(source)}.moved"))
+    os.rename(source, trash)
+    if os.path.isdir(trash):
+        shutil.rmtree(trash)
+    else:
+        os.remove(trash)
+
+    result = TransferResult(False, files, byte_total, time.monotonic() - start)
+    _Progress(os.path.basename(source), byte_total, logfile).report(
+        f"copied {files} files, {byte_total / 2 ** 30:.1f} GiB in {result.seconds:.0f}s at "
+        f"{result.bytes_per_second / 2 ** 20:.0f} MiB/s")
+    return result